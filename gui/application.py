@@ -23,6 +23,7 @@ import lib.document
 from lib import brush
 from lib import helpers
 from lib import mypaintlib
+from lib import tiledsurface
 from libmypaint import brushsettings
 
 
@@ -204,7 +205,7 @@ class Application (object):
         app_canvas = self.builder.get_object("app_canvas")
 
         # Working document: model and controller
-        model = lib.document.Document(self.brush)
+        model = lib.document.Document(self.brush, progressive_load=True)
         self.doc = document.Document(self, app_canvas, model)
         app_canvas.set_model(model)
 
@@ -359,6 +360,8 @@ class Application (object):
         self.update_input_mapping()
         self.update_input_devices()
         self.update_button_mapping()
+        self.update_tile_memory_budget()
+        self.update_undo_memory_budget()
         self.preferences_window.update_ui()
 
 
@@ -409,10 +412,13 @@ class Application (object):
             'ui.toolbar_icon_size': 'large',
             'ui.dark_theme_variant': True,
             'saving.default_format': 'openraster',
+            'saving.xsheet_format': 'json',
             'brushmanager.selected_brush' : None,
             'brushmanager.selected_groups' : [],
             'frame.color_rgba': (0.12, 0.12, 0.12, 0.92),
             'misc.context_restores_color': True,
+            'memory.tile_budget_mb': 1024,
+            'memory.undo_budget_mb': 256,
 
             "scratchpad.last_opened_scratchpad": "",
 
@@ -511,6 +517,17 @@ class Application (object):
         self.button_mapping.update(self.preferences["input.button_mapping"])
 
 
+    def update_tile_memory_budget(self):
+        budget_mb = self.preferences['memory.tile_budget_mb']
+        tiledsurface.tile_memory.set_budget(budget_mb * 1024 * 1024)
+
+
+    def update_undo_memory_budget(self):
+        budget = self.preferences['memory.undo_budget_mb'] * 1024 * 1024
+        for doc in (self.doc, self.scratchpad_doc):
+            doc.model.command_stack.set_memory_budget(budget)
+
+
     def update_input_mapping(self):
         p = self.preferences['input.global_pressure_mapping']
         if len(p) == 2 and abs(p[0][1]-1.0)+abs(p[1][1]-0.0) < 0.0001:
@@ -258,6 +258,9 @@ class FileHandler(object):
                 func(self.filename)
             logger.info('Loaded from %r', self.filename)
             self.app.doc.reset_view(True, True, True)
+            # Decode the layers in view before the rest
+            bbox = self.doc.tdw.get_visible_model_bbox()
+            self.doc.model.prioritize_loading(bbox=bbox)
             # try to restore the last used brush and color
             layers = self.doc.model.layer_stack
             search_layers = []
@@ -324,6 +327,9 @@ class FileHandler(object):
             x, y, w, h =  doc.model.get_bbox()
             if w == 0 and h == 0:
                 w, h = tiledsurface.N, tiledsurface.N # TODO: support for other sizes
+            if filename.lower().endswith('.ora'):
+                options.setdefault('xsheet_format',
+                                   self.app.preferences['saving.xsheet_format'])
             thumbnail_pixbuf = doc.model.save(filename, feedback_cb=self.gtk_main_tick, **options)
             self.lastsavefailed = False
         except document.SaveLoadError, e:
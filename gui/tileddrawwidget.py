@@ -21,6 +21,7 @@ from math import floor, ceil, log, exp
 from numpy import isfinite
 from warnings import warn
 import weakref
+from collections import OrderedDict
 import logging
 logger = logging.getLogger(__name__)
 
@@ -37,6 +38,9 @@ _ALPHA_CHECK_SIZE = 16
 _ALPHA_CHECK_COLOR_1 = (0.45, 0.45, 0.45)
 _ALPHA_CHECK_COLOR_2 = (0.50, 0.50, 0.50)
 
+#: Maximum number of composited tiles kept by each renderer (16KiB each)
+_DISPLAY_TILE_CACHE_SIZE = 2048
+
 
 ## Class definitions
 
@@ -161,7 +165,11 @@ class TiledDrawWidget (gtk.EventBox):
         root = model.layer_stack
         root.current_path_updated += renderer.current_layer_changed_cb
         root.layer_properties_changed += renderer.layer_props_changed_cb
+        root.layer_inserted += renderer.layer_stack_changed_cb
+        root.layer_deleted += renderer.layer_stack_changed_cb
         model.brush.brushinfo.observers.append(renderer.brush_modified_cb)
+        tiledsurface.mipmap_scheduler.observers.append(
+            renderer.mipmap_rebuilt_cb)
         self.doc = model
         self.renderer.queue_draw()
 
@@ -274,6 +282,10 @@ class TiledDrawWidget (gtk.EventBox):
     def get_center_model_coords(self):
         return self.renderer.get_center_model_coords
 
+    @property
+    def get_visible_model_bbox(self):
+        return self.renderer.get_visible_model_bbox
+
     @property
     def recenter_on_model_coords(self):
         return self.renderer.recenter_on_model_coords
@@ -509,6 +521,67 @@ def calculate_transformation_matrix(scale, rotation, translation_x, translation_
 
     return matrix
 
+class _DisplayTileCache (object):
+    """Composited 8bpp display tiles, reused between repaints
+
+    Tiles are keyed by ``(mipmap_level, tx, ty)`` in the tile grid of
+    their mipmap level, and the least recently used ones are dropped
+    when there are too many.
+    """
+
+    def __init__(self, size=_DISPLAY_TILE_CACHE_SIZE):
+        object.__init__(self)
+        self.size = size
+        self._tiles = OrderedDict()
+        self._dst_has_alpha = None
+
+    def clear(self):
+        self._tiles.clear()
+
+    def set_dst_has_alpha(self, dst_has_alpha):
+        """Clears the cache if the kind of tile being rendered changes"""
+        if dst_has_alpha != self._dst_has_alpha:
+            self._tiles.clear()
+            self._dst_has_alpha = dst_has_alpha
+
+    def get(self, mipmap_level, tx, ty):
+        key = (mipmap_level, tx, ty)
+        tile = self._tiles.pop(key, None)
+        if tile is not None:
+            self._tiles[key] = tile
+        return tile
+
+    def put(self, mipmap_level, tx, ty, tile):
+        """Stores a copy of a rendered tile"""
+        key = (mipmap_level, tx, ty)
+        self._tiles.pop(key, None)
+        self._tiles[key] = tile.copy()
+        while len(self._tiles) > self.size:
+            self._tiles.popitem(last=False)
+
+    def invalidate_area(self, x, y, w, h):
+        """Drops the tiles at any level touching an area of the model"""
+        tiles = self._tiles
+        if not tiles:
+            return
+        N = tiledsurface.N
+        for level in xrange(tiledsurface.MAX_MIPMAP_LEVEL + 1):
+            size = N << level
+            tx1 = int(x // size)
+            ty1 = int(y // size)
+            tx2 = int((x + w - 1) // size)
+            ty2 = int((y + h - 1) // size)
+            if (tx2 - tx1 + 1) * (ty2 - ty1 + 1) > len(tiles):
+                for key in tiles.keys():
+                    l, tx, ty = key
+                    if l == level and tx1 <= tx <= tx2 and ty1 <= ty <= ty2:
+                        del tiles[key]
+            else:
+                for tx in xrange(tx1, tx2 + 1):
+                    for ty in xrange(ty1, ty2 + 1):
+                        tiles.pop((level, tx, ty), None)
+
+
 class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
     """Render the document model to screen.
 
@@ -538,6 +611,10 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         self.mirrored = False
         self.cached_transformation_matrix = None
 
+        # Coalesced scrolling: see scroll()
+        self._scroll_start = None
+        self._scroll_srcid = None
+
         self.overlay_layer = None
 
         # gets overwritten for the main window
@@ -564,6 +641,9 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         self._alpha_check_bg = None
         self._init_alpha_check_bg()
 
+        # Composited tiles, so that panning need not recomposite
+        self._tile_cache = _DisplayTileCache()
+
 
     def _init_alpha_check_bg(self):
         """Initialize the alpha check surface used for no-bg renderings"""
@@ -651,6 +731,11 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
     def canvas_modified_cb(self, model, x, y, w, h):
         """Handles area redraw notifications from the underlying model"""
 
+        if w == 0 and h == 0:
+            self._tile_cache.clear()
+        else:
+            self._tile_cache.invalidate_area(x, y, w, h)
+
         if not self.get_window():
             return
 
@@ -665,12 +750,27 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         corners = [self.model_to_display(x, y) for (x, y) in corners]
         self.queue_draw_area(*helpers.rotated_rectangle_bbox(corners))
 
+    def mipmap_rebuilt_cb(self, x, y, w, h):
+        """Redraws areas shown from stale mipmaps once they're rebuilt"""
+        if self.scale >= 1.0:
+            self._tile_cache.invalidate_area(x, y, w, h)
+            return
+        self.canvas_modified_cb(self.doc, x, y, w, h)
+
     def current_layer_changed_cb(self, rootstack, path):
+        # Solo and preview rendering depend on the current layer
+        if rootstack.current_layer_solo or rootstack.current_layer_previewing:
+            self._tile_cache.clear()
         self.update_cursor()
 
     def layer_props_changed_cb(self, rootstack, path, layer, changed):
+        self._tile_cache.clear()
         self.update_cursor()
 
+    def layer_stack_changed_cb(self, rootstack, *args):
+        """Drops all cached tiles when the layers are restructured"""
+        self._tile_cache.clear()
+
     def draw_cb(self, widget, cr):
         #TODO: (GTK3 migration fallout)
         #  ...should display snapshot instead of normal content, I think
@@ -773,6 +873,15 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
             clip_region = area
             sparse = (cx < rect.x or cx > rect.x+rect.width
                       or cy < rect.y or cy > rect.y+rect.height)
+            # Scrolling exposes L-shaped regions, whose bounding box is
+            # the whole window. Python-cairo can list the parts though.
+            try:
+                rects = cr.copy_clip_rectangle_list()
+            except (AttributeError, cairo.Error):
+                rects = None
+            if rects and len(rects) > 1:
+                clip_region = [tuple(int(v) for v in r) for r in rects]
+                sparse = True
         else:
             clip_region = None
             sparse = False
@@ -795,12 +904,19 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
             corners = [transformation.transform_point(x_, y_) for (x_, y_) in corners]
             bbox = helpers.rotated_rectangle_bbox(corners)
 
-        c_r = gdk.Rectangle()
-        c_r.x, c_r.y, c_r.width, c_r.height = clip_region
+        if isinstance(clip_region, list):
+            clip_rects = clip_region
+        else:
+            clip_rects = [clip_region]
         bb_r = gdk.Rectangle()
         bb_r.x, bb_r.y, bb_r.width, bb_r.height = bbox
-        intersects, isect_r = gdk.rectangle_intersect(bb_r, c_r)
-        return intersects
+        for clip_rect in clip_rects:
+            c_r = gdk.Rectangle()
+            c_r.x, c_r.y, c_r.width, c_r.height = clip_rect
+            intersects, isect_r = gdk.rectangle_intersect(bb_r, c_r)
+            if intersects:
+                return True
+        return False
 
 
     def render_prepare(self, cr, device_bbox):
@@ -879,8 +995,14 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
             if self.tile_is_visible( tx, ty, transformation, clip_region,
                                      sparse, translation_only ):
                 tiles.append((tx, ty))
-        self.doc._layers.render_into(surface, tiles, mipmap_level,
-                                     overlay=self.overlay_layer)
+        playback_cache = self.doc.ani.playback_cache
+        if playback_cache.active and not self.overlay_layer:
+            playback_cache.render_into(surface, tiles, mipmap_level)
+        elif self.overlay_layer:
+            self.doc._layers.render_into(surface, tiles, mipmap_level,
+                                         overlay=self.overlay_layer)
+        else:
+            self._render_cached(surface, tiles, mipmap_level)
 
         gdk.cairo_set_source_pixbuf( cr, surface.pixbuf,
                                      round(surface.x), round(surface.y) )
@@ -897,23 +1019,66 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
             cr.set_source_rgba(0, 0, random.random(), 0.4)
             cr.paint()
 
+    def _render_cached(self, surface, tiles, mipmap_level):
+        """Renders tiles of the layer stack, reusing cached ones"""
+        layers = self.doc._layers
+        cache = self._tile_cache
+        cache.set_dst_has_alpha(not layers.get_render_is_opaque())
+        missing = []
+        for tx, ty in tiles:
+            tile = cache.get(mipmap_level, tx, ty)
+            if tile is None:
+                missing.append((tx, ty))
+                continue
+            with surface.tile_request(tx, ty, readonly=False) as dst:
+                dst[...] = tile
+        if not missing:
+            return
+        layers.render_into(surface, missing, mipmap_level)
+        for tx, ty in missing:
+            with surface.tile_request(tx, ty, readonly=True) as src:
+                cache.put(mipmap_level, tx, ty, src)
+
     def scroll(self, dx, dy):
+        """Pans the view by an amount in display pixels
+
+        Scrolls are coalesced, and applied just before the next redraw by
+        moving the pixels already on screen, so that only the strips which
+        are uncovered need rendering. Those are handled by the sparse
+        rendering path in `render_execute()`.
+        """
+        if self._scroll_start is None:
+            self._scroll_start = self._get_scroll_state()
         self.translation_x -= dx
         self.translation_y -= dy
-        if False:
-            # This speeds things up nicely when scrolling is already
-            # fast, but produces temporary artefacts and an
-            # annoyingly non-constant framerate otherwise.
-            #
-            # It might be worth it if it was done only once per
-            # redraw, instead of once per motion event. Maybe try to
-            # implement something like "queue_scroll" with priority
-            # similar to redraw? (The GTK commit responsible for bug
-            # http://bugzilla.gnome.org/show_bug.cgi?id=702392 might
-            # solve this problem, I think.)
-            self.window.scroll(int(-dx), int(-dy))
-        else:
+        if self._scroll_srcid is None:
+            # Just before GDK's redraw, which is at PRIORITY_HIGH_IDLE+20
+            self._scroll_srcid = gobject.idle_add(
+                self._scroll_idle_cb, priority=gobject.PRIORITY_HIGH_IDLE+15)
+
+    def _get_scroll_state(self):
+        """Everything which must match to reuse pixels, and the origin"""
+        x, y = self.model_to_display(0, 0)
+        return (self.scale, self.rotation, self.mirrored), (x, y)
+
+    def _scroll_idle_cb(self):
+        self._scroll_srcid = None
+        start = self._scroll_start
+        self._scroll_start = None
+        window = self.get_window()
+        if start is None or window is None:
+            return False
+        view, (x0, y0) = start
+        new_view, (x1, y1) = self._get_scroll_state()
+        # The transformation is aligned so that the origin always lands on
+        # a whole pixel: shifting the old pixels is exact.
+        dx = int(round(x1 - x0))
+        dy = int(round(y1 - y0))
+        if new_view != view or self.visualize_rendering:
             self.queue_draw()
+        elif dx or dy:
+            window.scroll(dx, dy)
+        return False
 
 
     def get_center(self):
@@ -930,6 +1095,17 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         return self.display_to_model(*center)
 
 
+    def get_visible_model_bbox(self):
+        """Return the bounding box of the visible area in model coordinates.
+        """
+        alloc = self.get_allocation()
+        corners = [self.display_to_model(x, y)
+                   for x, y in [(0, 0), (alloc.width, 0),
+                                (alloc.width, alloc.height),
+                                (0, alloc.height)]]
+        return helpers.rotated_rectangle_bbox(corners)
+
+
     def recenter_document(self):
         """Recentres the view onto the document's centre.
         """
@@ -7,6 +7,8 @@ from lib.helpers import escape
 from gi.repository import Gtk, GObject
 from gi.repository import Gdk, GdkPixbuf
 
+import sys
+from bisect import bisect_right
 import cairo
 import textwrap
 import logging
@@ -248,7 +250,12 @@ class FrameWidget(Gtk.DrawingArea):
 
         cr.set_font_size(10)
         cr.select_font_face('sans', cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
-        for f, i in enumerate(range(0, wh, fh), 1):
+        # only the exposed rows need numbering
+        cy1, cy2 = cr.clip_extents()[1::2]
+        first = max(0, int((cy1 - m) // fh) - 1)
+        last = min((wh - 1) // fh, int((cy2 - m) // fh) + 1)
+        for f in xrange(first + 1, last + 2):
+            i = (f - 1) * fh
             cr.rectangle(ww-2, i+m, 6, 1)
             dimx = cr.text_extents(str(f))[2]
             if f % fps == 0:
@@ -308,8 +315,8 @@ class TimelineWidget(Gtk.DrawingArea):
         self.connect('query-tooltip', self.tooltip)
         self.timeline.connect('update', self.update)
         
-        self.key_box_list = []
-        self.close_box_list = []
+        self._grid_key = None
+        self._grid_pattern = None
         self.move_frame = False
         self.drag_scroll = False
         self.h = [0, 0]
@@ -319,24 +326,18 @@ class TimelineWidget(Gtk.DrawingArea):
         self.queue_draw()
     
     def tooltip(self, item, x, y, keyboard_mode, tooltip):
-        l_idx = self.timeline.convert_layer(x)
-        if not 0 <= l_idx < len(self.timeline.data): return False
+        l_idx = self.layer_at(x)
+        if l_idx is None: return False
         idx = int((y - self.timeline.margin_top) / self.timeline.frame_height)
-        if idx not in self.timeline.data[l_idx]: return False
-        if idx in self.close_box_list:
-            c = self.close_box_list[l_idx][idx]
-        else:
-            c = (0,0,0,0)
-        if idx in self.key_box_list:
-            k = self.key_box_list[l_idx][idx]
-        else:
-            k = (0,0,0,0)
-        if c[0] < x < c[0]+c[2] and c[1] < y < c[1]+c[3]:
+        hit = self.button_at(x, y)
+        if hit and hit[0] == 'close':
             text = _("Remove Frame")
-        elif k[0] < x < k[0]+k[2] and k[1] < y < k[1]+k[3]:
+        elif hit and hit[0] == 'key':
             text = _("Toggle Keyframe")
-        else:
+        elif idx in self.timeline.data[l_idx]:
             text = self.timeline.data[l_idx][idx].description
+        else:
+            return False
         if text != '':
             tooltip.set_text(text)
             return True
@@ -350,20 +351,113 @@ class TimelineWidget(Gtk.DrawingArea):
         if ww != w or wh != h:
             self.set_size_request(w, h)
             self.emit('size_changed', w, h)
-    
-    def draw_button(self, cr, x, y, l, f, type='close', sz=12):
+
+    ## Layout and hit-testing
+
+    def get_columns(self):
+        """Column intervals, as a list of (x, width) sorted by x
+
+        Layer n's column is item n. The active layer's column is wider.
+        """
+        fw, fwa = self.timeline.frame_width, self.timeline.frame_width_active
+        active = self.timeline.data.layer_idx
+        columns = []
+        for nl in xrange(len(self.timeline.data)):
+            if nl > active:
+                columns.append(((nl - 1) * fw + fwa + 1, fw))
+            elif nl == active:
+                columns.append((nl * fw + 1, fwa))
+            else:
+                columns.append((nl * fw + 1, fw))
+        return columns
+
+    def layer_at(self, x):
+        """Index of the layer whose column contains x, or None"""
+        columns = self.get_columns()
+        nl = bisect_right(columns, (x, sys.maxint)) - 1
+        if nl < 0 or x >= columns[nl][0] + columns[nl][1]:
+            return None
+        return nl
+
+    def get_buttons(self, nl, nf, column):
+        """The buttons drawn for a cel, as a list of (type, x, y, size)"""
+        x, w = column
+        y = nf * self.timeline.frame_height + self.timeline.margin_top
+        if nl == self.timeline.data.layer_idx:
+            if self.timeline.frame_height > 8 or self.timeline.data.idx == nf:
+                return [('key', x+w-26, y-1, 12), ('close', x+w-12, y-1, 12)]
+        elif self.timeline.frame_height > 8:
+            return [('close', x+w-12, y-1, 12)]
+        return []
+
+    def button_at(self, x, y):
+        """Find the cel button under a point
+
+        :returns: (type, layer index, frame index), or None
+
+        Buttons poke out by a pixel above their row, so the row below is
+        checked too.
+        """
+        nl = self.layer_at(x)
+        if nl is None:
+            return None
+        column = self.get_columns()[nl]
+        layer = self.timeline.data[nl]
+        nf = int((y - self.timeline.margin_top) // self.timeline.frame_height)
+        for f in (nf, nf + 1):
+            if f not in layer:
+                continue
+            for type, bx, by, sz in self.get_buttons(nl, f, column):
+                if bx < x < bx+sz and by < y < by+sz:
+                    return (type, nl, f)
+        return None
+
+    ## Drawing
+
+    def draw_button(self, cr, x, y, type='close', sz=12):
         cr.rectangle(x, y, sz, sz)
         cr.set_source_rgb(0, 0, 0)
         cr.fill()
         cr.rectangle(x+1, y+1, sz-2, sz-2)
         if type == 'key':
             cr.set_source_rgb(.9, .9, .14)
-            self.key_box_list[l][f] = (x, y, sz, sz)
         else:
             cr.set_source_rgb(1, .67, .67)
-            self.close_box_list[l][f] = (x, y, sz, sz)
         cr.fill()
-        
+
+    def get_grid_pattern(self):
+        """Repeating pattern of the lines marking one second of rows
+
+        The pattern is cached until the frame rate, row height, or
+        divisions change.
+        """
+        fps = self.timeline.data.fps
+        fh = self.timeline.frame_height
+        div_li = self.timeline.get_divisions()[1:]
+        key = (fps, fh, tuple(div_li))
+        if self._grid_key == key:
+            return self._grid_pattern
+        surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, fps*fh)
+        cr = cairo.Context(surf)
+        cr.set_source_rgb(.74, .74, .74)
+        for j in range(1, fps):
+            cr.rectangle(0, j*fh, 1, 1)
+        cr.fill()
+        for li in reversed(div_li):
+            col=.75 - (0.5/li)
+            cr.set_source_rgb(col, col, col)
+            for j in range(1, li):
+                cr.rectangle(0, j*fps/li*fh, 1, 1)
+            cr.fill()
+        cr.set_source_rgb(.2, .2, .2)
+        cr.rectangle(0, 0, 1, 2)
+        cr.fill()
+        pattern = cairo.SurfacePattern(surf)
+        pattern.set_extend(cairo.EXTEND_REPEAT)
+        self._grid_key = key
+        self._grid_pattern = pattern
+        return pattern
+
     def do_draw(self, cr):
         # widget size
         ww, wh = self.get_allocation().width, self.get_allocation().height
@@ -371,60 +465,47 @@ class TimelineWidget(Gtk.DrawingArea):
         fw, fwa, fh = self.timeline.frame_width, self.timeline.frame_width_active, \
                       self.timeline.frame_height
         m = self.timeline.margin_top
+        # only the exposed rows and columns need drawing
+        cx1, cy1, cx2, cy2 = cr.clip_extents()
+        first = max(0, int((cy1 - m) // fh) - 1)
+        last = int((cy2 - m) // fh) + 1
         cr.set_source_rgba(0, 0, 0, 0.1)
         cr.paint()
         # current frame
         cr.set_source_rgb(0.85, 0.85, 0.85)
         cr.rectangle(0, self.timeline.data.idx*fh+m, ww, fh+1)
         cr.fill()
-        # draw layers
-        self.key_box_list = []
-        self.close_box_list = []
 
         #lines marking seconds
         fps = self.timeline.data.fps
-        div_li = self.timeline.get_divisions()[1:]
-
-        for i in range(0, max(self.ani.timeline.get_length(), 
-                       self.ani.timeline.idx, wh//fh) + fps, fps):
-            y = i*fh+m
-            cr.set_source_rgb(.74, .74, .74)
-            for j in range(1, fps):
-                cr.rectangle(0, y + j*fh, ww, 1)
-            cr.fill()
-            for li in reversed(div_li):
-                col=.75 - (0.5/li)
-                cr.set_source_rgb(col, col, col)
-                for j in range(1, li):
-                    cr.rectangle(0, y + j*fps/li*fh, ww, 1)
-                cr.fill()
-            cr.set_source_rgb(.2, .2, .2)
-            cr.rectangle(0, y, ww, 2)
-            cr.fill()
+        rows = max(self.ani.timeline.get_length(), 
+                   self.ani.timeline.idx, wh//fh) + fps
+        rows = (rows + fps - 1) // fps * fps
+        cr.save()
+        pattern = self.get_grid_pattern()
+        pattern.set_matrix(cairo.Matrix(y0=-m))
+        cr.set_source(pattern)
+        cr.rectangle(0, m, ww, rows*fh)
+        cr.fill()
+        cr.restore()
 
+        cr.set_font_size(10)
+        cr.select_font_face('sans', cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+        th, tw = 10, 7
 
-        for nl, l in enumerate(self.timeline.data):
-            self.close_box_list.append({})
-            self.key_box_list.append({})
-            if nl > self.timeline.data.layer_idx:
-                x = (nl - 1) * fw + fwa + 1
-            else:
-                x = nl * fw + 1
-            lenn = self.ani.timeline.get_length()-1
+        # draw layers
+        for nl, column in enumerate(self.get_columns()):
+            x, w = column
+            if x + w < cx1 or x > cx2:
+                continue
+            l = self.timeline.data[nl]
 
             # between layer
-            if nl == self.timeline.data.layer_idx:
-                cr.rectangle(x+fwa-1, 0, 1, wh)
-            else:
-                cr.rectangle(x+fw-1, 0, 1, wh)
+            cr.rectangle(x+w-1, cy1, 1, cy2-cy1)
             cr.set_source_rgb(.2, .2, .2)
             cr.fill();
 
-            cr.set_font_size(10)
-            cr.select_font_face('sans', cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
-            th, tw = 10, 7
-
-            for nf in l:
+            for nf in l.iter_range(first - 1, 1, last):
                 y = nf*fh+m
                 if nl == self.timeline.data.layer_idx:
                     if nf == self.timeline.data.idx:
@@ -455,9 +536,6 @@ class TimelineWidget(Gtk.DrawingArea):
                         else:
                             cr.move_to(x + 1, y + th + nt*th)
                             cr.show_text(t)
-                    if fh > 8 or self.timeline.data.idx == nf:
-                        self.draw_button(cr, x+fwa-26, y-1, nl, nf, 'key')
-                        self.draw_button(cr, x+fwa-12, y-1, nl, nf)
                     cr.fill();
                 else:
                     if nf == self.timeline.data.idx:
@@ -477,8 +555,8 @@ class TimelineWidget(Gtk.DrawingArea):
                     cr.rectangle(x, y+fh, fw, 1)
                     cr.set_source_rgb(0, 0, 0)
                     cr.fill()
-                    if fh > 8:
-                        self.draw_button(cr, x+fw-12, y-1, nl, nf)
+                for type, bx, by, sz in self.get_buttons(nl, nf, column):
+                    self.draw_button(cr, bx, by, type, sz)
         # before layer
         cr.rectangle(0, 0, 1, wh)
         cr.set_source_rgb(0, 0, 0)
@@ -488,28 +566,18 @@ class TimelineWidget(Gtk.DrawingArea):
         cr.rectangle(0, 0, ww, 1)
         cr.fill();
     
-    def get_in_list(self, l, f, x, y):
-        try:
-            c = self.close_box_list[l][f]
-            if c[0] < x < c[0]+c[2] and c[1] < y < c[1]+c[3]:
-                self.ani.remove_frame(l, f)
-                return True
-        except:
-            return False
-        try:
-            k = self.key_box_list[l][f]
-            if k[0] < x < k[0]+k[2] and k[1] < y < k[1]+k[3]:
-                self.ani.toggle_key(l, f)
-                return True
-        except:
-            return False
-
     def clic(self, widget, event):
         self.move_frame = False
         if event.button == Gdk.BUTTON_PRIMARY:
             frame = (int(event.y)-1-self.timeline.margin_top)//self.timeline.frame_height
             layer = self.timeline.convert_layer(event.x)
-            if self.get_in_list(layer, frame, event.x, event.y):
+            hit = self.button_at(event.x, event.y)
+            if hit:
+                type, l, f = hit
+                if type == 'close':
+                    self.ani.remove_frame(l, f)
+                else:
+                    self.ani.toggle_key(l, f)
                 return True
             if event.type == Gdk.EventType._2BUTTON_PRESS:
                 if not 0 <= layer < len(self.timeline.data):
@@ -938,6 +1006,8 @@ class TimelineTool(Gtk.VBox):
         #@TODO: allow stopping while paused
         self.ani.player_next(use_lightbox)
         keep_playing = True
+        if self.ani.player_state in ("stop", "pause"):
+            self.ani.finish_playback()
         if self.ani.player_state == "stop":
             self.ani.select_without_undo(self.beforeplay_frame)
             keep_playing = False
@@ -959,6 +1029,8 @@ class TimelineTool(Gtk.VBox):
         if from_first_frame:
             self.ani.timeline.select(self.ani.timeline.get_first())
         self._change_player_buttons()
+        cache_mb = self.app.preferences.get("xsheet.playback_cache_mb", 512)
+        self.ani.playback_cache.set_budget(cache_mb * 1024 * 1024)
         self.ani.hide_all_frames()
         # animation timer
         ms_per_frame = int(round(1000.0/self.ani.timeline.fps))
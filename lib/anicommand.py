@@ -429,26 +429,27 @@ class MergeAnimatedLayers(Command):
             self.idx = self.timeline.index(following)
         self.timeline.insert(self.idx, merged)
 
-        for layer in self.unmerged_layers:
-            for i in layer:
-                if layer[i].cel:
-                    rootstack.deeppop(rootstack.deepindex(layer[i].cel))
-        for i in merged:
-            if merged[i].cel:
-                rootstack.deepinsert((0,), merged[i].cel)
-
-        self.prev_idx = self.timeline.layer_idx
-        self.timeline.layer_idx = self.idx
-        cel = self.timeline.cel
-        if cel is not None:
-            # Select the corresponding layer:
-            layer_path = rootstack.deepindex(cel)
-            rootstack.set_current_path(layer_path)
-        else:
-            rootstack.set_current_path((0,))
+        with self.doc.batch_updates():
+            for layer in self.unmerged_layers:
+                for i in layer:
+                    if layer[i].cel:
+                        rootstack.deeppop(rootstack.deepindex(layer[i].cel))
+            for i in merged:
+                if merged[i].cel:
+                    rootstack.deepinsert((0,), merged[i].cel)
+
+            self.prev_idx = self.timeline.layer_idx
+            self.timeline.layer_idx = self.idx
+            cel = self.timeline.cel
+            if cel is not None:
+                # Select the corresponding layer:
+                layer_path = rootstack.deepindex(cel)
+                rootstack.set_current_path(layer_path)
+            else:
+                rootstack.set_current_path((0,))
 
-        self.doc.ani.sort_layers()
-        self.doc.ani.update_opacities()
+            self.doc.ani.sort_layers()
+            self.doc.ani.update_opacities()
         self._notify_document_observers()
 
     def undo(self):
@@ -7,19 +7,32 @@
 # (at your option) any later version.
 
 import os
-import glob
+import sys
+import shutil
+import subprocess
+import threading
+import functools
+import multiprocessing
+import Queue
 from gettext import gettext as _
 import layer
 import json
-import tempfile
-from subprocess import call
+from collections import OrderedDict, deque
+from bisect import bisect_left
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy
 
 import pixbufsurface
 import tiledsurface
+import mypaintlib
+import idletask
 
 import anicommand
-from timeline import TimeLine
+from timeline import TimeLine, Lightbox
 from xdna import XDNA
+import xdna
 from mypaintlib import combine_mode_get_info
 
 
@@ -36,12 +49,15 @@ class Animation(object):
     def __init__(self, doc):
         self.doc = doc
         self.timeline = None
+        self.lightbox = None
         self.cleared = False
         self.using_legacy = False
         self.xdna = XDNA()
 
         # For reproduction, "play", "pause", "stop":
         self.player_state = None
+        self.playback_cache = PlaybackCache(self)
+        self.merge_cache = MergeCache(self)
 
         # For cut/copy/paste operations:
         self.edit_operation = None
@@ -50,6 +66,7 @@ class Animation(object):
     def clear_xsheet(self, init=False):
         self.timeline = TimeLine(self.opacities)
         self.timeline.append_layer()
+        self.merge_cache.clear()
         self.cleared = True
     
     def legacy_xsheet_as_str(self):
@@ -151,6 +168,111 @@ class Animation(object):
         str_data = json.dumps(data, sort_keys=True, indent=4)
         return str_data
 
+    def xsheet_as_binary(self):
+        """
+        Return animation X-Sheet as data in the binary XDNA format.
+
+        Each cel is stored once, in a table of layer paths, and frames
+        refer to it by its index in the table.
+
+        """
+        x = self.xdna
+        layer_stack = self.doc.layer_stack
+        cel_ids = {}  # id(cel) -> index in cels
+        cels = []
+        frame_lists = []
+
+        self.timeline.cleanup()
+        for lyr in self.timeline:
+            compop = combine_mode_get_info(lyr.composite).get("name", '')
+            frames = list(lyr)
+            flags = []
+            cel_column = []
+            descriptions = []
+            for nf in frames:
+                f = lyr[nf]
+                flag = 0
+                if f.is_key:
+                    flag |= xdna.FRAME_KEY
+                if f.skip_visible:
+                    flag |= xdna.FRAME_SKIP_VISIBLE
+                if f.description:
+                    flag |= xdna.FRAME_DESCRIBED
+                flags.append(flag)
+                descriptions.append(f.description)
+                cel_id = None
+                if f.cel is not None:
+                    cel_id = cel_ids.get(id(f.cel))
+                    if cel_id is None:
+                        path = layer_stack.deepindex(f.cel)
+                        if path is not None:
+                            cel_id = cel_ids[id(f.cel)] = len(cels)
+                            cels.append(path)
+                cel_column.append(cel_id)
+            frame_lists.append({
+                'name': lyr.name,
+                'visible': lyr.visible,
+                'opacity': lyr.opacity,
+                'locked': lyr.locked,
+                'composite': compop,
+                'frames': frames,
+                'flags': flags,
+                'cels': cel_column,
+                'descriptions': descriptions,
+            })
+
+        return x.binary_serialize({
+            'metadata': x.application_signature,
+            'framerate': self.timeline.fps,
+            'cels': cels,
+            'raster_frame_lists': frame_lists,
+        })
+
+    def _binary_to_xsheet(self, ani_data):
+        """
+        Update TimeLine from binary XDNA data.
+
+        Cels are looked up in the layers tree the first time a frame
+        refers to them, and reused for later frames.
+
+        """
+        data = self.xdna.binary_deserialize(ani_data)
+        layer_stack = self.doc.layer_stack
+        cel_paths = data['cels']
+        cels = [None] * len(cel_paths)
+
+        def resolve(cel_id):
+            cel = cels[cel_id]
+            if cel is None:
+                cel = layer_stack.deepget(cel_paths[cel_id])
+                if cel is None:
+                    cel = layer.PaintingLayer()
+                    layer_stack.append(cel)
+                cels[cel_id] = cel
+            return cel
+
+        self.timeline = TimeLine(self.opacities)
+        self.timeline.fps = int(data['framerate'])
+        self.cleared = True
+        for j, fl in enumerate(data['raster_frame_lists']):
+            self.timeline.append_layer()
+            lyr = self.timeline[j]
+            lyr.name = fl['name']
+            lyr.visible = fl['visible']
+            lyr.opacity = fl['opacity']
+            lyr.locked = fl['locked']
+            lyr.composite = tiledsurface.OPENRASTER_COMBINE_MODES.get(
+                str(fl['composite']), tiledsurface.DEFAULT_COMBINE_MODE)
+            columns = zip(fl['frames'], fl['flags'], fl['cels'],
+                          fl['descriptions'])
+            for nf, flag, cel_id, description in columns:
+                f = lyr[nf]
+                f.is_key = bool(flag & xdna.FRAME_KEY)
+                f.skip_visible = bool(flag & xdna.FRAME_SKIP_VISIBLE)
+                f.description = description
+                if cel_id is not None:
+                    f.cel = resolve(cel_id)
+
     def _write_xsheet(self, xsheetfile):
         """
         Save FrameList to file.
@@ -162,8 +284,13 @@ class Animation(object):
     def str_to_xsheet(self, ani_data):
         """
         Update TimeLine from animation data.
+
+        The data can be in any of the JSON formats, or binary XDNA.
     
         """
+        if self.xdna.is_binary(ani_data):
+            self._binary_to_xsheet(ani_data)
+            return
         data = json.loads(ani_data)
         # first check if it's in the legacy non-descriptive JSON or new XDNA format
         if type(data) is dict and data['XDNA']:
@@ -269,105 +396,209 @@ class Animation(object):
         else:
             self._read_xsheet(xsheetfile)
     
-    def save_png(self, filename, **kwargs):
+    def _export_bbox(self):
+        x, y, w, h = self.doc.get_effective_bbox()
+        if w == 0 or h == 0:
+            # workaround to save empty documents
+            x, y, w, h = 0, 0, 1, 1
+        return x, y, w, h
+
+    def _plan_frame(self, cels, bbox, background=None):
+        """Plan the rendering of the merge of some cels
+
+        :param cels: cels to merge, as returned by `TimeLine.cels_at()`
+        :param tuple bbox: x, y, w, h of the region to render
+        :param tuple background: RGB tuple to flatten onto, or None
+        :returns: a job for `_FrameRenderer`, whose pixels are an RGBA
+          array, or a contiguous RGB array if flattened
+        :rtype: _FrameJob
+
+        This looks up the cels' tiles and any merged tiles already
+        cached, so it must be called on the thread which owns the
+        document. The merging and conversion are left to the job.
+        """
+        x, y, w, h = bbox
+        N = tiledsurface.N
+        tx0, ty0 = x // N, y // N
+        tx1, ty1 = (x + w - 1) // N, (y + h - 1) // N
+        job = _FrameJob(((ty1-ty0+1)*N, (tx1-tx0+1)*N),
+                        (y-ty0*N, x-tx0*N, h, w), background)
+        cache = self.merge_cache
+        sources = cache.get_sources(cels)
+        if sources is None:
+            surf = self._merge_normalized(cels)._surface
+            tiles = ((tx, ty, tile.rgba, None, None)
+                     for (tx, ty), tile in surf.tiledict.items())
+        else:
+            tiles = ((tx, ty) + cache.get_tile_plan(sources, tx, ty)
+                     for tx, ty in cache.get_tile_coords(sources))
+        for tx, ty, rgba, key, plan in tiles:
+            if tx0 <= tx <= tx1 and ty0 <= ty <= ty1:
+                job.tiles.append(((ty-ty0)*N, (tx-tx0)*N, rgba, key, plan))
+        return job
+
+    def _iter_frames(self, bbox, background=None, feedback_cb=None):
+        """Render every frame of the timeline, in order
+
+        :returns: iterator of ``(idx, pixels, repeat)`` tuples
+
+        Held frames, i.e. consecutive frames which resolve to the same
+        cels, are only rendered once: the repeat yields the previous
+        array again with `repeat` set. The other frames are planned
+        here, a few frames ahead of the one being yielded, and rendered
+        on a pool of worker threads.
+        """
+        self.doc.finish_loading()
+        renderer = _FrameRenderer()
+        pending = deque()  # (idx, job, repeat)
+        rendering = 0  # distinct jobs in pending
+        prev_cels = None
+        job = None
+        first = self.timeline.get_first()
+        last = self.timeline.get_last()
+        try:
+            for i in xrange(first, last+1):
+                cels = tuple(self.timeline.cels_at(i))
+                repeat = (cels == prev_cels)
+                if not repeat:
+                    job = self._plan_frame(cels, bbox, background)
+                    renderer.submit(job)
+                    rendering += 1
+                    prev_cels = cels
+                pending.append((i, job, repeat))
+                while rendering > renderer.lookahead:
+                    if not pending[0][2]:
+                        rendering -= 1
+                    yield self._finish_frame(pending.popleft(), feedback_cb)
+            while pending:
+                yield self._finish_frame(pending.popleft(), feedback_cb)
+        finally:
+            renderer.close()
+
+    def _finish_frame(self, item, feedback_cb=None):
+        """Wait for a frame's job, and cache the tiles it merged"""
+        idx, job, repeat = item
+        pixels = job.wait()
+        for key, rgba in job.merged:
+            self.merge_cache.add_tile(key, rgba)
+        job.merged = []
+        if feedback_cb:
+            feedback_cb()
+        return idx, pixels, repeat
+
+    def save_png(self, filename, feedback_cb=None, write_legacy_png=True):
+        """Save each frame of the animation as a numbered PNG file
+
+        :param callable feedback_cb: called after each frame is rendered
+        :param bool write_legacy_png: passed to the PNG writer, as for
+          `lib.pixbufsurface.save_as_png()`
+
+        Held frames are written by copying the previous frame's file.
+        """
         prefix, ext = os.path.splitext(filename)
         # if we have a number already, strip it
         l = prefix.rsplit('-', 1)
         if l[-1].isdigit():
             prefix = l[0]
-        doc_bbox = self.doc.get_effective_bbox()
+        bbox = self._export_bbox()
+        prev_filename = None
+        for idx, pixels, repeat in self._iter_frames(bbox,
+                                                     feedback_cb=feedback_cb):
+            filename = '%s-%03d%s' % (prefix, idx+1, ext)
+            if repeat:
+                shutil.copyfile(prev_filename, filename)
+            else:
+                _save_png_pixels(filename, pixels, write_legacy_png)
+            prev_filename = filename
+        self.merge_cache.log_usage()
+
+    def _encode_frames(self, argv, bbox, feedback_cb=None):
+        """Stream flattened RGB frames to the stdin of an encoder command
+
+        :param list argv: command to run; it must read raw frames from
+          its standard input.
 
-        for i in range(self.timeline.get_first(), self.timeline.get_last()+1):
-            frame = self.merge(self.timeline.cels_at(i))
-            filename = '%s-%03d%s' % (prefix, i+1, ext)
-            frame._surface.save_as_png(filename, *doc_bbox, **kwargs)
+        The encoder runs in parallel with rendering, and raw frames are
+        fed to it from a background thread.
+        """
+        logger.info("Encoding frames with %r", argv[0])
+        try:
+            proc = subprocess.Popen(argv, stdin=subprocess.PIPE)
+        except OSError, e:
+            raise IOError(e.errno, "%s: %s" % (argv[0], e.strerror))
+
+        def _write(idx, pixels, repeat):
+            proc.stdin.write(buffer(pixels))
+
+        writer = _FrameWriter(_write)
+        try:
+            frames = self._iter_frames(bbox, background=(255, 255, 255),
+                                       feedback_cb=feedback_cb)
+            for frame in frames:
+                writer.put(*frame)
+        finally:
+            try:
+                writer.close()
+            finally:
+                proc.stdin.close()
+                status = proc.wait()
+        self.merge_cache.log_usage()
+        if status != 0:
+            raise IOError(0, "%s exited with status %d" % (argv[0], status))
 
     def save_gif(self, filename, gif_fps=24, gif_loop=0, **kwargs):
         # Requires command tool imagemagick.
-        tempdir = tempfile.mkdtemp()
-        gifs_tempdir = os.path.join(tempdir, 'gifs')
-        os.mkdir(gifs_tempdir)
         base_filename = os.path.basename(filename)
         prefix, ext = os.path.splitext(base_filename)
         out_filename = os.path.join(os.path.dirname(filename), prefix + '.gif')
-
-        pngs_filename = os.path.join(tempdir, 'tempani.png')
-        self.save_png(pngs_filename)
-
-        # convert pngs to jpegs with imagemagick command:
-        pngs_list = glob.glob(tempdir + os.path.sep + '*png')
-        pngs_list.sort()
-        for png_file in pngs_list:
-            f_basename = os.path.basename(png_file)
-            name, ext = os.path.splitext(f_basename)
-            gif_file = os.path.join(gifs_tempdir, name + '.gif')
-            print "converting %s to %s..." % (png_file, gif_file)
-            call(["convert",
-                  "-background", "white",
-                  "-flatten",
-                  png_file, gif_file])
-
-        # convert the previous gifs to animated gif with imagemagick command:
-        gifs = gifs_tempdir + os.path.sep + 'tempani-*.gif'
-	gif_filename = os.path.join(tempdir, 'temp.gif')
-        call(["convert",
-              "-delay", "1x" + str(gif_fps),
-              "-loop", str(gif_loop),
-              gifs, gif_filename])
-
-        # optimize gif size:
-        call(["convert",
-              "-layers", "Optimize",
-              gif_filename, out_filename])
+        bbox = self._export_bbox()
+        # ImageMagick reads consecutive raw images from the one stream
+        argv = ["convert",
+                "-delay", "1x" + str(gif_fps),
+                "-loop", str(gif_loop),
+                "-size", "%dx%d" % bbox[2:],
+                "-depth", "8",
+                "rgb:-",
+                "-layers", "Optimize",
+                out_filename]
+        self._encode_frames(argv, bbox, kwargs.get('feedback_cb'))
 
     def save_avi(self, filename, vid_width=800, vid_fps=24, **kwargs):
         """
         Save video file with codec mpeg4.
 
-        Requires command tools imagemagick and ffmpeg .
+        Requires command tool ffmpeg.
 
         """
-        tempdir = tempfile.mkdtemp()
-        jpgs_tempdir = os.path.join(tempdir, 'jpgs')
-        os.mkdir(jpgs_tempdir)
         base_filename = os.path.basename(filename)
         prefix, ext = os.path.splitext(base_filename)
         out_filename = os.path.join(os.path.dirname(filename), prefix + '.avi')
-
-        pngs_filename = os.path.join(tempdir, 'tempani.png')
-        self.save_png(pngs_filename)
-
-        # convert pngs to jpegs with imagemagick command:
-        pngs_list = glob.glob(tempdir + os.path.sep + '*png')
-        pngs_list.sort()
-        for png_file in pngs_list:
-            f_basename = os.path.basename(png_file)
-            name, ext = os.path.splitext(f_basename)
-            jpg_file = os.path.join(jpgs_tempdir, name + '.jpg')
-            print "converting %s to %s..." % (png_file, jpg_file)
-            call(["convert",
-                  "-resize", str(vid_width),
-                  "-quality", "100",
-                  "-background", "white",
-                  "-flatten",
-                  png_file, jpg_file])
-
-        # convert the previous jpgs to video with ffmpeg command:
-        jpgs = jpgs_tempdir + os.path.sep + 'tempani-%03d.jpg'
-        call(["ffmpeg",
-              "-r", str(vid_fps),
-              "-b", "1800",
-              "-y", "-i",
-              jpgs, out_filename])
+        bbox = self._export_bbox()
+        argv = ["ffmpeg",
+                "-f", "rawvideo",
+                "-pix_fmt", "rgb24",
+                "-s", "%dx%d" % bbox[2:],
+                "-r", str(vid_fps),
+                "-i", "-",
+                "-vf", "scale=%d:-2" % vid_width,
+                "-vcodec", "mpeg4",
+                "-b:v", "1800k",
+                "-y", out_filename]
+        self._encode_frames(argv, bbox, kwargs.get('feedback_cb'))
 
     def hide_all_frames(self):
         for cel in self.timeline.get_all_cels():
             cel.visible = False
+            cel.opacity = 1
+        if self.lightbox is not None:
+            self.lightbox.invalidate()
 
     def change_visible_frame(self, prev_idx, cur_idx):
         prev_cels = self.timeline.cels_at(prev_idx)
         cur_cels = self.timeline.cels_at(cur_idx)
         if prev_cels == cur_cels: return
+        if self.lightbox is not None:
+            self.lightbox.invalidate()
         for cel in prev_cels:
             if cel in cur_cels:
                 continue
@@ -381,17 +612,20 @@ class Animation(object):
                 cel.visible = True
 
     def update_opacities(self):
-        opacities, visible = self.timeline.get_opacities()
+        """
+        Apply the lightbox opacities, touching only the cels whose
+        opacity or visibility changed since the last update.
 
-        for cel, opa in opacities.items():
-            if cel is None:
-                continue
-            cel.opacity = opa
+        """
+        if self.lightbox is None or self.lightbox.timeline is not self.timeline:
+            self.lightbox = Lightbox(self.timeline)
 
-        for cel, vis in visible.items():
-            if cel is None:
-                continue
-            cel.visible = vis
+        with self.doc.batch_updates():
+            for cel, (opa, vis) in self.lightbox.update().items():
+                if cel is None:
+                    continue
+                cel.opacity = opa
+                cel.visible = vis
 
     def number_to_letter(self, idx):
         letter = ""
@@ -435,18 +669,38 @@ class Animation(object):
         self.player_state = "stop"
 
     def player_next(self, use_lightbox=False):
-        #@TODO: should maybe remove cels from stack before doing this
-        # it causes a lot of unnecessary updates otherwise
         prev_idx = self.timeline.idx
         if self.timeline.has_next():
             self.timeline.goto_next()
         else:
             self.timeline.select(self.timeline.get_first())
         if use_lightbox:
+            self.playback_cache.active = False
             self.update_opacities()
+        elif self.playback_cache.budget > 0:
+            # The cels' flags are left alone, the canvas shows the
+            # pre-rendered frames from the playback cache instead.
+            self.playback_cache.active = True
+            self.doc.invalidate_all()
         else:
             self.change_visible_frame(prev_idx, self.timeline.idx)
 
+    def finish_playback(self):
+        """
+        Leave cached playback, showing the current frame's cels on the
+        layer stack again.
+
+        """
+        if not self.playback_cache.active:
+            return
+        self.playback_cache.active = False
+        for cel in self.timeline.cels_at(self.timeline.idx):
+            cel.opacity = 1
+            cel.visible = True
+        if self.lightbox is not None:
+            self.lightbox.invalidate()
+        self.doc.invalidate_all()
+
     def toggle_key(self, lidx=None, idx=None):
         if lidx is None:
             lidx = self.timeline.layer_idx
@@ -522,6 +776,7 @@ class Animation(object):
 
     def select(self, idx):
         if self.timeline.idx != idx:
+            self.doc.prioritize_loading(layers=self.timeline.cels_at(idx))
             self.doc.do(anicommand.SelectFrame(self.doc, idx))
             self.sort_layers()
 
@@ -566,22 +821,28 @@ class Animation(object):
         self.doc.call_doc_observers()
 
     def sort_layers(self):
+        """Restacks the layer tree to match the x-sheet
+
+        The cels of each animated layer go in a group of their own, in
+        the order of `TimeLine.get_effective_paths()`, and any other
+        layers go in a "Sketches" group on top. The moves needed are
+        planned against the current tree by `_plan_restack()`, and made
+        in one batch, with the resulting notifications merged.
+        """
         #@TODO: remove unneeded stacks
         #@TODO: make another method to pull the active cels to separate group
         layers = self.doc.layer_stack
-        #new_order = self.timeline.get_order(layers)
         new_order = self.timeline.get_effective_paths()
-        
+
+        frames = set(id(y[2]) for y in new_order)
         def get_layer_list():
             items = list(layers)
-            frames = [y[2] for y in new_order]
             while len(items) > 0:
                 item = items.pop(0)
-                try:
+                if isinstance(item, layer.LayerStack):
                     items.extend(list(item))
-                except TypeError:
-                    if item not in frames:
-                        yield item
+                elif id(item) not in frames:
+                    yield item
 
         extra = [x for x in get_layer_list()]
         extra_order = []
@@ -595,75 +856,34 @@ class Animation(object):
                 new_order.append((path, nl, l))
 
         selection = self.doc.layer_stack.current
-        changed = True
-        while changed:
-            changed = False
-            for pl, nl, src in new_order + extra_order:
-                src_path = layers.deepindex(src)
-                tar_path = pl
-                if src_path != tar_path:
-                    changed = True
-                    affected = []
-                    tar_parent = layers.deepget(tar_path[:-1])
-                    parent_exists = isinstance(tar_parent, layer.LayerStack)
-                    #make placeholder
-                    if src_path != None:
-                        placeholder = layer.PlaceholderLayer(name="moving")
-                        src_parent = layers.deepget(src_path[:-1])
-                        src_index = src_path[-1]
-                        src_parent[src_index] = placeholder
-                        affected.append(src)
-                    else:
-                        placeholder = None
-
-                    tar_parent = layers.deepget(tar_path[:-1])
-                    #do the move
-                    if parent_exists:
-                        tar_index = tar_path[-1]
-                        tar_parent.insert(tar_index, src)
-                    elif tar_parent is None:
-                        #make parent if it doesnt exist
-                        parent = layer.LayerStack()
-                        tar_gparent = layers.deepget(tar_path[:-2])
-                        tar_gparent.append(parent)
-                        parent.append(src)
-                    else:
-                        #another layer is where the parent should be, move it
-                        tar_parent_index = tar_path[-2]
-                        tar_gparent = layers.deepget(tar_path[:-2])
-                        parent = layer.LayerStack()
-                        tar_gparent[tar_parent_index] = parent
-                        parent.append(src)
-                        parent.append(tar_parent)
-                        affected.append(tar_parent)
-                    
-                    # Remove placeholder
-                    if placeholder:
-                        layers.deepremove(placeholder)
-
-        # Rename layers as necessary
-        par_name = lambda i, n: n and str(n) or _("Layer ") + str(i+1)
-        for pl, [a, f], l in new_order:
-            #rename this layer if need be
-            placeholder = layer.PlaceholderLayer(name="moving")
-            parent = layers.deepget(pl[:-1])
-            index = pl[-1]
-            cel = parent.pop(index)
-            new_name = self.generate_layername(f, self.timeline[a][f].description)
-            cel.name = new_name		#@TODO: redo paintinglayer naming
-            parent.insert(index, cel)
-
-            #rename parent if need be
-            if self.timeline[a].stack != pl[:-1]:
-                parent.name = par_name(a, self.timeline[a].name)
-                self.timeline[a].stack = pl[:-1]
-        if len(extra) > 0:
-            layers.deepget((0,)).name = _("Sketches")
-
-        # Issue redraws
-        layers.set_current_path(layers.canonpath(path=layers.deepindex(selection)))
-        #redraw_bboxes = [a.get_full_redraw_bbox() for a in affected]
-        #self._notify_canvas_observers(redraw_bboxes)
+        groups = []
+        for pl, nl, cel in extra_order + new_order:
+            while len(groups) <= pl[0]:
+                groups.append([])
+            groups[pl[0]].append(cel)
+        with self.doc.batch_updates():
+            moves = _plan_restack(layers, groups)
+            if moves:
+                layers.restack(moves)
+
+            # Rename layers as necessary
+            par_name = lambda i, n: n and str(n) or _("Layer ") + str(i+1)
+            for pl, [a, f], cel in new_order:
+                new_name = self.generate_layername(f, self.timeline[a][f].description)
+                if cel.name != new_name:
+                    cel.name = new_name		#@TODO: redo paintinglayer naming
+
+                #rename parent if need be
+                if self.timeline[a].stack != pl[:-1]:
+                    parent = layers.deepget(pl[:-1])
+                    parent.name = par_name(a, self.timeline[a].name)
+                    self.timeline[a].stack = pl[:-1]
+            if len(extra) > 0:
+                sketches = layers.deepget((0,))
+                if sketches.name != _("Sketches"):
+                    sketches.name = _("Sketches")
+
+            layers.set_current_path(layers.canonpath(path=layers.deepindex(selection)))
 
 
     def change_opacityfactor(self, opacityfactor):
@@ -701,6 +921,53 @@ class Animation(object):
         self.doc.do(anicommand.PasteCel(self.doc, frame))
 
     def merge(self, layers):
+        """Merge cels into a new painting layer, as they'd look together
+
+        :param layers: cels to merge, topmost first, as returned by
+          `TimeLine.cels_at()`. Each is merged at the visibility and
+          opacity of the timeline layer holding it.
+        :rtype: lib.layer.PaintingLayer
+
+        The returned layer is not inserted into the document.
+        """
+        sources = self.merge_cache.get_sources(layers)
+        if sources is None:
+            return self._merge_normalized(layers)
+        dstlayer = layer.PaintingLayer()
+        for cel, opacity in sources:
+            dstlayer.strokes[:0] = cel.strokes
+        names = [cel.name for cel, opacity in reversed(sources)
+                 if cel.has_interesting_name()]
+        #TRANSLATORS: name combining punctuation for Merge Down
+        name = _(u", ").join(names)
+        if name != '':
+            dstlayer.name = name
+        dstsurf = dstlayer._surface
+        for tx, ty, src in self._iter_merged_tiles(layers, sources):
+            with dstsurf.tile_request(tx, ty, readonly=False) as dst:
+                mypaintlib.tile_copy_rgba16_into_rgba16(src, dst)
+        return dstlayer
+
+    def _iter_merged_tiles(self, layers, sources=None):
+        """Iterate over the merged tiles of some cels
+
+        :returns: iterator of ``(tx, ty, rgba)``, where `rgba` must not
+          be modified.
+        """
+        cache = self.merge_cache
+        if sources is None:
+            sources = cache.get_sources(layers)
+        if sources is None:
+            surf = self._merge_normalized(layers)._surface
+            for (tx, ty), tile in surf.tiledict.items():
+                yield tx, ty, tile.rgba
+            return
+        for tx, ty in cache.get_tile_coords(sources):
+            rgba = cache.get_tile(sources, tx, ty)
+            if rgba is not None:
+                yield tx, ty, rgba
+
+    def _merge_normalized(self, layers):
         merge_layers = []
         for l in layers[::-1]:
             if l is None: continue
@@ -736,3 +1003,768 @@ class Animation(object):
                     lyr.composite_tile(dst, True, tx, ty, mipmap_level=0)
         return dstlayer
 
+
+
+def _plan_restack(root, groups):
+    """Plans the fewest moves which put layers into groups
+
+    :param RootLayerStack root: the layer tree
+    :param list groups: lists of layers, one for each top-level group
+      wanted, in order. Each group must end up holding its layers at
+      the front, in order.
+    :returns: moves for `RootLayerStack.restack()`
+
+    Each group reuses the top-level stack which holds the first of its
+    layers that is already in one, so a group which just changes place
+    is moved whole. Failing that it reuses a top-level stack with none
+    of the grouped layers in it, or gets a new one. Other children of
+    the stacks stay after the grouped layers, and unused top-level
+    stacks go after the groups. Within each stack, the layers already
+    in the longest run of the right order stay put.
+    """
+    parents = {}  # id(layer) -> parent stack
+    for path, l in root.walk():
+        if isinstance(l, layer.LayerStack):
+            for child in l:
+                parents[id(child)] = l
+    for child in root:
+        parents[id(child)] = root
+    top_stacks = [l for l in root if isinstance(l, layer.LayerStack)]
+    top_ids = set(id(l) for l in top_stacks)
+    grouped = set()
+    used = set()  # ids of stacks holding grouped layers
+    for group in groups:
+        for l in group:
+            grouped.add(id(l))
+            used.add(id(parents.get(id(l))))
+    stacks = [None] * len(groups)
+    claimed = set()
+    for g, group in enumerate(groups):
+        for l in group:
+            parent = parents.get(id(l))
+            if parent is None or id(parent) not in top_ids:
+                continue
+            if id(parent) not in claimed:
+                stacks[g] = parent
+                claimed.add(id(parent))
+                break
+    spare = [l for l in top_stacks
+             if id(l) not in claimed and id(l) not in used]
+    spare.reverse()
+    for g, stack in enumerate(stacks):
+        if stack is None:
+            stack = spare.pop() if spare else layer.LayerStack()
+            stacks[g] = stack
+            claimed.add(id(stack))
+
+    moves = []
+    top = stacks + [l for l in root
+                    if id(l) not in claimed and id(l) not in grouped]
+    _plan_container_moves(root, top, moves)
+    for stack, group in zip(stacks, groups):
+        rest = [l for l in stack if id(l) not in grouped]
+        _plan_container_moves(stack, group + rest, moves)
+    return moves
+
+
+def _plan_container_moves(stack, targets, moves):
+    """Plans the moves giving a stack its target children, in order"""
+    position = dict((id(l), i) for i, l in enumerate(targets))
+    current = [position[id(l)] for l in stack if id(l) in position]
+    kept = _longest_increasing(current)
+    for i, l in enumerate(targets):
+        if i not in kept:
+            moves.append((l, stack, i))
+
+
+def _longest_increasing(seq):
+    """Returns the set of values in a longest increasing subsequence
+
+    >>> sorted(_longest_increasing([3, 0, 1, 4, 2]))
+    [0, 1, 2]
+    >>> _longest_increasing([])
+    set([])
+    """
+    tails = []  # smallest tail value for each subsequence length
+    tail_idx = []
+    prev = [None] * len(seq)
+    for i, x in enumerate(seq):
+        n = bisect_left(tails, x)
+        if n > 0:
+            prev[i] = tail_idx[n-1]
+        if n == len(tails):
+            tails.append(x)
+            tail_idx.append(i)
+        else:
+            tails[n] = x
+            tail_idx[n] = i
+    result = set()
+    i = tail_idx[-1] if tail_idx else None
+    while i is not None:
+        result.add(seq[i])
+        i = prev[i]
+    return result
+
+
+class MergeCache(object):
+    """
+    Tile-level cache of merged cels.
+
+    Merging cels at the timeline layers' opacities only needs the cels'
+    own tiles if they are normal-mode painting layers whose parent
+    stacks, if any, leave them looking as they would in the root stack.
+    This covers almost all animations, including those whose cels are
+    grouped by `Animation.sort_layers()`. The merged tiles are keyed by
+    the source Tile objects and opacities they were made from, so the
+    same cels are only composited once across held frames, and across
+    repeated exports or merges.
+
+    Source tiles are made read-only as they are used, as
+    `save_snapshot()` does, so painting copies them rather than changing
+    them under the cache. This means entries never need invalidating:
+    they just stop being looked up, and are evicted in least recently
+    used order when the memory budget is exceeded. Entries keep their
+    source tiles alive, so those count towards the budget too.
+
+    """
+
+    #: Default memory budget, in bytes
+    DEFAULT_BUDGET = 256 * 1024 * 1024
+
+    #: Bytes used by one tile's pixels
+    TILE_BYTES = tiledsurface.N * tiledsurface.N * 4 * 2
+
+    def __init__(self, ani, budget=DEFAULT_BUDGET):
+        self.ani = ani
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()  # ((Tile, opacity), ...) -> rgba
+        self._owners = {}  # cel -> timeline layer holding it
+        self._owners_key = None
+
+    def clear(self):
+        self._tiles.clear()
+        self.size = 0
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.budget and self._tiles:
+            key, rgba = self._tiles.popitem(last=False)
+            self.size -= (len(key) + 1) * self.TILE_BYTES
+
+    def log_usage(self):
+        logger.info("Merge cache: %d tiles, %.1f of %.1f MiB, "
+                    "%d hits, %d misses", len(self._tiles),
+                    self.size / 1048576.0, self.budget / 1048576.0,
+                    self.hits, self.misses)
+
+    def _get_owner(self, cel):
+        """The timeline layer holding a cel, like `TimeLine.cel_index()`"""
+        timeline = self.ani.timeline
+        key = (id(timeline),) + tuple((id(l), l.revision) for l in timeline)
+        if key != self._owners_key:
+            self._owners = {}
+            for l in timeline:
+                for frame in l.itervalues():
+                    if frame.cel is not None:
+                        self._owners.setdefault(frame.cel, l)
+            self._owners_key = key
+        return self._owners.get(cel)
+
+    @staticmethod
+    def _is_pass_through(stack):
+        """Whether a stack leaves its children looking as if in its parent"""
+        return (stack.visible and stack.opacity == 1.0
+                and stack.mode == tiledsurface.DEFAULT_COMBINE_MODE
+                and not stack.isolated
+                and not stack.get_auto_isolation())
+
+    def get_sources(self, cels):
+        """Resolve cels to the ``(cel, opacity)`` pairs to merge
+
+        :param cels: cels to merge, topmost first
+        :returns: contributing cels and their opacities, bottommost
+          first, or None if some cel can't be merged from its own tiles.
+
+        Cels nested in stacks are merged from their own tiles too, so
+        long as every parent stack is visible, fully opaque, normal mode
+        and not isolated, as the groups made by sorting are.
+        """
+        root = self.ani.doc.layer_stack
+        sources = []
+        for cel in reversed(cels):
+            if cel is None:
+                continue
+            path = root.deepindex(cel)
+            if path is None:
+                continue
+            for i in xrange(1, len(path)):
+                if not self._is_pass_through(root.deepget(path[:i])):
+                    return None
+            if not isinstance(cel, layer.PaintingLayer):
+                return None
+            if cel.mode != tiledsurface.DEFAULT_COMBINE_MODE:
+                return None
+            owner = self._get_owner(cel)
+            if owner is None:
+                return None
+            if not owner.visible or owner.opacity == 0:
+                continue
+            sources.append((cel, owner.opacity))
+        return sources
+
+    def get_tile_coords(self, sources):
+        tiles = set()
+        for cel, opacity in sources:
+            tiles.update(cel._surface.tiledict.iterkeys())
+        return tiles
+
+    def get_tile_plan(self, sources, tx, ty):
+        """Get one merged tile, or a plan for merging it
+
+        :param sources: as returned by `get_sources()`
+        :returns: ``(rgba, key, plan)``. Either `rgba` is RGBA16 tile
+          data, which must not be modified, or None if nothing is
+          there. Otherwise it is None, and `plan` is the render plan
+          which merges the tile, for `mypaintlib.tile_combine_plan()`.
+          The result can be cached with `add_tile()` under `key`.
+
+        Merging from a plan needs no access to the layers, so it can be
+        done on another thread.
+        """
+        key = []
+        for cel, opacity in sources:
+            tile = cel._surface.tiledict.get((tx, ty))
+            if tile is None or tile is tiledsurface.transparent_tile:
+                continue
+            tile.readonly = True
+            key.append((tile, opacity))
+        if not key:
+            return None, None, None
+        if len(key) == 1 and key[0][1] == 1.0:
+            return key[0][0].rgba, None, None
+        key = tuple(key)
+        rgba = self._tiles.pop(key, None)
+        if rgba is not None:
+            self.hits += 1
+            self._tiles[key] = rgba
+            return rgba, None, None
+        self.misses += 1
+        combine_op = mypaintlib.RenderPlanCombine
+        mode = tiledsurface.DEFAULT_COMBINE_MODE
+        plan = [(combine_op, tile.rgba, mode, opacity)
+                for tile, opacity in key]
+        return None, key, plan
+
+    def add_tile(self, key, rgba):
+        """Cache a tile merged from the plan given by `get_tile_plan()`"""
+        if key in self._tiles:
+            return
+        self._tiles[key] = rgba
+        self.size += (len(key) + 1) * self.TILE_BYTES
+        self._evict()
+
+    def get_tile(self, sources, tx, ty):
+        """Get one merged tile
+
+        :param sources: as returned by `get_sources()`
+        :returns: RGBA16 tile data, which must not be modified, or None
+          if nothing is there.
+        """
+        rgba, key, plan = self.get_tile_plan(sources, tx, ty)
+        if plan is not None:
+            N = tiledsurface.N
+            rgba = numpy.zeros((N, N, 4), 'uint16')
+            mypaintlib.tile_combine_plan(plan, rgba, True)
+            self.add_tile(key, rgba)
+        return rgba
+
+
+def _save_png_pixels(filename, pixels, write_legacy_png=True):
+    """Writes an RGBA8 pixel array to a PNG file"""
+    h, w = pixels.shape[:2]
+    N = tiledsurface.N
+    rows = (pixels[y:y+N] for y in xrange(0, h, N))
+    filename_sys = filename.encode(sys.getfilesystemencoding())
+    mypaintlib.save_png_fast_progressive(filename_sys, w, h, True, rows,
+                                         write_legacy_png)
+
+
+class _FrameJob(object):
+    """One frame to render on a `_FrameRenderer`, planned by the caller
+
+    `tiles` holds ``(row, col, rgba, key, plan)`` tuples, as returned by
+    `MergeCache.get_tile_plan()` for the tile drawn at (row, col) of the
+    frame, and the tiles merged from plans end up in `merged` as
+    ``(key, rgba)`` pairs, for the caller to cache.
+    """
+
+    def __init__(self, shape, crop, background=None):
+        object.__init__(self)
+        self.shape = shape  # (height, width) of the tiles drawn
+        self.crop = crop  # (y, x, height, width) of the frame in them
+        self.background = background
+        self.tiles = []
+        self.merged = []
+        self.pixels = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+    def run(self):
+        """Render the frame, on any thread"""
+        h, w = self.shape
+        arr = numpy.zeros((h, w, 4), 'uint8')
+        N = tiledsurface.N
+        for row, col, rgba, key, plan in self.tiles:
+            if rgba is None and plan is None:
+                continue
+            if rgba is None:
+                rgba = numpy.zeros((N, N, 4), 'uint16')
+                mypaintlib.tile_combine_plan(plan, rgba, True)
+                self.merged.append((key, rgba))
+            dst = arr[row:row+N, col:col+N, :]
+            mypaintlib.tile_convert_rgba16_to_rgba8(rgba, dst)
+        self.tiles = []
+        y, x, h, w = self.crop
+        arr = arr[y:y+h, x:x+w, :]
+        if self.background is None:
+            self.pixels = arr
+            return
+        # The 8-bit output is straight (non-premultiplied) alpha
+        alpha = arr[:, :, 3:4].astype('uint16')
+        bg = numpy.array(self.background, 'uint16')
+        rgb = arr[:, :, :3] * alpha + bg * (255 - alpha) + 127
+        rgb //= 255
+        self.pixels = numpy.ascontiguousarray(rgb, 'uint8')
+
+    def wait(self):
+        """Wait for the frame to be rendered, and return its pixels"""
+        self.done.wait()
+        if self.exc_info is not None:
+            exc_type, exc, tb = self.exc_info
+            self.exc_info = None
+            raise exc_type, exc, tb
+        return self.pixels
+
+
+class _FrameRenderer(object):
+    """Renders planned frames on a pool of worker threads
+
+    Frames are planned on the calling thread, which owns the document,
+    and only the merging and conversion of their tiles is done by the
+    workers. The native tile operations doing that release the
+    interpreter lock, so several frames render at once.
+    """
+
+    def __init__(self, threads=None):
+        object.__init__(self)
+        if threads is None:
+            try:
+                threads = multiprocessing.cpu_count()
+            except NotImplementedError:
+                threads = 1
+        threads = max(1, threads)
+        #: Frames to plan ahead of the one being waited for
+        self.lookahead = 2 * threads
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in xrange(threads):
+            thread = threading.Thread(target=self._run,
+                                      name="FrameRenderer")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                job.run()
+            except Exception:
+                logger.exception("Failed to render a frame")
+                job.exc_info = sys.exc_info()
+            finally:
+                job.done.set()
+
+    def submit(self, job):
+        """Queue a job for rendering"""
+        self._queue.put(job)
+
+    def close(self):
+        """Stop the workers once the jobs queued so far are done"""
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+class _FrameWriter(object):
+    """Hands rendered frames to a write callback on a background thread
+
+    Writing frames to an encoder's pipe blocks without holding the
+    interpreter lock, so that can overlap with planning and rendering
+    the next frames while the encoder process works in parallel. The queue is bounded so that only a few frames
+    are held in memory at once.
+    """
+
+    def __init__(self, write_cb, depth=4):
+        object.__init__(self)
+        self._write_cb = write_cb
+        self._queue = Queue.Queue(maxsize=depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._run,
+                                        name="FrameWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue  # drain, so that put() never blocks forever
+            try:
+                self._write_cb(*item)
+            except Exception:
+                logger.exception("Failed to write frame %d", item[0])
+                self._error = sys.exc_info()
+
+    def put(self, *item):
+        """Queue a frame for writing, raising any earlier write error"""
+        self._raise_error()
+        self._queue.put(item)
+
+    def close(self):
+        """Wait for all queued frames to be written"""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            exc_type, exc, tb = self._error
+            self._error = None
+            raise exc_type, exc, tb
+
+
+class PlaybackCache(object):
+    """
+    Pre-rendered animation frames for playback.
+
+    Each frame's cels are flattened together with the rest of the
+    visible layer stack, once, into RGBA8 tiles at the mipmap level
+    being displayed. Held frames share the same entry since they show
+    the same cels. Entries are evicted in least recently used order
+    when the memory budget is exceeded, and dropped tile by tile when
+    the pixels of a layer they contain change.
+
+    While playing, the frames ahead of the playhead are rendered in
+    the background when idle, for the tiles last displayed, for as long
+    as they fit into the budget without evicting anything.
+
+    Changes to the cels' pixels are watched on the surfaces of the
+    cels shown by the cached frames, since the root's content change
+    events for them also report visible/opacity changes, which the
+    cached frames don't depend on. Cels stop being watched once no
+    cached frame shows them.
+
+    While `active`, the canvas renders from here instead of compositing
+    the layer stack, and the cels' own visible/opacity flags are
+    ignored: the current frame's cels are shown fully opaque, the other
+    cels are hidden.
+
+    """
+
+    #: Default memory budget, in bytes
+    DEFAULT_BUDGET = 512 * 1024 * 1024
+
+    #: Bytes used by one cached tile
+    TILE_BYTES = tiledsurface.N * tiledsurface.N * 4
+
+    def __init__(self, ani, budget=DEFAULT_BUDGET):
+        self.ani = ani
+        self.budget = budget
+        self.active = False
+        self.size = 0
+        self._frames = OrderedDict()  # key -> _PlaybackFrame
+        self._watched = {}  # cel -> its surface observer
+        self._view = None  # (tiles, mipmap_level) last rendered
+        self._tasks = idletask.Processor()
+        self._prerender_queued = False
+        root = ani.doc.layer_stack
+        root.layer_content_changed += self._content_changed_cb
+        root.layer_properties_changed += self._properties_changed_cb
+        root.layer_inserted += self._structure_changed_cb
+        root.layer_deleted += self._structure_changed_cb
+
+    def clear(self):
+        self._frames.clear()
+        self.size = 0
+        self._unwatch_unused()
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self._evict()
+
+    def _evict(self, keep=None):
+        evicted = False
+        while self.size > self.budget and self._frames:
+            key, frame = self._frames.popitem(last=False)
+            if frame is keep:
+                self._frames[key] = frame
+                if len(self._frames) == 1:
+                    break
+                continue
+            self.size -= frame.size
+            evicted = True
+        if evicted:
+            self._unwatch_unused()
+
+    def _get_frame_key(self, idx, mipmap_level):
+        root = self.ani.doc.layer_stack
+        shown = tuple(self.ani.timeline.cels_at(idx))
+        background = root._get_render_background()
+        dst_has_alpha = not root.get_render_is_opaque()
+        return (shown, mipmap_level, background, dst_has_alpha)
+
+    def _get_frame(self, key):
+        frame = self._frames.pop(key, None)
+        if frame is None:
+            shown, mipmap_level, background, dst_has_alpha = key
+            root = self.ani.doc.layer_stack
+            timeline = self.ani.timeline
+            hidden = set(timeline.get_all_cels()).difference(shown)
+            frame = _PlaybackFrame(root, set(shown), hidden, mipmap_level,
+                                   background, dst_has_alpha)
+            self._watch(frame.shown)
+        self._frames[key] = frame
+        return frame
+
+    def render_into(self, surface, tiles, mipmap_level):
+        """
+        Tiled rendering of the current frame, like
+        `lib.layer.RootLayerStack.render_into()`.
+
+        """
+        timeline = self.ani.timeline
+        frame = self._get_frame(self._get_frame_key(timeline.idx,
+                                                    mipmap_level))
+        for tx, ty in tiles:
+            tile, allocated = frame.get_tile(tx, ty)
+            self.size += allocated
+            with surface.tile_request(tx, ty, readonly=False) as dst:
+                dst[...] = tile
+        self._evict(keep=frame)
+        self._view = (list(tiles), mipmap_level)
+        self._schedule_prerender()
+
+    ## Rendering ahead
+
+    def _schedule_prerender(self):
+        if not self._prerender_queued:
+            self._prerender_queued = True
+            self._tasks.add_work(self._prerender)
+
+    def _prerender(self):
+        """Render the next frame ahead of the playhead which is missing
+
+        Frames are tried in playback order, wrapping around, and one is
+        rendered per call, which then queues the next call. This stops
+        when all of the frames are there, or when the next one would
+        need more memory than is left in the budget.
+        """
+        self._prerender_queued = False
+        if not self.active or self._view is None:
+            return
+        tiles, mipmap_level = self._view
+        timeline = self.ani.timeline
+        first = timeline.get_first()
+        last = timeline.get_last()
+        idx = timeline.idx
+        flags = self._get_frame_key(idx, mipmap_level)[1:]
+        keys = set()
+        for i in xrange(last - first + 1):
+            idx += 1
+            if idx > last or idx < first:
+                idx = first
+            key = (tuple(timeline.cels_at(idx)),) + flags
+            if key in keys:
+                continue
+            keys.add(key)
+            frame = self._frames.get(key)
+            if frame is None:
+                missing = tiles
+            else:
+                missing = [t for t in tiles if t not in frame.tiles]
+            if not missing:
+                continue
+            if self.size + len(missing) * self.TILE_BYTES > self.budget:
+                return
+            if frame is None:
+                frame = self._get_frame(key)
+            for tx, ty in missing:
+                tile, allocated = frame.get_tile(tx, ty)
+                self.size += allocated
+            self._schedule_prerender()
+            return
+
+    ## Invalidation
+
+    def _watch(self, cels):
+        for cel in cels:
+            if cel not in self._watched:
+                cb = functools.partial(self._cel_pixels_changed_cb, cel)
+                cel._surface.observers.append(cb)
+                self._watched[cel] = cb
+
+    def _unwatch_unused(self):
+        """Stop watching the cels which no cached frame shows"""
+        used = set()
+        for frame in self._frames.itervalues():
+            used.update(frame.shown)
+        for cel in list(self._watched):
+            if cel in used:
+                continue
+            cb = self._watched.pop(cel)
+            if cb in cel._surface.observers:
+                cel._surface.observers.remove(cb)
+
+    def _invalidate(self, frames, x, y, w, h):
+        dropped = False
+        for key, frame in frames:
+            if w == 0 or h == 0:
+                freed = frame.size
+                del self._frames[key]
+                dropped = True
+            else:
+                freed = frame.invalidate_area(x, y, w, h)
+            self.size -= freed
+        if dropped:
+            self._unwatch_unused()
+        if frames:
+            self._schedule_prerender()
+
+    def _cel_pixels_changed_cb(self, cel, x, y, w, h):
+        frames = [(k, f) for (k, f) in self._frames.items()
+                  if f.depends_on(cel)]
+        self._invalidate(frames, x, y, w, h)
+
+    def _properties_changed_cb(self, root, path, layer, changed):
+        # Cached frames ignore the cels' visible/opacity flags, but not
+        # their modes. The other layers' flags are handled as content.
+        if "mode" not in changed:
+            return
+        frames = [(k, f) for (k, f) in self._frames.items()
+                  if f.is_cel(layer) and f.depends_on(layer)]
+        self._invalidate(frames, 0, 0, 0, 0)
+
+    def _content_changed_cb(self, root, layer, x, y, w, h):
+        # Pixel changes to a frame's cels arrive via their surfaces
+        frames = [(k, f) for (k, f) in self._frames.items()
+                  if f.depends_on(layer) and not f.is_cel(layer)]
+        self._invalidate(frames, x, y, w, h)
+
+    def _structure_changed_cb(self, root, path):
+        self.clear()
+
+
+class _PlaybackFrame(object):
+    """
+    One cached frame: the flattened tiles of a set of shown cels.
+
+    """
+    def __init__(self, root, shown, hidden, mipmap_level, background,
+                 dst_has_alpha):
+        self.root = root
+        self.shown = shown
+        self.hidden = hidden
+        self.mipmap_level = mipmap_level
+        self.background = background
+        self.dst_has_alpha = dst_has_alpha
+        self.tiles = {}
+        self.size = 0
+        self._plan = None
+
+    def depends_on(self, layer):
+        return layer not in self.hidden
+
+    def is_cel(self, layer):
+        return layer in self.shown or layer in self.hidden
+
+    def invalidate_area(self, x, y, w, h):
+        """Drop the tiles intersecting a model area, returns bytes freed"""
+        # Layer flags may have changed too, which the plan holds
+        self._plan = None
+        size = tiledsurface.N << self.mipmap_level
+        tx0, ty0 = x // size, y // size
+        tx1, ty1 = (x + w - 1) // size, (y + h - 1) // size
+        freed = 0
+        for pos in self.tiles.keys():
+            tx, ty = pos
+            if tx0 <= tx <= tx1 and ty0 <= ty <= ty1:
+                freed += self.tiles.pop(pos).nbytes
+        self.size -= freed
+        return freed
+
+    def _get_plan(self):
+        """The layer stack's render plan, as this frame shows it
+
+        This is the plan `lib.layer.RootLayerStack.render_into()` uses,
+        without the hidden cels, and with the shown cels combined fully
+        opaque whatever their own visible/opacity flags.
+        """
+        if self._plan is None:
+            layers = set()
+            for path, l in self.root.walk():
+                if l in self.shown or (l.visible and l not in self.hidden):
+                    layers.add(l)
+            shown_surfaces = set(cel._surface for cel in self.shown)
+            plan = []
+            for l in reversed(self.root):
+                plan.extend(l.get_render_ops(layers))
+            self._plan = [(op, surf, mode,
+                           1.0 if surf in shown_surfaces else opacity)
+                          for op, surf, mode, opacity in plan]
+        return self._plan
+
+    def get_tile(self, tx, ty):
+        """Get one tile of the frame, rendering it if needed
+
+        :returns: ``(tile, allocated)``: the RGBA8 or RGBU8 tile, which
+          must not be modified, and the bytes allocated for it.
+        """
+        tile = self.tiles.get((tx, ty))
+        if tile is not None:
+            return tile, 0
+        N = tiledsurface.N
+        tmp = numpy.zeros((N, N, 4), dtype='uint16')
+        if self.background:
+            bg = self.root._background_layer._surface
+            bg.blit_tile_into(tmp, self.dst_has_alpha, tx, ty,
+                              self.mipmap_level)
+        combine_op = mypaintlib.RenderPlanCombine
+        steps = []
+        for op, surf, mode, opacity in self._get_plan():
+            src = None
+            if op == combine_op:
+                src = surf.get_combine_src(tx, ty, self.mipmap_level,
+                                           opacity, mode)
+            steps.append((op, src, mode, opacity))
+        mypaintlib.tile_combine_plan(steps, tmp, self.dst_has_alpha)
+        tile = numpy.empty((N, N, 4), dtype='uint8')
+        if self.dst_has_alpha:
+            mypaintlib.tile_convert_rgba16_to_rgba8(tmp, tile)
+        else:
+            mypaintlib.tile_convert_rgbu16_to_rgbu8(tmp, tile)
+        self.tiles[(tx, ty)] = tile
+        self.size += tile.nbytes
+        return tile, tile.nbytes
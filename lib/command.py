@@ -27,12 +27,32 @@ logger = getLogger(__name__)
 
 
 class CommandStack (object):
-    """Undo/redo stack"""
+    """Undo/redo stack
+
+    The undo stack is limited to `MAX_STEPS` non-automatic commands, and
+    the tiles which its commands alone hold are limited to a memory
+    budget. When they exceed it, the tiles of the oldest commands are
+    spilled to a temporary file, and read back when those commands are
+    undone.
+
+    Each command's share of the memory is estimated once, when it is
+    pushed, and the stack only accounts for its tiles exactly and spills
+    them once the estimates add up to more than the budget.
+    """
+
+    #: Maximum number of non-automatic commands kept for undo
+    MAX_STEPS = 30
+
+    #: Default budget for tiles held only by the undo stack, in bytes
+    DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
 
     def __init__(self, **kwargs):
         super(CommandStack, self).__init__()
         self.undo_stack = []
         self.redo_stack = []
+        self.memory_budget = self.DEFAULT_MEMORY_BUDGET
+        self._spill = tiledsurface.SnapshotSpill()
+        self._command_bytes = weakref.WeakKeyDictionary()  # cmd -> bytes
         self.stack_updated()
 
     def __repr__(self):
@@ -42,12 +62,25 @@ class CommandStack (object):
     def clear(self):
         self._discard_undo()
         self._discard_redo()
+        self._spill.close()
         self.stack_updated()
 
+    def set_memory_budget(self, budget):
+        """Sets the budget for tiles held only by the undo stack
+
+        :param int budget: the budget, in bytes
+        """
+        self.memory_budget = budget
+        self.reduce_undo_history()
+
     def _discard_undo(self):
+        for command in self.undo_stack:
+            self._command_bytes.pop(command, None)
         self.undo_stack = []
 
     def _discard_redo(self):
+        for command in self.redo_stack:
+            self._command_bytes.pop(command, None)
         self.redo_stack = []
 
     def do(self, command):
@@ -62,6 +95,7 @@ class CommandStack (object):
         self._discard_redo()
         command.redo()
         self.undo_stack.append(command)
+        self._command_bytes[command] = self._estimate_bytes(command)
         self.reduce_undo_history()
         self.stack_updated()
 
@@ -95,16 +129,93 @@ class CommandStack (object):
         return command
 
     def reduce_undo_history(self):
-        """Trims the undo stack"""
+        """Trims the undo stack, and spills it to keep within budget"""
         stack = self.undo_stack
-        self.undo_stack = []
+        start = 0
         steps = 0
-        for item in reversed(stack):
-            self.undo_stack.insert(0, item)
-            if not item.automatic_undo:
+        for i in xrange(len(stack)-1, -1, -1):
+            if not stack[i].automatic_undo:
                 steps += 1
-            if steps == 30: # and memory > ...
+            if steps == self.MAX_STEPS:
+                start = i
                 break
+        if start:
+            for command in stack[:start]:
+                self._command_bytes.pop(command, None)
+            del stack[:start]
+        used = sum(self._command_bytes.itervalues())
+        if stack and used > self.memory_budget:
+            self._spill_undo_history()
+        self._spill.collect()
+
+    def _spill_undo_history(self):
+        """Spills the oldest commands' unique tiles past the budget
+
+        Tiles are accounted to the newest thing holding them: first the
+        document's layers, then commands which can be redone, and then
+        commands which can be undone, newest first. The newest command
+        is always kept in memory, and so is everything accounted before
+        the budget runs out. The tiles of older commands which nothing
+        kept in memory shares are spilled.
+        """
+        seen = set()
+        newest = self.undo_stack[-1]
+        for layer in newest.doc.layer_stack.deepiter():
+            surface = getattr(layer, "_surface", None)
+            tiledict = getattr(surface, "tiledict", None)
+            if tiledict is not None:
+                for tile in tiledict.iterunseen(seen, seen):
+                    pass  # just recording them as seen
+        used = 0
+        for command in reversed(self.redo_stack):
+            size = self._account_unique_tiles(command, seen)
+            self._command_bytes[command] = size
+            used += size
+        spilling = []
+        for command in reversed(self.undo_stack):
+            if not spilling:
+                found = set()
+                size = self._account_unique_tiles(command, seen, found)
+                if used + size <= self.memory_budget or command is newest:
+                    self._command_bytes[command] = size
+                    used += size
+                    seen.update(found)
+                    continue
+            self._command_bytes[command] = 0
+            spilling.append(command)
+        spilled = 0
+        for command in spilling:
+            for sshot in command.get_surface_snapshots():
+                spilled += sshot.spill(self._spill, seen)
+        if spilled:
+            logger.debug("Spilled %.1f MiB of undo history, keeping %.1f MiB",
+                         spilled / 1048576.0, used / 1048576.0)
+
+    @staticmethod
+    def _estimate_bytes(command):
+        """Estimates the bytes a newly performed command alone holds
+
+        These are the tiles in its snapshots which differ from what their
+        surfaces hold now: usually the tiles it changed, as they were
+        before.
+        """
+        sshots = command.get_surface_snapshots()
+        return sum(sshot.count_unshared_bytes() for sshot in sshots)
+
+    @staticmethod
+    def _account_unique_tiles(command, seen, found=None):
+        """Bytes used by a command's tiles not seen before
+
+        The ids of the command's new tiles are added to `found`, or to
+        `seen` if `found` is not given.
+        """
+        if found is None:
+            found = seen
+        size = 0
+        for sshot in command.get_surface_snapshots():
+            for tile in sshot.iter_unseen_tiles(seen, found):
+                size += tiledsurface._tile_bytes(tile)
+        return size
 
     def get_last_command(self):
         """Returns the most recently performed command"""
@@ -117,6 +228,8 @@ class CommandStack (object):
         if cmd is None:
             return None
         cmd.update(**kwargs)
+        self._command_bytes[cmd] = self._estimate_bytes(cmd)
+        self.reduce_undo_history()
         self.stack_updated() # the display_name may have changed
         return cmd
 
@@ -172,6 +285,19 @@ class Command (object):
     def __repr__(self):
         return "<%s>" % (self.display_name,)
 
+    def get_surface_snapshots(self):
+        """Returns the tiled surface snapshots the command holds
+
+        This is used to account for the memory the undo stack uses, and
+        to spill snapshots out of memory. The default implementation
+        finds the layer snapshots in the command's attributes.
+        """
+        sshots = []
+        for value in self.__dict__.itervalues():
+            if isinstance(value, lib.layer._LayerBaseSnapshot):
+                sshots.extend(value.get_surface_snapshots())
+        return sshots
+
 
     ## Main Command interface
 
@@ -253,6 +379,7 @@ class Brushwork (Command):
         self._sshot_before = None
         self._time_after = None
         self._sshot_after = None
+        self._tiles_changed = None
         self._last_pos = None
         self.description = description
         self.split_due = False
@@ -285,8 +412,9 @@ class Brushwork (Command):
             self._time_after = t0 + self._stroke_seq.total_painting_time
             layer.add_stroke_shape(self._stroke_seq, self._sshot_before)
             self._sshot_after = layer.save_snapshot()
+            self._tiles_changed = self._sshot_before.diff(self._sshot_after)
         else:
-            layer.load_snapshot(self._sshot_after)
+            layer.load_snapshot_tiles(self._sshot_after, self._tiles_changed)
         # Update painting time
         assert self._time_after is not None
         self.doc.unsaved_painting_time = self._time_after
@@ -294,7 +422,7 @@ class Brushwork (Command):
     def undo(self):
         """Undoes the effects of redo()"""
         layer = self.doc.layer_stack.deepget(self._layer_path)
-        layer.load_snapshot(self._sshot_before)
+        layer.load_snapshot_tiles(self._sshot_before, self._tiles_changed)
         self.doc.unsaved_painting_time = self._time_before
 
     def update(self, brushinfo):
@@ -306,6 +434,7 @@ class Brushwork (Command):
         self._stroke_seq = stroke
         layer.add_stroke_shape(stroke, self._sshot_before)
         self._sshot_after = layer.save_snapshot()
+        self._tiles_changed = self._sshot_before.diff(self._sshot_after)
 
     def stroke_to(self, dtime, x, y, pressure, xtilt, ytilt):
         """Painting: forward a stroke position update to the model
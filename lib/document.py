@@ -37,7 +37,9 @@ import stroke
 import layer
 import brush
 import animation
-from observable import event
+import oraload
+import orasave
+from observable import event, coalesced, batch_updates
 
 ## Module constants
 
@@ -91,11 +93,14 @@ class Document (object):
 
     ## Initialization and cleanup
 
-    def __init__(self, brushinfo=None, painting_only=False):
+    def __init__(self, brushinfo=None, painting_only=False,
+                 progressive_load=False):
         """Initialize
 
         :param brushinfo: the lib.brush.BrushInfo instance to use
         :param painting_only: only use painting layers
+        :param progressive_load: decode layer data in the background
+          when loading OpenRaster files (see `load_ora()`)
 
         If painting_only is true, then no tempdir will be created by the
         document when it is initialized or cleared.
@@ -118,6 +123,13 @@ class Document (object):
         self.command_stack = command.CommandStack()
         self._painting_only = painting_only
         self._tempdir = None
+        self._progressive_load = progressive_load
+        self._loader = None
+
+        # Reuse of data from the last OpenRaster file saved or loaded
+        self._ora_filename = None
+        self._ora_members = {}
+        self._ora_thumbnail = None
 
         # Optional page area and resolution information
         self._frame = [0, 0, 0, 0]
@@ -227,6 +239,7 @@ class Document (object):
         Currently this just removes the working-document tempdir. This method
         is called by the main app's exit routine after confirmation.
         """
+        self._close_loader()
         self._cleanup_tempdir()
 
 
@@ -398,6 +411,7 @@ class Document (object):
         and resets the frame and the stored resolution.
         """
         self.flush_updates()
+        self._close_loader()
         self.set_symmetry_axis(None)
         prev_area = self.get_full_redraw_bbox()
         if self._tempdir is not None:
@@ -416,6 +430,9 @@ class Document (object):
         self._frame_enabled = False
         self._xres = None
         self._yres = None
+        self._ora_filename = None
+        self._ora_members = {}
+        self._ora_thumbnail = None
         self.canvas_area_modified(*prev_area)
         self.ani.clear_xsheet()
         self.call_frame_observers()
@@ -585,6 +602,7 @@ class Document (object):
         self.canvas_area_modified(x, y, w, h)
 
     @event
+    @coalesced(key=lambda *bbox: None, merge=helpers.union_redraw_bbox)
     def canvas_area_modified(self, x, y, w, h):
         """Event: canvas was updated, either within a rectangle or fully
 
@@ -599,10 +617,30 @@ class Document (object):
         redrawn. In the latter case, the `w` or `h` args forwarded to
         registered observers is zero.
 
+        Inside `batch_updates()`, all the areas are merged into one call.
+
         See also: `invalidate_all()`.
         """
         pass
 
+    def batch_updates(self):
+        """Context manager: merges change notifications until it ends
+
+        >>> doc = Document()
+        >>> areas = []
+        >>> doc.canvas_area_modified += lambda d, *a: areas.append(a)
+        >>> with doc.batch_updates():
+        ...     doc.canvas_area_modified(0, 0, 64, 64)
+        ...     doc.canvas_area_modified(64, 0, 64, 64)
+        >>> areas
+        [(0, 0, 128, 64)]
+
+        Redraws, and the property and content changes of each layer, are
+        merged until the outermost batch ends. See
+        `lib.observable.batch_updates()`.
+        """
+        return batch_updates()
+
     def invalidate_all(self):
         """Marks everything as invalid"""
         self.canvas_area_modified(0, 0, 0, 0)
@@ -869,6 +907,7 @@ class Document (object):
         ``save_*()`` method is chosen to perform the save.
         """
         self.flush_updates()
+        self.finish_loading()
         junk, ext = os.path.splitext(filename)
         ext = ext.lower().replace('.', '')
         save = getattr(self, 'save_' + ext, self._unsupported)
@@ -1012,8 +1051,18 @@ class Document (object):
     save_jpeg = save_jpg
 
 
-    def save_ora(self, filename, options=None, **kwargs):
-        """Saves OpenRaster data to a file"""
+    def save_ora(self, filename, options=None, xsheet_format='json',
+                 **kwargs):
+        """Saves OpenRaster data to a file
+
+        Layer data which is unchanged since the last OpenRaster file was
+        saved or loaded is copied from that file rather than encoded
+        again, and so is the merged image if nothing visible changed.
+
+        The animation X-Sheet is written as JSON, or in the more compact
+        binary format if `xsheet_format` is ``'binary'``. Loading
+        accepts either.
+        """
         logger.info('save_ora: %r (%r, %r)', filename, options, kwargs)
         t0 = time.time()
         tempdir = tempfile.mkdtemp('mypaint')
@@ -1022,15 +1071,10 @@ class Document (object):
 
         # Use .tmpsave extension, so we don't overwrite a valid file if there
         # is an exception
-        orazip = zipfile.ZipFile(filename + '.tmpsave', 'w',
-                                 compression=zipfile.ZIP_STORED)
-
-        # work around a permission bug in the zipfile library:
-        # http://bugs.python.org/issue3394
-        def write_file_str(filename, data):
-            zi = zipfile.ZipInfo(filename)
-            zi.external_attr = 0100644 << 16
-            orazip.writestr(zi, data)
+        orazip = orasave.OraZipFile(filename + '.tmpsave', filename,
+                                    previous=self._ora_filename,
+                                    compression=zipfile.ZIP_STORED)
+        write_file_str = orazip.write_file_str
 
         write_file_str('mimetype', 'image/openraster') # must be the first file
         image = ET.Element('image')
@@ -1062,23 +1106,37 @@ class Document (object):
         # Version declaration
         image.attrib["version"] = "0.0.4-pre.1"
 
-        ani_data = self.ani.xsheet_as_str()
+        if xsheet_format == 'binary':
+            ani_data = self.ani.xsheet_as_binary()
+        elif xsheet_format == 'json':
+            ani_data = self.ani.xsheet_as_str()
+        else:
+            raise ValueError("unknown X-Sheet format %r" % (xsheet_format,))
         write_file_str('animation.xsheet', ani_data)
 
         # Thumbnail preview (256x256)
-        thumbnail = layers.render_thumbnail(frame_bbox)
-        tmpfile = join(tempdir, 'tmp.png')
-        thumbnail.savev(tmpfile, 'png', [], [])
-        orazip.write(tmpfile, 'Thumbnails/thumbnail.png')
-        os.remove(tmpfile)
+        render_key = self._get_render_key(frame_bbox,
+                                          orasave.options_key(kwargs))
+        if self._ora_thumbnail and self._ora_thumbnail[0] == render_key:
+            thumbnail = self._ora_thumbnail[1]
+        else:
+            thumbnail = layers.render_thumbnail(frame_bbox)
+            self._ora_thumbnail = (render_key, thumbnail)
+        thumbnail_data = thumbnail.save_to_bufferv('png', [], [])[1]
+        write_file_str('Thumbnails/thumbnail.png', thumbnail_data)
 
         # Save fully rendered image too
-        tmpfile = os.path.join(tempdir, "mergedimage.png")
-        self.layer_stack.save_as_png( tmpfile, *frame_bbox,
-                                      alpha=False, background=True,
-                                      **kwargs )
-        orazip.write(tmpfile, 'mergedimage.png')
-        os.remove(tmpfile)
+        merged_record = orazip.reuse(self._ora_members, "mergedimage",
+                                     render_key, 'mergedimage.png')
+        if merged_record is None:
+            data = self.layer_stack.encode_as_png( *frame_bbox,
+                                                   alpha=False,
+                                                   background=True,
+                                                   encoder=orazip.encoder,
+                                                   **kwargs )
+            write_file_str('mergedimage.png', data)
+            orazip.remember(self._ora_members, "mergedimage", render_key,
+                            'mergedimage.png')
 
         # Prettification
         helpers.indent_etree(image)
@@ -1091,17 +1149,49 @@ class Document (object):
         if os.path.exists(filename):
             os.remove(filename) # windows needs that
         os.rename(filename + '.tmpsave', filename)
+        orazip.commit()
+        self._ora_filename = orazip.saved_as
 
-        logger.info('%.3fs save_ora total', time.time() - t0)
+        logger.info('%.3fs save_ora total (%d members reused)',
+                    time.time() - t0, orazip.reused)
         return thumbnail
 
 
+    def _get_render_key(self, frame_bbox, options):
+        """Summarizes everything the merged image depends on, for save_ora
+
+        Content generations are unique across layers, so this changes
+        whenever a layer is changed, added, removed, or moved.
+        """
+        layers = self.layer_stack
+        key = [tuple(frame_bbox), options, layers.background_visible,
+               layers.background_layer.content_generation]
+        for path, l in layers.deepenumerate():
+            key.append((path, l.opacity, l.visible, l.mode,
+                        getattr(l, "isolated", None),
+                        getattr(l, "content_generation", None)))
+        return tuple(key)
+
+
     def load_ora(self, filename, feedback_cb=None):
-        """Loads from an OpenRaster file"""
+        """Loads from an OpenRaster file
+
+        If the document was created with `progressive_load` set, this
+        returns once the layers tree and the x-sheet have been read, and
+        the layers' PNG data is decoded in the background afterwards.
+        The cels of the current frame are decoded first, then the
+        layers in the area passed to `prioritize_loading()`.
+        """
         logger.info('load_ora: %r', filename)
         t0 = time.time()
         tempdir = self._tempdir
+        self._close_loader()
+        kwargs = {}
+        if self._progressive_load:
+            self._loader = oraload.ProgressiveLoader()
+            kwargs["loader"] = self._loader
         orazip = zipfile.ZipFile(filename)
+        self._ora_filename = os.path.abspath(filename)
         logger.debug('mimetype: %r', orazip.read('mimetype').strip())
         xml = orazip.read('stack.xml')
         image_elem = ET.fromstring(xml)
@@ -1113,14 +1203,16 @@ class Document (object):
         image_yres = max(0, int(image_elem.attrib.get('yres', 0)))
 
         # Delegate loading of image data to the layers tree itself
-        self.layer_stack.clear()
-        self.layer_stack.load_from_openraster(orazip, root_stack_elem,
-                                              tempdir, feedback_cb, x=0, y=0)
-        assert len(self.layer_stack) > 0
+        with self.batch_updates():
+            self.layer_stack.clear()
+            self.layer_stack.load_from_openraster(orazip, root_stack_elem,
+                                                  tempdir, feedback_cb,
+                                                  x=0, y=0, **kwargs)
+            assert len(self.layer_stack) > 0
 
-        # Set up symmetry axes
-        for path, descendent in self.layer_stack.deepenumerate():
-            descendent.set_symmetry_axis(self.get_symmetry_axis())
+            # Set up symmetry axes
+            for path, descendent in self.layer_stack.deepenumerate():
+                descendent.set_symmetry_axis(self.get_symmetry_axis())
 
         # Resolution information if specified
         # Before frame to benefit from its observer call
@@ -1137,6 +1229,13 @@ class Document (object):
         except KeyError:
             self.ani.load_xsheet(filename)
 
+        if self._loader is not None:
+            timeline = self.ani.timeline
+            wanted = timeline.cels_at(timeline.idx)
+            wanted.append(self.layer_stack.current)
+            self._loader.prioritize(layers=wanted)
+            self._loader.start()
+
         # Set the frame size to that saved in the image.
         self.update_frame(x=0, y=0, width=image_width, height=image_height,
                           user_initiated=False)
@@ -1154,6 +1253,31 @@ class Document (object):
         logger.info('%.3fs load_ora total', time.time() - t0)
 
 
+    ## Progressive loading
+
+    def prioritize_loading(self, layers=None, bbox=None):
+        """Asks for some layers to finish loading before the others
+
+        :param layers: the layers wanted first
+        :param bbox: the visible area, in model coordinates
+
+        This does nothing unless layer data from `load_ora()` is still
+        being decoded in the background.
+        """
+        if self._loader is not None:
+            self._loader.prioritize(layers=layers, bbox=bbox)
+
+    def finish_loading(self):
+        """Waits until all layer data from `load_ora()` has been loaded"""
+        if self._loader is not None:
+            self._loader.finish()
+
+    def _close_loader(self):
+        if self._loader is not None:
+            self._loader.close()
+            self._loader = None
+
+
 class _LayerStackMapping (object):
     """Temporary compatibility hack"""
 
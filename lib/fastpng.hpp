@@ -1,6 +1,7 @@
 #define PNG_SKIP_SETJMP_CHECK
 #include "png.h"
 #include "lcms2.h"
+#include <string>
 
 #ifndef SWIG
 static void png_write_error_callback(png_structp png_save_ptr, png_const_charp error_msg)
@@ -18,6 +19,46 @@ static void png_write_error_callback(png_structp png_save_ptr, png_const_charp e
 }
 #endif
 
+#ifndef SWIG
+// Writes the header, and sets up fast compression of 8-bit RGBA or RGBU rows
+static void
+png_write_fast_header(png_structp png_ptr, png_infop info_ptr,
+                      int w, int h, bool has_alpha, bool write_legacy_png)
+{
+  const int bpc = 8;
+
+  png_set_IHDR (png_ptr, info_ptr,
+                w, h, bpc,
+                has_alpha ? PNG_COLOR_TYPE_RGB_ALPHA : PNG_COLOR_TYPE_RGB,
+                PNG_INTERLACE_NONE,
+                PNG_COMPRESSION_TYPE_BASE,
+                PNG_FILTER_TYPE_BASE);
+
+  if (! write_legacy_png) {
+    // Internal data is sRGB by the time it gets here.
+    // Explicitly save with the recommended chunks to advertise that fact.
+    png_set_sRGB_gAMA_and_cHRM (png_ptr, info_ptr, PNG_sRGB_INTENT_PERCEPTUAL);
+  }
+
+  // default (all filters enabled):                 1350ms, 3.4MB
+  //png_set_filter(png_ptr, 0, PNG_FILTER_NONE);  // 790ms, 3.8MB
+  //png_set_filter(png_ptr, 0, PNG_FILTER_PAETH); // 980ms, 3.5MB
+  png_set_filter(png_ptr, 0, PNG_FILTER_SUB);     // 760ms, 3.4MB
+
+  //png_set_compression_level(png_ptr, 0); // 0.49s, 32MB
+  //png_set_compression_level(png_ptr, 1); // 0.98s, 9.6MB
+  png_set_compression_level(png_ptr, 2);   // 1.08s, 9.4MB
+  //png_set_compression_level(png_ptr, 9); // 18.6s, 9.3MB
+
+  png_write_info(png_ptr, info_ptr);
+
+  if (!has_alpha) {
+    // input array format format is rgbu
+    png_set_filler(png_ptr, 0, PNG_FILLER_AFTER);
+  }
+}
+#endif
+
 typedef int (*GetScanlinesFunction) (int width, png_bytep *rows_out, int *rowstride_out, void *user_data);
 
 typedef struct {
@@ -91,7 +132,6 @@ save_png_fast_progressive_c(char *filename, int w, int h,
   png_infop info_ptr = NULL;
   bool success = false;
 
-  int bpc;
   FILE * fp = NULL;
 
 
@@ -105,8 +145,6 @@ save_png_fast_progressive_c(char *filename, int w, int h,
 #endif
   */
 
-  bpc = 8;
-  
   fp = fopen(filename, "wb");
   if (!fp) {
     PyErr_SetFromErrno(PyExc_IOError);
@@ -132,35 +170,7 @@ save_png_fast_progressive_c(char *filename, int w, int h,
 
   png_init_io(png_ptr, fp);
 
-  png_set_IHDR (png_ptr, info_ptr,
-                w, h, bpc,
-                has_alpha ? PNG_COLOR_TYPE_RGB_ALPHA : PNG_COLOR_TYPE_RGB,
-                PNG_INTERLACE_NONE,
-                PNG_COMPRESSION_TYPE_BASE,
-                PNG_FILTER_TYPE_BASE);
-
-  if (! write_legacy_png) {
-    // Internal data is sRGB by the time it gets here.
-    // Explicitly save with the recommended chunks to advertise that fact.
-    png_set_sRGB_gAMA_and_cHRM (png_ptr, info_ptr, PNG_sRGB_INTENT_PERCEPTUAL);
-  }
-
-  // default (all filters enabled):                 1350ms, 3.4MB
-  //png_set_filter(png_ptr, 0, PNG_FILTER_NONE);  // 790ms, 3.8MB
-  //png_set_filter(png_ptr, 0, PNG_FILTER_PAETH); // 980ms, 3.5MB
-  png_set_filter(png_ptr, 0, PNG_FILTER_SUB);     // 760ms, 3.4MB
-
-  //png_set_compression_level(png_ptr, 0); // 0.49s, 32MB
-  //png_set_compression_level(png_ptr, 1); // 0.98s, 9.6MB
-  png_set_compression_level(png_ptr, 2);   // 1.08s, 9.4MB
-  //png_set_compression_level(png_ptr, 9); // 18.6s, 9.3MB
-
-  png_write_info(png_ptr, info_ptr);
-
-  if (!has_alpha) {
-    // input array format format is rgbu
-    png_set_filler(png_ptr, 0, PNG_FILLER_AFTER);
-  }
+  png_write_fast_header(png_ptr, info_ptr, w, h, has_alpha, write_legacy_png);
 
   {
     int y = 0;
@@ -214,6 +224,232 @@ save_png_fast_progressive (char *filename,
     return result;
 }
 
+/** ProgressivePNGWriter:
+ *
+ * Encodes a PNG image into memory, a strip of scanlines at a time.
+ *
+ *   writer = ProgressivePNGWriter(w, h, has_alpha, write_legacy_png)
+ *   writer.write(strip)    # repeatedly, until all h rows are written
+ *   data = writer.close()  # the PNG data, as a str
+ *
+ * Strips are 8-bit RGBA or RGBU arrays shaped (rows, w, 4), and must not
+ * be modified by other threads while write() runs. The global interpreter
+ * lock is released while libpng filters and compresses the rows, so
+ * writers used by different threads encode in parallel. Each writer must
+ * only be used by one thread at a time.
+ */
+
+#ifndef SWIG
+struct ProgressivePNGWriterState {
+  png_structp png_ptr;
+  png_infop info_ptr;
+  std::string data;   // PNG data encoded so far
+  std::string error;  // first error reported by libpng
+};
+
+static void
+png_memory_write_callback(png_structp png_ptr, png_bytep data,
+                          png_size_t length)
+{
+  ProgressivePNGWriterState *state
+    = (ProgressivePNGWriterState *)png_get_io_ptr(png_ptr);
+  state->data.append((const char *)data, length);
+}
+
+static void
+png_memory_flush_callback(png_structp png_ptr)
+{
+}
+
+static void
+png_memory_error_callback(png_structp png_ptr, png_const_charp error_msg)
+{
+  // Called without the GIL held, so just note the message for later
+  ProgressivePNGWriterState *state
+    = (ProgressivePNGWriterState *)png_get_error_ptr(png_ptr);
+  if (state->error.empty()) {
+    state->error = error_msg;
+  }
+  longjmp (png_jmpbuf(png_ptr), 1);
+}
+#endif
+
+class ProgressivePNGWriter
+{
+private:
+  ProgressivePNGWriterState *state;
+  int width;
+  int height;
+  int y;  // rows written so far
+
+  // Frees the libpng structures. Nothing can be written after this.
+  void
+  cleanup()
+  {
+    if (!state) {
+      return;
+    }
+    if (state->png_ptr) {
+      png_destroy_write_struct(&state->png_ptr,
+                               state->info_ptr ? &state->info_ptr : NULL);
+    }
+    delete state;
+    state = NULL;
+  }
+
+  // Raises the error recorded by libpng, and gives up on the image
+  PyObject *
+  raise_error()
+  {
+    PyErr_Format(PyExc_RuntimeError, "Error writing PNG: %s",
+                 state->error.c_str());
+    cleanup();
+    return NULL;
+  }
+
+  bool
+  check_usable()
+  {
+    if (!state) {
+      PyErr_SetString(PyExc_RuntimeError, "PNG writer is closed");
+      return false;
+    }
+    if (!state->error.empty()) {
+      raise_error();
+      return false;
+    }
+    return true;
+  }
+
+  // These run with the GIL released, and return false on libpng errors
+
+  bool
+  write_rows(png_bytep p, npy_intp rowstride, int rows)
+  {
+    if (setjmp(png_jmpbuf(state->png_ptr))) {
+      return false;
+    }
+    for (int row=0; row<rows; row++) {
+      png_write_row(state->png_ptr, p);
+      p += rowstride;
+    }
+    return true;
+  }
+
+  bool
+  write_end()
+  {
+    if (setjmp(png_jmpbuf(state->png_ptr))) {
+      return false;
+    }
+    png_write_end(state->png_ptr, NULL);
+    return true;
+  }
+
+public:
+
+  ProgressivePNGWriter(int w, int h, bool has_alpha, bool write_legacy_png)
+    : state(new ProgressivePNGWriterState()), width(w), height(h), y(0)
+  {
+    state->png_ptr = NULL;
+    state->info_ptr = NULL;
+    png_structp png_ptr = png_create_write_struct(PNG_LIBPNG_VER_STRING,
+                                                  (png_voidp)state,
+                                                  png_memory_error_callback,
+                                                  NULL);
+    if (!png_ptr) {
+      state->error = "png_create_write_struct() failed";
+      return;
+    }
+    state->png_ptr = png_ptr;
+    state->info_ptr = png_create_info_struct(png_ptr);
+    if (!state->info_ptr) {
+      state->error = "png_create_info_struct() failed";
+      return;
+    }
+    if (setjmp(png_jmpbuf(png_ptr))) {
+      return;
+    }
+    png_set_write_fn(png_ptr, (png_voidp)state,
+                     png_memory_write_callback, png_memory_flush_callback);
+    png_write_fast_header(png_ptr, state->info_ptr,
+                          w, h, has_alpha, write_legacy_png);
+  }
+
+  ~ProgressivePNGWriter()
+  {
+    cleanup();
+  }
+
+  PyObject *
+  write(PyObject *arr_obj)
+  {
+    if (!check_usable()) {
+      return NULL;
+    }
+    if (!PyArray_Check(arr_obj)) {
+      PyErr_SetString(PyExc_TypeError, "strip must be a numpy array");
+      return NULL;
+    }
+    PyArrayObject *arr = (PyArrayObject *)arr_obj;
+    if (PyArray_NDIM(arr) != 3
+        || PyArray_DIM(arr, 1) != width
+        || PyArray_DIM(arr, 2) != 4
+        || PyArray_TYPE(arr) != NPY_UINT8
+        || !PyArray_ISALIGNED(arr)
+        || PyArray_STRIDE(arr, 1) != 4
+        || PyArray_STRIDE(arr, 2) != 1)
+    {
+      PyErr_SetString(PyExc_ValueError,
+                      "strip must be a uint8 array of shape (rows, w, 4), "
+                      "with contiguous pixels");
+      return NULL;
+    }
+    const int rows = PyArray_DIM(arr, 0);
+    if (y + rows > height) {
+      PyErr_Format(PyExc_ValueError, "too many rows: %d+%d of %d",
+                   y, rows, height);
+      return NULL;
+    }
+    png_bytep p = (png_bytep)PyArray_DATA(arr);
+    const npy_intp rowstride = PyArray_STRIDE(arr, 0);
+    bool success;
+    Py_BEGIN_ALLOW_THREADS
+    success = write_rows(p, rowstride, rows);
+    Py_END_ALLOW_THREADS
+    if (!success) {
+      return raise_error();
+    }
+    y += rows;
+    Py_RETURN_NONE;
+  }
+
+  PyObject *
+  close()
+  {
+    if (!check_usable()) {
+      return NULL;
+    }
+    if (y != height) {
+      PyErr_Format(PyExc_RuntimeError, "only %d of %d rows were written",
+                   y, height);
+      cleanup();
+      return NULL;
+    }
+    bool success;
+    Py_BEGIN_ALLOW_THREADS
+    success = write_end();
+    Py_END_ALLOW_THREADS
+    if (!success) {
+      return raise_error();
+    }
+    PyObject *result = PyString_FromStringAndSize(state->data.data(),
+                                                  state->data.size());
+    cleanup();
+    return result;
+  }
+};
+
 #ifndef SWIG
 static void
 png_read_error_callback (png_structp png_read_ptr,
@@ -92,6 +92,24 @@ class Rect (object):
     def __repr__(self):
         return 'Rect(%d, %d, %d, %d)' % (self.x, self.y, self.w, self.h)
 
+def union_redraw_bbox(a, b):
+    """Union of two ``(x, y, w, h)`` redraw areas, as a tuple
+
+    Redraw areas with a zero width or height mean "redraw everything",
+    so they absorb anything else.
+
+    >>> union_redraw_bbox((0, 0, 10, 10), (20, 0, 10, 10))
+    (0, 0, 30, 10)
+    >>> union_redraw_bbox((0, 0, 10, 10), (0, 0, 0, 0))
+    (0, 0, 0, 0)
+    """
+    a = Rect(*a)
+    b = Rect(*b)
+    if a.empty() or b.empty():
+        return (0, 0, 0, 0)
+    a.expandToIncludeRect(b)
+    return tuple(a)
+
 def rotated_rectangle_bbox(corners):
     list_y = [y for (x, y) in corners]
     list_x = [x for (x, y) in corners]
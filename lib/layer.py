@@ -31,6 +31,7 @@ from gi.repository import GdkPixbuf
 
 import re
 import struct
+import itertools
 import zlib
 import numpy
 from numpy import *
@@ -54,7 +55,8 @@ import pixbufsurface
 import strokemap
 import mypaintlib
 import helpers
-from observable import event
+import orasave
+from observable import event, coalesced
 
 from tiledsurface import OPENRASTER_COMBINE_MODES
 from tiledsurface import DEFAULT_COMBINE_MODE
@@ -76,6 +78,10 @@ MODES_EFFECTIVE_AT_ZERO_ALPHA = {
     m for m in range(mypaintlib.NumCombineModes)
     if mypaintlib.combine_mode_get_info(m).get("zero_alpha_has_effect")}
 
+#: Source of `SurfaceBackedLayer.content_generation` values, unique
+#: across all layers so that they can identify layer data on their own
+_CONTENT_GENERATIONS = itertools.count(1)
+
 
 ## Class defs
 
@@ -619,6 +625,24 @@ class LayerBase (object):
         """
         pass
 
+    def get_render_ops(self, layers=None, previewing=None, solo=None):
+        """Flattened compositing operations equivalent to `composite_tile()`
+
+        :param layers: the set of layers to render, as for composite_tile()
+        :param previewing: the layer currently being previewed
+        :param solo: the layer currently being shown solo
+        :returns: render plan steps, for `mypaintlib.tile_combine_plan()`
+        :rtype: list
+
+        Each step is an ``(op, surface, mode, opacity)`` tuple. For
+        ``mypaintlib.RenderPlanCombine`` steps, the surface supplies the
+        source tile via its ``get_combine_src()`` method. The other ops
+        begin and end isolated groups, and have no surface.
+
+        The base implementation returns an empty list.
+        """
+        return []
+
 
     def render_as_pixbuf(self, *rect, **kwargs):
         """Renders this layer as a pixbuf
@@ -850,6 +874,10 @@ class _LayerBaseSnapshot (object):
         layer.visible = self.visible
         layer.locked = self.locked
 
+    def get_surface_snapshots(self):
+        """Returns the tiled surface snapshots held, for undo accounting"""
+        return []
+
 
 class LoadError (Exception):
     """Raised when loading to indicate that a layer cannot be loaded"""
@@ -1222,6 +1250,37 @@ class LayerStack (LayerBase):
                                      layers=layers, previewing=p, solo=s,
                                      **kwargs)
 
+    def get_render_ops(self, layers=None, previewing=None, solo=None):
+        """Flattened compositing operations equivalent to `composite_tile()`"""
+        mode = self.mode
+        opacity = self.opacity
+        if layers is not None:
+            if self not in layers:
+                return []
+            if self in (previewing, solo):
+                layers.update(self._layers)
+        elif not self.visible:
+            return []
+        isolate = self.isolated or self.get_auto_isolation()
+        if isolate and previewing and self is not previewing:
+            isolate = False
+        if isolate and solo and self is not solo:
+            isolate = False
+        ops = []
+        if isolate:
+            ops.append((mypaintlib.RenderPlanPush, None,
+                        DEFAULT_COMBINE_MODE, 0.0))
+        for layer in reversed(self._layers):
+            p = (self is previewing) and layer or previewing
+            s = (self is solo) and layer or solo
+            ops.extend(layer.get_render_ops(layers, p, s))
+        if isolate:
+            if previewing or solo:
+                mode = DEFAULT_COMBINE_MODE
+                opacity = 1.0
+            ops.append((mypaintlib.RenderPlanPop, None, mode, opacity))
+        return ops
+
     def render_as_pixbuf(self, *args, **kwargs):
         return pixbufsurface.render_as_pixbuf(self, *args, **kwargs)
 
@@ -1262,6 +1321,12 @@ class LayerStack (LayerBase):
             kwargs['alpha'] = True
         pixbufsurface.save_as_png(self, filename, *rect, **kwargs)
 
+    def encode_as_png(self, *rect, **kwargs):
+        """Encode as PNG data, like `save_as_png()`"""
+        if 'alpha' not in kwargs:
+            kwargs['alpha'] = True
+        return pixbufsurface.encode_as_png(self, *rect, **kwargs)
+
 
     def save_to_openraster(self, orazip, tmpdir, path,
                            canvas_bbox, frame_bbox, **kwargs):
@@ -1336,6 +1401,12 @@ class _LayerStackSnapshot (_LayerBaseSnapshot):
             child.load_snapshot(snap)
             layer._layers.append(child)
 
+    def get_surface_snapshots(self):
+        sshots = []
+        for snap in self.layer_snaps:
+            sshots.extend(snap.get_surface_snapshots())
+        return sshots
+
 
 class LayerStackMove (object):
     """Move object wrapper for layer stacks"""
@@ -1418,6 +1489,8 @@ class RootLayerStack (LayerStack):
         self._current_layer_previewing = False
         # Current layer
         self._current_path = ()
+        # Path index: id(layer) -> (layer, parent, index in parent)
+        self._path_index = {}
 
     def clear(self):
         """Clear the layer and set the default background"""
@@ -1541,14 +1614,40 @@ class RootLayerStack (LayerStack):
             previewing = self.current
         if self._current_layer_solo:
             solo = self.current
-        # Blit loop. Could this be done in C++?
-        for tx, ty in tiles:
-            with surface.tile_request(tx, ty, readonly=False) as dst:
-                self.composite_tile(dst, dst_has_alpha, tx, ty,
-                                    mipmap_level, layers=layers,
-                                    background=background,
-                                    overlay=overlay,
-                                    previewing=previewing, solo=solo)
+        # Flatten the stack into a render plan once, then composite each
+        # tile with a single native call, reusing one 15-bit buffer.
+        plan = []
+        for layer in reversed(self):
+            plan.extend(layer.get_render_ops(layers, previewing, solo))
+        if overlay:
+            plan.extend(overlay.get_render_ops(set([overlay]), previewing,
+                                               solo))
+        if background:
+            background_surface = self._background_layer._surface
+        else:
+            background_surface = self._blank_bg_surface
+        combine_op = mypaintlib.RenderPlanCombine
+        N = tiledsurface.N
+        tmp = numpy.empty((N, N, 4), dtype='uint16')
+        # Mipmaps being rebuilt in the background may be drawn from their
+        # stale data, to be redrawn when they're ready.
+        with tiledsurface.mipmap_scheduler.deferred():
+            for tx, ty in tiles:
+                background_surface.blit_tile_into(tmp, dst_has_alpha, tx, ty,
+                                                  mipmap_level)
+                steps = []
+                for op, surf, mode, opacity in plan:
+                    src = None
+                    if op == combine_op:
+                        src = surf.get_combine_src(tx, ty, mipmap_level,
+                                                   opacity, mode)
+                    steps.append((op, src, mode, opacity))
+                mypaintlib.tile_combine_plan(steps, tmp, dst_has_alpha)
+                with surface.tile_request(tx, ty, readonly=False) as dst:
+                    if dst_has_alpha:
+                        mypaintlib.tile_convert_rgba16_to_rgba8(tmp, dst)
+                    else:
+                        mypaintlib.tile_convert_rgbu16_to_rgbu8(tmp, dst)
 
     def render_thumbnail(self, bbox, **options):
         """Renders a 256x256 thumbnail of the stack
@@ -2408,38 +2507,120 @@ class RootLayerStack (LayerStack):
         """
         if layer is self:
             raise ValueError("Cannot remove the root stack")
+        path = self.deepindex(layer)
+        if path is None:
+            raise ValueError("Layer is not in the root stack or "
+                             "any descendent")
         old_current = self.current_path
-        for path, descendent_layer in self.deepenumerate():
-            assert len(path) > 0
-            if descendent_layer is not layer:
-                continue
-            parent_path = path[:-1]
-            if len(parent_path) == 0:
-                parent = self
-            else:
-                parent = self.deepget(parent_path)
-            parent.remove(layer)
-            self.current_path = old_current # i.e. nearest remaining
-            return None
-        raise ValueError("Layer is not in the root stack or "
-                         "any descendent")
+        parent = self.deepget(path[:-1])
+        parent.remove(layer)
+        self.current_path = old_current # i.e. nearest remaining
+
+
+    def restack(self, moves):
+        """Moves layers around the tree in one batch
+
+        :param moves: ``(layer, parent, index)`` tuples. Each layer is
+          removed from wherever it is in the tree, and then inserted
+          into the parent stack before the index, in the order given.
+          Layers which aren't in the tree yet are just inserted.
+
+        Structure notifications are sent for each removal and insertion
+        as usual, but content change notifications are aggregated into
+        one for the whole batch.
 
+        >>> stack, leaves = _make_test_stack()
+        >>> group0, group1 = stack
+        >>> stack.restack([(group1, stack, 0), (leaves[0], group1, 3)])
+        >>> [stack.deepindex(l) for l in leaves]
+        [(0, 3), (1, 0), (1, 1), (0, 0), (0, 1), (0, 2)]
+        """
+        redraws = []
+        # Remove later siblings and descendents first, so that the
+        # paths of the layers not yet removed stay valid.
+        removals = []
+        for layer, parent, index in moves:
+            path = self.deepindex(layer)
+            if path is not None:
+                removals.append(path)
+        removals.sort(reverse=True)
+        for path in removals:
+            oldparent = self.deepget(path[:-1])
+            oldindex = path[-1]
+            removed = oldparent._layers.pop(oldindex)
+            oldparent._notify_disown(removed, oldindex)
+            redraws.append(removed.get_full_redraw_bbox())
+        for layer, parent, index in moves:
+            index = parent._normidx(index, insert=True)
+            parent._layers.insert(index, layer)
+            parent._notify_adopt(layer, index)
+            redraws.append(layer.get_full_redraw_bbox())
+        if redraws:
+            self._content_changed_aggregated(redraws)
 
     def deepindex(self, layer):
-        """Return a path for a layer by searching the stack tree
+        """Return a path for a layer, using the path index
 
         >>> stack, leaves = _make_test_stack()
         >>> stack.deepindex(stack)
         ()
         >>> [stack.deepindex(l) for l in leaves]
         [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2)]
+
+        The index records each layer's parent and position when it is
+        inserted. Positions shifted by later insertions and removals
+        are renumbered when next looked up, one stack at a time, so a
+        lookup usually costs time in proportion to the layer's depth.
+
+        >>> stack.deepget([0]).insert(0, PaintingLayer())
+        >>> stack.deeppop([1, 1]) is leaves[4]
+        True
+        >>> [stack.deepindex(l) for l in leaves]
+        [(0, 1), (0, 2), (0, 3), (1, 0), None, (1, 1)]
         """
         if layer is self:
             return ()
-        for path, ly in self.walk():
-            if ly is layer:
-                return tuple(path)
-        return None
+        path = self._lookup_path(layer)
+        if path is None:
+            # Stacks can be rebuilt without notifications, e.g. by
+            # loading snapshots, so fall back to indexing everything.
+            self._reindex()
+            path = self._lookup_path(layer)
+        return path
+
+    def _lookup_path(self, layer):
+        """Path of a layer from the index, or None if it isn't there"""
+        index = self._path_index
+        path = []
+        while layer is not self:
+            entry = index.get(id(layer))
+            if entry is None or entry[0] is not layer:
+                return None
+            layer, parent, i = entry
+            siblings = parent._layers
+            if i >= len(siblings) or siblings[i] is not layer:
+                self._index_children(parent)
+                i = index[id(layer)][2]
+                if i >= len(siblings) or siblings[i] is not layer:
+                    return None
+            path.append(i)
+            layer = parent
+        path.reverse()
+        return tuple(path)
+
+    def _index_children(self, parent):
+        """Renumbers the path index entries for a stack's children"""
+        index = self._path_index
+        for i, child in enumerate(parent._layers):
+            index[id(child)] = (child, parent, i)
+
+    def _reindex(self):
+        """Rebuilds the path index from the whole tree"""
+        self._path_index = {}
+        self._index_children(self)
+        for path, layer in self.walk():
+            if isinstance(layer, LayerStack):
+                self._index_children(layer)
 
 
     ## Convenience methods for commands
@@ -2715,6 +2896,7 @@ class RootLayerStack (LayerStack):
                 if backdrop_layers:
                     dst[:,:,3] = 0 # minimize alpha (discard original)
                     mypaintlib.tile_flat2rgba(dst, bd)
+        dstsurf.remove_empty_tiles()  # also makes flat tiles solid
         return dstlayer
 
     def get_merge_down_target(self, path):
@@ -2912,8 +3094,15 @@ class RootLayerStack (LayerStack):
     ## Notification mechanisms
 
     @event
+    @coalesced(key=lambda layer, *bbox: id(layer),
+               merge=lambda a, b: a[:1] + helpers.union_redraw_bbox(a[1:],
+                                                                    b[1:]))
     def layer_content_changed(self, *args):
-        """Event: notifies that sub-layer's pixels have changed"""
+        """Event: notifies that sub-layer's pixels have changed
+
+        In a `lib.observable.batch_updates()` context, the changes to
+        each layer are merged into one call.
+        """
 
     def _notify_layer_properties_changed(self, layer, changed):
         if layer is self:
@@ -2924,12 +3113,22 @@ class RootLayerStack (LayerStack):
         self.layer_properties_changed(path, layer, changed)
 
     @event
+    @coalesced(key=lambda path, layer, changed: id(layer),
+               merge=lambda a, b: (b[0], b[1], a[2] | b[2]))
     def layer_properties_changed(self, path, layer, changed):
-        """Event: notifies that a sub-layer's properties have changed"""
+        """Event: notifies that a sub-layer's properties have changed
+
+        In a `lib.observable.batch_updates()` context, the changes to
+        each layer are merged into one call, with the union of the
+        changed property names.
+        """
 
     def _notify_layer_deleted(self, parent, oldchild, oldindex):
         assert parent.root is self
         assert oldchild.root is not self
+        entry = self._path_index.get(id(oldchild))
+        if entry is not None and entry[0] is oldchild:
+            del self._path_index[id(oldchild)]
         path = self.deepindex(parent)
         assert path is not None, "Unable to find parent of deleted child"
         path = path + (oldindex,)
@@ -2942,6 +3141,7 @@ class RootLayerStack (LayerStack):
     def _notify_layer_inserted(self, parent, newchild, newindex):
         assert parent.root is self
         assert newchild.root is self
+        self._path_index[id(newchild)] = (newchild, parent, newindex)
         path = self.deepindex(newchild)
         assert path is not None, "Unable to find child which was inserted"
         assert len(path) > 0
@@ -3001,10 +3201,20 @@ class SurfaceBackedLayer (LayerBase):
         # Only connect observers if using the default tiled surface
         if surface is None:
             self._surface = tiledsurface.Surface()
-            self._surface.observers.append(self._content_changed)
+            self._surface.observers.append(self._surface_changed)
         else:
             self._surface = surface
 
+        #: Surface data still being decoded by a lib.oraload loader
+        self._pending_load = None
+
+        #: Changes whenever the layer's data changes
+        self.content_generation = next(_CONTENT_GENERATIONS)
+
+        #: Where the layer's data was last saved or loaded, as
+        #: lib.orasave.SavedMember records by name
+        self._ora_members = {}
+
     def load_from_surface(self, surface):
         """Load the backing surface image's tiles from another surface"""
         self._surface.load_from_surface(surface)
@@ -3014,13 +3224,24 @@ class SurfaceBackedLayer (LayerBase):
         strokeshape.render_to_surface(self._surface)
 
 
+    ## Notifications
+
+    def _surface_changed(self, *args):
+        """Updates the content generation, and notifies the root"""
+        self.content_generation = next(_CONTENT_GENERATIONS)
+        self._content_changed(*args)
+
+
     ## Loading
 
     def load_from_openraster(self, orazip, elem, tempdir, feedback_cb,
-                             x=0, y=0, extract_and_keep=False, **kwargs):
+                             x=0, y=0, extract_and_keep=False, loader=None,
+                             **kwargs):
         """Loads layer flags and bitmap/surface data from a .ora zipfile
 
         :param extract_and_keep: Set to true to extract and keep a copy
+        :param loader: Optional lib.oraload.ProgressiveLoader to decode
+          PNG data with later, instead of now
 
         The normal behaviour is to load the data file directly from `orazip`
         without using a temporary file.  If `extract_and_keep` is set, an
@@ -3029,7 +3250,7 @@ class SurfaceBackedLayer (LayerBase):
             os.path.join(tempdir, elem.attrib["src"])
 
         and reads from that. The caller is then free to do what it likes with
-        this file.
+        this file. It takes precedence over `loader`.
         """
         # Load layer flags
         super(SurfaceBackedLayer, self) \
@@ -3053,9 +3274,24 @@ class SurfaceBackedLayer (LayerBase):
             orazip.extract(src, path=tempdir)
             tmp_filename = os.path.join(tempdir, src)
             self.load_surface_from_pixbuf_file(tmp_filename, x, y, feedback_cb)
+        elif loader is not None and src_ext == ".png":
+            datafp = _open_zipfile_member(orazip, src)
+            data = datafp.read()
+            datafp.close()
+            self._surface.clear()
+            self._pending_load = loader.add(self, data, x, y)
         else:
             pixbuf = pixbuf_from_zipfile(orazip, src, feedback_cb=feedback_cb)
             self.load_surface_from_pixbuf(pixbuf, x=x, y=y)
+        # Data loaded off the tile grid is encoded again when saved,
+        # because strokemaps can only be saved at tile-aligned offsets.
+        N = tiledsurface.N
+        if not extract_and_keep and x % N == 0 and y % N == 0:
+            record = orasave.SavedMember.from_zipfile(orazip, src,
+                                                      origin=(x, y))
+            if record is not None:
+                self._ora_members["layer"] = record
+            self._complete_loaded_members()
         t1 = time.time()
         logger.debug('%.3fs loading and converting src %r for %r',
                      t1 - t0, src_ext, src_rootname)
@@ -3078,6 +3314,36 @@ class SurfaceBackedLayer (LayerBase):
         self.load_from_surface(surface)
         return bbox
 
+
+    def load_surface_tiles(self, tiles):
+        """Loads the layer's surface from decoded tiles, ending a pending load
+
+        :param dict tiles: new tiles, keyed by position
+
+        This is called by `lib.oraload` loaders once the data passed to
+        them by `load_from_openraster()` has been decoded.
+        """
+        self._pending_load = None
+        self._surface.load_tiles(tiles)
+        self._complete_loaded_members()
+
+
+    def _complete_loaded_members(self):
+        """Keys the records of data loaded, once loading is complete"""
+        if self._pending_load is not None:
+            return
+        record = self._ora_members.get("layer")
+        if record is not None and record.key is None:
+            rect = tuple(self.get_bbox())
+            record.key = (self.content_generation, rect, ())
+
+
+    def finish_loading(self):
+        """Completes any pending load of the layer's surface synchronously"""
+        job = self._pending_load
+        if job is not None:
+            job.loader.finish([job])
+
     def clear(self):
         """Clears the layer"""
         self._surface.clear()
@@ -3100,11 +3366,15 @@ class SurfaceBackedLayer (LayerBase):
 
     def get_bbox(self):
         """Returns the inherent bounding box of the surface, tile aligned"""
+        if self._pending_load is not None:
+            return self._pending_load.bbox.copy()
         return self._surface.get_bbox()
 
 
     def is_empty(self):
         """Tests whether the surface is empty"""
+        if self._pending_load is not None:
+            return self._pending_load.bbox.empty()
         return self._surface.is_empty()
 
 
@@ -3166,6 +3436,20 @@ class SurfaceBackedLayer (LayerBase):
                                       mipmap_level=mipmap_level,
                                       opacity=opacity, mode=mode )
 
+    def get_render_ops(self, layers=None, previewing=None, solo=None):
+        """Flattened compositing operations equivalent to `composite_tile()`"""
+        mode = self.mode
+        opacity = self.opacity
+        if layers is not None:
+            if self not in layers:
+                return []
+        elif not self.visible:
+            return []
+        if self is previewing:
+            mode = DEFAULT_COMBINE_MODE
+            opacity = 1.0
+        return [(mypaintlib.RenderPlanCombine, self._surface, mode, opacity)]
+
     def render_as_pixbuf(self, *rect, **kwargs):
         """Renders this layer as a pixbuf"""
         return self._surface.render_as_pixbuf(*rect, **kwargs)
@@ -3185,6 +3469,7 @@ class SurfaceBackedLayer (LayerBase):
         additional functionality for moving things other than the surface tiles
         around.
         """
+        self.finish_loading()
         return self._surface.get_move(x, y)
 
 
@@ -3202,6 +3487,17 @@ class SurfaceBackedLayer (LayerBase):
         self._surface.save_as_png(filename, *rect, **kwargs)
 
 
+    def encode_as_png(self, *rect, **kwargs):
+        """Encode as PNG data, like `save_as_png()`
+
+        :param *rect: rectangle to encode, as a 4-tuple
+        :param **kwargs: passed to pixbufsurface.encode_as_png()
+        :returns: the PNG data, or a job producing it (see `kwargs`)
+        :rtype: str or lib.orasave.EncoderPool job
+        """
+        return self._surface.encode_as_png(*rect, **kwargs)
+
+
     def save_to_openraster(self, orazip, tmpdir, path,
                            canvas_bbox, frame_bbox, **kwargs):
         """Saves the layer's data into an open OpenRaster ZipFile"""
@@ -3221,21 +3517,37 @@ class SurfaceBackedLayer (LayerBase):
 
     def _save_rect_to_ora( self, orazip, tmpdir, prefix, path,
                            frame_bbox, rect, **kwargs ):
-        """Internal: saves a rectangle of the surface to an ORA zip"""
-        # Write PNG data via a tempfile
+        """Internal: saves a rectangle of the surface to an ORA zip
+
+        If `orazip` is a `lib.orasave.OraZipFile`, and the layer's data
+        is unchanged since it was last saved or loaded, the PNG is
+        copied from the previous file rather than being encoded again.
+        Otherwise the surface is rendered here, and compressed on the
+        zipfile's encoder threads.
+        """
         pngname = self._make_refname(prefix, path, ".png")
-        pngpath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self.save_as_png(pngpath, *rect, **kwargs)
-        t1 = time.time()
-        logger.debug('%.3fs surface saving %r', t1-t0, pngname)
-        # Archive and remove
         storepath = "data/%s" % (pngname,)
-        orazip.write(pngpath, storepath)
-        os.remove(pngpath)
+        key = (self.content_generation, tuple(rect),
+               orasave.options_key(kwargs))
+        record = orasave.reuse(orazip, self._ora_members, prefix, key,
+                               storepath)
+        if record is None:
+            t0 = time.time()
+            encoder = orasave.get_encoder(orazip)
+            data = self.encode_as_png(*rect, encoder=encoder, **kwargs)
+            t1 = time.time()
+            logger.debug('%.3fs surface rendering %r', t1-t0, pngname)
+            orasave.write_file_str(orazip, storepath, data)
+            orasave.remember(orazip, self._ora_members, prefix, key,
+                             storepath)
         # Return details
         elem = self._get_stackxml_element(frame_bbox, "layer")
         elem.attrib["src"] = storepath
+        if record is not None and record.origin is not None:
+            # Loaded data keeps the position it was loaded at
+            x0, y0 = frame_bbox[0:2]
+            elem.attrib["x"] = str(record.origin[0] - x0)
+            elem.attrib["y"] = str(record.origin[1] - y0)
         return elem
 
 
@@ -3257,6 +3569,19 @@ class SurfaceBackedLayer (LayerBase):
         """Snapshots the state of the layer, for undo purposes"""
         return _SurfaceBackedLayerSnapshot(self)
 
+    def load_snapshot_tiles(self, sshot, tiles):
+        """Restores the layer from a snapshot, loading only some tiles
+
+        :param sshot: a snapshot of this layer, from save_snapshot()
+        :param tiles: positions of the only tiles which can differ from
+          the snapshot, for example the ones which a stroke changed
+
+        This costs time in proportion to the number of tiles given,
+        rather than to the size of the layer. Only the area of the tiles
+        which actually changed is redrawn.
+        """
+        sshot.restore_to_layer(self, tiles=tiles)
+
 
     ## Trimming
 
@@ -3288,11 +3613,24 @@ class _SurfaceBackedLayerSnapshot (_LayerBaseSnapshot):
 
     def __init__(self, layer):
         super(_SurfaceBackedLayerSnapshot, self).__init__(layer)
+        layer.finish_loading()  # tiles arriving later can't be undone
         self.surface_sshot = layer._surface.save_snapshot()
 
-    def restore_to_layer(self, layer):
+    def restore_to_layer(self, layer, tiles=None):
         super(_SurfaceBackedLayerSnapshot, self).restore_to_layer(layer)
-        layer._surface.load_snapshot(self.surface_sshot)
+        layer._surface.load_snapshot(self.surface_sshot, tiles=tiles)
+
+    def get_surface_snapshots(self):
+        return [self.surface_sshot]
+
+    def diff(self, other):
+        """Returns the positions of the tiles differing in another snapshot
+
+        :param _SurfaceBackedLayerSnapshot other: a snapshot of the same
+          layer
+        :rtype: set
+        """
+        return self.surface_sshot.tiledict.diff(other.surface_sshot.tiledict)
 
 
 class BackgroundLayer (SurfaceBackedLayer):
@@ -3333,6 +3671,7 @@ class BackgroundLayer (SurfaceBackedLayer):
         """Sets the surface from a tiledsurface.Background"""
         assert isinstance(surface, tiledsurface.Background)
         self._surface = surface
+        self.content_generation = next(_CONTENT_GENERATIONS)
 
     def save_to_openraster(self, orazip, tmpdir, path,
                            canvas_bbox, frame_bbox, **kwargs):
@@ -3353,14 +3692,13 @@ class BackgroundLayer (SurfaceBackedLayer):
         rect = (x+x0, y+y0, w, h)
 
         pngname = self._make_refname("background", path, "tile.png")
-        tmppath = os.path.join(tmpdir, pngname)
         t0 = time.time()
-        self._surface.save_as_png(tmppath, *rect, **kwargs)
+        data = self._surface.encode_as_png(
+            *rect, encoder=orasave.get_encoder(orazip), **kwargs)
         t1 = time.time()
         storename = 'data/%s' % (pngname,)
-        logger.debug('%.3fs surface saving %s', t1 - t0, storename)
-        orazip.write(tmppath, storename)
-        os.remove(tmppath)
+        logger.debug('%.3fs surface rendering %s', t1 - t0, storename)
+        orasave.write_file_str(orazip, storename, data)
         elem.attrib['background_tile'] = storename
         return elem
 
@@ -3494,8 +3832,8 @@ class _ExternalLayerSnapshot (_SurfaceBackedLayerSnapshot):
         self.x = layer._x
         self.y = layer._y
 
-    def restore_to_layer(self, layer):
-        super(_ExternalLayerSnapshot, self).restore_to_layer(layer)
+    def restore_to_layer(self, layer, tiles=None):
+        super(_ExternalLayerSnapshot, self).restore_to_layer(layer, tiles)
         layer._basename = self._copy_working_file( self.basename,
                                                    self.workdir )
         layer._workdir = self.workdir
@@ -3597,6 +3935,7 @@ class PaintingLayer (SurfaceBackedLayer):
         #: List of strokemap.StrokeShape instances (not stroke.Stroke), ordered
         #: by depth.
         self.strokes = []
+        self._stroke_index = strokemap.StrokeIndex()
 
 
     def clear(self):
@@ -3632,6 +3971,20 @@ class PaintingLayer (SurfaceBackedLayer):
             t3 = time.time()
             logger.debug('%.3fs loading strokemap %r',
                          t3 - t2, strokemap_name)
+            record = orasave.SavedMember.from_zipfile(orazip, strokemap_name,
+                                                      origin=(x, y))
+            if record is not None:
+                self._ora_members["strokemap"] = record
+            self._complete_loaded_members()
+
+
+    def _complete_loaded_members(self):
+        """Keys the records of data loaded, once loading is complete"""
+        super(PaintingLayer, self)._complete_loaded_members()
+        record = self._ora_members.get("strokemap")
+        if self._pending_load is None and record is not None:
+            if record.key is None:
+                record.key = (self.content_generation, record.origin)
 
 
     ## Flood fill
@@ -3722,6 +4075,7 @@ class PaintingLayer (SurfaceBackedLayer):
         shape.init_from_snapshots(before.surface_sshot, after_sshot)
         shape.brush_string = stroke.brush_settings
         self.strokes.append(shape)
+        self.content_generation = next(_CONTENT_GENERATIONS)
 
 
     ## Snapshots
@@ -3753,6 +4107,7 @@ class PaintingLayer (SurfaceBackedLayer):
         for stroke in empty_strokes:
             logger.debug("Removing emptied stroke %r", stroke)
             self.strokes.remove(stroke)
+        self._stroke_index.invalidate()
 
     ## Strokemap
 
@@ -3765,6 +4120,7 @@ class PaintingLayer (SurfaceBackedLayer):
         y = int(translate_y//N) * N
         dx = translate_x % N
         dy = translate_y % N
+        loaded = []
         while True:
             t = f.read(1)
             if t == 'b':
@@ -3777,22 +4133,21 @@ class PaintingLayer (SurfaceBackedLayer):
                 tmp = f.read(length)
                 stroke.init_from_string(tmp, x, y)
                 stroke.brush_string = brushes[brush_id]
-                # Translate non-aligned strokes
-                if (dx, dy) != (0, 0):
-                    stroke.translate(dx, dy)
-                self.strokes.append(stroke)
+                loaded.append(stroke)
             elif t == '}':
                 break
             else:
                 assert False, 'invalid strokemap'
+        # Translate non-aligned strokes, all together
+        if (dx, dy) != (0, 0):
+            strokemap.translate_shapes(loaded, dx, dy)
+        self.strokes.extend(loaded)
 
 
     def get_stroke_info_at(self, x, y):
         """Get the stroke at the given point"""
         x, y = int(x), int(y)
-        for s in reversed(self.strokes):
-            if s.touches_pixel(x, y):
-                return s
+        return self._stroke_index.get_stroke_at(self.strokes, x, y)
 
 
     def get_last_stroke_info(self):
@@ -3803,18 +4158,13 @@ class PaintingLayer (SurfaceBackedLayer):
 
     ## Saving
 
-    @staticmethod
-    def _write_file_str(z, filename, data):
-        """Helper: write data to a zipfile with the right permissions"""
-        # Work around a permission bug in the zipfile library:
-        # http://bugs.python.org/issue3394
-        zi = zipfile.ZipInfo(filename)
-        zi.external_attr = 0100644 << 16
-        z.writestr(zi, data)
-
     def _save_strokemap_to_file(self, f, translate_x, translate_y):
+        self._write_strokemap(f, self.strokes, translate_x, translate_y)
+
+    @staticmethod
+    def _write_strokemap(f, strokes, translate_x, translate_y):
         brush2id = {}
-        for stroke in self.strokes:
+        for stroke in strokes:
             s = stroke.brush_string
             # save brush (if not already known)
             if s not in brush2id:
@@ -3830,6 +4180,17 @@ class PaintingLayer (SurfaceBackedLayer):
             f.write(s)
         f.write('}')
 
+    @classmethod
+    def _encode_strokemap(cls, strokes, translate_x, translate_y):
+        """Returns strokemap data as a str (thread-safe)"""
+        sio = StringIO()
+        t0 = time.time()
+        cls._write_strokemap(sio, strokes, translate_x, translate_y)
+        data = sio.getvalue()
+        sio.close()
+        logger.debug("%.3fs strokemap encoding", time.time() - t0)
+        return data
+
 
     def save_to_openraster(self, orazip, tmpdir, path,
                            canvas_bbox, frame_bbox, **kwargs):
@@ -3839,18 +4200,29 @@ class PaintingLayer (SurfaceBackedLayer):
         elem = super(PaintingLayer, self)\
             .save_to_openraster( orazip, tmpdir, path,
                                  canvas_bbox, frame_bbox, **kwargs )
-        # Store stroke shape data too
-        x, y, w, h = self.get_bbox()
-        sio = StringIO()
-        t0 = time.time()
-        self._save_strokemap_to_file(sio, -x, -y)
-        t1 = time.time()
-        data = sio.getvalue()
-        sio.close()
+        # Store stroke shape data too, relative to the PNG's position
+        x = int(elem.attrib["x"]) + frame_bbox[0]
+        y = int(elem.attrib["y"]) + frame_bbox[1]
         datname = self._make_refname("layer", path, "strokemap.dat")
-        logger.debug("%.3fs strokemap saving %r", t1-t0, datname)
         storepath = "data/%s" % (datname,)
-        self._write_file_str(orazip, storepath, data)
+        key = (self.content_generation, (x, y))
+        record = orasave.reuse(orazip, self._ora_members, "strokemap",
+                               key, storepath)
+        if record is None:
+            # Pending strokemap updates are idle tasks, so finish them
+            # here before serializing a copy of the list elsewhere.
+            strokes = self.strokes[:]
+            for stroke in strokes:
+                stroke.tasks.finish_all()
+            encoder = orasave.get_encoder(orazip)
+            if encoder is None:
+                data = self._encode_strokemap(strokes, -x, -y)
+            else:
+                data = encoder.submit(self._encode_strokemap,
+                                      strokes, -x, -y)
+            orasave.write_file_str(orazip, storepath, data)
+            orasave.remember(orazip, self._ora_members, "strokemap", key,
+                             storepath, (x, y))
         # Return details
         elem.attrib['mypaint_strokemap_v2'] = storepath
         return elem
@@ -3863,9 +4235,10 @@ class _PaintingLayerSnapshot (_SurfaceBackedLayerSnapshot):
         super(_PaintingLayerSnapshot, self).__init__(layer)
         self.strokes = layer.strokes[:]
 
-    def restore_to_layer(self, layer):
-        super(_PaintingLayerSnapshot, self).restore_to_layer(layer)
+    def restore_to_layer(self, layer, tiles=None):
+        super(_PaintingLayerSnapshot, self).restore_to_layer(layer, tiles)
         layer.strokes = self.strokes[:]
+        layer.content_generation = next(_CONTENT_GENERATIONS)
 
 
 class PaintingLayerMove (object):
@@ -3887,15 +4260,9 @@ class PaintingLayerMove (object):
         result = self._wrapped.cleanup()
         dx = self._final_dx
         dy = self._final_dy
-        # Arrange for the strokemap to be moved too;
-        # this happens in its own background idler.
-        for stroke in self._layer.strokes:
-            stroke.translate(dx, dy)
-            # Minor problem: huge strokemaps take a long time to move, and the
-            # translate must be forced to completion before drawing or any
-            # further layer moves. This can cause apparent hangs for no
-            # reason later on. Perhaps it would be better to process them
-            # fully in this hourglass-cursor phase after all?
+        # Move the strokemap too, all strokes in one bulk operation
+        self._layer._stroke_index.invalidate()
+        strokemap.translate_shapes(self._layer.strokes, dx, dy)
 
     def process(self, n=200):
         return self._wrapped.process(n)
@@ -3957,10 +4324,10 @@ def pixbuf_from_stream(fp, feedback_cb=None):
     return loader.get_pixbuf()
 
 
-def pixbuf_from_zipfile(datazip, filename, feedback_cb=None):
-    """Extract and return a GdkPixbuf from a zipfile entry"""
+def _open_zipfile_member(datazip, filename):
+    """Open a zipfile entry for reading, tolerating misencoded names"""
     try:
-        datafp = datazip.open(filename, mode='r')
+        return datazip.open(filename, mode='r')
     except KeyError:
         # Support for bad zip files (saved by old versions of the
         # GIMP ORA plugin)
@@ -3968,6 +4335,12 @@ def pixbuf_from_zipfile(datazip, filename, feedback_cb=None):
         logger.warning('Bad ZIP file. There is an utf-8 encoded '
                        'filename that does not have the utf-8 '
                        'flag set: %r', filename)
+        return datafp
+
+
+def pixbuf_from_zipfile(datazip, filename, feedback_cb=None):
+    """Extract and return a GdkPixbuf from a zipfile entry"""
+    datafp = _open_zipfile_member(datazip, filename)
     pixbuf = pixbuf_from_stream(datafp, feedback_cb=feedback_cb)
     datafp.close()
     return pixbuf
@@ -11,6 +11,8 @@
 
 import weakref
 import sys
+import threading
+import contextlib
 from warnings import warn
 import logging
 
@@ -259,6 +261,7 @@ class MethodWithObservers (object):
         self.func = func
         self.instance_weakref = weakref.ref(instance)
         self.calling_observers = False
+        self.coalesce = getattr(func, "coalesce", None)
         self.__name__ = func.__name__
         self.__doc__ = func.__doc__
         self._func_repr = _method_repr(instance=instance, func=func)
@@ -278,10 +281,26 @@ class MethodWithObservers (object):
         observed = self.instance_weakref()
 
         result = self.func(observed, *args, **kwargs)
+        del observed
+        batch = getattr(_batch_state, "batch", None)
+        if batch is not None and self.observers:
+            if self.coalesce is not None and not kwargs:
+                batch.add(self, args)
+                return result
+            # Keep the order of notifications which can't be merged
+            batch.flush()
+        self._call_observers(args, kwargs)
+        return result
+
+    def _call_observers(self, args, kwargs):
+        """Calls the observers, without calling the wrapped function"""
+        observed = self.instance_weakref()
+        if observed is None:
+            return
         if self.calling_observers:
             logger.debug("Recursive call to %r detected and skipped",
                          self)
-            return result
+            return
         self.calling_observers = True
         for observer in self.observers[:]:
             try:
@@ -291,7 +310,6 @@ class MethodWithObservers (object):
                 self.observers.remove(observer)
         del observed
         self.calling_observers = False
-        return result
 
     def __iadd__(self, observer):
         """Registers an observer with the method to be invoked after it
@@ -362,6 +380,136 @@ class event (observable):
         super(event, self).__init__(func)
 
 
+def coalesced(key, merge):
+    """Decorator for observable methods whose calls merge in batches
+
+    :param key: callable returning a key for a call's arguments
+    :param merge: callable taking the argument tuples of two calls with
+      the same key, the earlier one first, and returning a tuple of
+      arguments for a single call standing in for both
+
+    Inside `batch_updates()`, calls to observable methods decorated
+    with this are queued, and each queued call absorbs later calls with
+    the same key. Put it below ``@observable`` or ``@event``:
+
+    >>> class Canvas (object):
+    ...     @event
+    ...     @coalesced(key=lambda *a: None,
+    ...                merge=lambda a, b: (min(a[0], b[0]), max(a[1], b[1])))
+    ...     def modified(self, lo, hi):
+    ...         '''Event: a span of the canvas was modified'''
+    >>> canvas = Canvas()
+    >>> spans = []
+    >>> canvas.modified += lambda c, lo, hi: spans.append((lo, hi))
+    >>> with batch_updates():
+    ...     for i in range(200):
+    ...         canvas.modified(i, i+1)
+    ...     spans
+    []
+    >>> spans
+    [(0, 200)]
+    """
+    def _decorate(func):
+        func.coalesce = (key, merge)
+        return func
+    return _decorate
+
+
+class _Batch (object):
+    """Queue of merged observable calls, see `batch_updates()`"""
+
+    def __init__(self):
+        super(_Batch, self).__init__()
+        self.depth = 0
+        self._queue = []  # [wrapper, args], in order of first call
+        self._entries = {}  # (wrapper, key) -> queue entry
+        self._flushing = False
+
+    def add(self, wrapper, args):
+        """Queues a call, merging it into an earlier one if possible"""
+        key_func, merge = wrapper.coalesce
+        key = (wrapper, key_func(*args))
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[1] = merge(entry[1], args)
+        else:
+            entry = [wrapper, args]
+            self._entries[key] = entry
+            self._queue.append(entry)
+
+    def flush(self):
+        """Calls the observers of everything queued so far
+
+        Observers can make calls of their own while being called, and
+        ones which merge are queued up again, and delivered afterwards.
+        """
+        if self._flushing:
+            return
+        self._flushing = True
+        try:
+            while self._queue:
+                queue = self._queue
+                self._queue = []
+                self._entries = {}
+                for wrapper, args in queue:
+                    wrapper._call_observers(args, {})
+        finally:
+            self._flushing = False
+
+
+_batch_state = threading.local()
+
+
+@contextlib.contextmanager
+def batch_updates():
+    """Context manager: merges observer calls, and delivers them at the end
+
+    Calls to observable methods marked with `coalesced()` are queued
+    while the context is active, and their observers are called once
+    for each merged call when the outermost batch ends. Other observable
+    calls are delivered immediately, after anything queued before them,
+    so notifications still arrive in the order they were made. Batches
+    apply to the thread which started them, and can be nested.
+
+    >>> class Tester (object):
+    ...     @event
+    ...     @coalesced(key=lambda name: name, merge=lambda a, b: a)
+    ...     def touched(self, name):
+    ...         '''Event: a named thing was touched'''
+    ...     @event
+    ...     def added(self, name):
+    ...         '''Event: a named thing was added'''
+    >>> tester = Tester()
+    >>> calls = []
+    >>> tester.touched += lambda t, name: calls.append(("touched", name))
+    >>> tester.added += lambda t, name: calls.append(("added", name))
+    >>> with batch_updates():
+    ...     tester.touched("a")
+    ...     tester.touched("b")
+    ...     tester.touched("a")
+    ...     with batch_updates():
+    ...         tester.added("c")
+    ...     tester.touched("c")
+    ...     tester.touched("a")
+    >>> calls   # doctest: +NORMALIZE_WHITESPACE
+    [('touched', 'a'), ('touched', 'b'), ('added', 'c'),
+     ('touched', 'c'), ('touched', 'a')]
+    """
+    batch = getattr(_batch_state, "batch", None)
+    if batch is None:
+        batch = _batch_state.batch = _Batch()
+    batch.depth += 1
+    try:
+        yield batch
+    finally:
+        batch.depth -= 1
+        if batch.depth == 0:
+            try:
+                batch.flush()
+            finally:
+                _batch_state.batch = None
+
+
 def _wrap_observer(observer):
     """Factory function for the observers in a BoundObserverMethod"""
     if _is_bound_method(observer):
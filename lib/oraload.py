@@ -0,0 +1,276 @@
+# This file is part of MyPaint.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Progressive loading of OpenRaster layer pixels
+
+Decoding the layer PNGs is most of the work of opening an OpenRaster
+file. A `ProgressiveLoader` lets `lib.document.Document.load_ora()`
+return as soon as the layers tree and the x-sheet have been read, with
+the layers' surfaces still empty. Worker threads then decode the PNG
+data into tiles, and the tiles are handed over to the layers from the
+main loop when it is idle, since surfaces are not thread-safe.
+
+Layers with a load pending report the bounding box of their PNG, and
+complete their load synchronously before anything snapshots them, so
+painting, undo, and saving never see a half-loaded layer.
+"""
+
+import struct
+import threading
+import multiprocessing
+from cStringIO import StringIO
+import logging
+logger = logging.getLogger(__name__)
+
+from gi.repository import GObject
+
+import helpers
+import tiledsurface
+import pixbufsurface
+import layer
+
+N = tiledsurface.N
+
+#: Most worker threads used by a loader
+MAX_THREADS = 4
+
+_PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+
+class _LoadJob (object):
+    """A layer waiting for its PNG data to be decoded into tiles"""
+
+    def __init__(self, loader, layer, data, x, y, seq):
+        object.__init__(self)
+        self.loader = loader
+        self.layer = layer
+        self.data = data
+        self.x = x
+        self.y = y
+        self.seq = seq
+        self.tiles = None
+        self.bbox = _png_bbox(data, x, y)
+
+
+def _png_bbox(data, x, y):
+    """Tile-aligned bbox of PNG data placed at x, y, read from its header
+
+    >>> hdr = _PNG_SIGNATURE + struct.pack('>I4sII', 13, 'IHDR', N, 1)
+    >>> _png_bbox(hdr, -10, 0) == helpers.Rect(-N, 0, 2*N, N)
+    True
+    >>> _png_bbox('junk', 0, 0).empty()
+    True
+    """
+    if data[:8] != _PNG_SIGNATURE or data[12:16] != 'IHDR':
+        return helpers.Rect()
+    w, h = struct.unpack('>II', data[16:24])
+    if w <= 0 or h <= 0:
+        return helpers.Rect()
+    tx0, ty0 = x // N, y // N
+    tx1, ty1 = (x + w - 1) // N, (y + h - 1) // N
+    return helpers.Rect(tx0*N, ty0*N, (tx1-tx0+1)*N, (ty1-ty0+1)*N)
+
+
+def _decode_tiles(data, x, y):
+    """Decodes PNG data into a dict of new tiles, dropping empty ones"""
+    pixbuf = layer.pixbuf_from_stream(StringIO(data))
+    arr = helpers.gdkpixbuf2numpy(pixbuf)
+    h, w = arr.shape[:2]
+    tiles = {}
+    if h <= 0 or w <= 0:
+        return tiles
+    src = pixbufsurface.Surface(x, y, w, h, data=arr)
+    for tx, ty in src.get_tiles():
+        tile = tiledsurface.Tile()
+        src.blit_tile_into(tile.rgba, True, tx, ty)
+        tiles[tx, ty] = tile
+    return tiles
+
+
+class ProgressiveLoader (object):
+    """Decodes layer PNGs in the background, most wanted layers first
+
+    Jobs are queued with `add()` while the layers tree is being read,
+    and decoding begins with `start()`. Workers always take the queued
+    job ranking highest: first the layers named by `prioritize()`, such
+    as the cels of the current frame, then the layers overlapping the
+    visible area, then the rest in document order.
+    """
+
+    def __init__(self, threads=None):
+        """Initialize, with an optional number of worker threads"""
+        object.__init__(self)
+        if threads is None:
+            try:
+                threads = multiprocessing.cpu_count()
+            except NotImplementedError:
+                threads = 1
+            threads = max(1, min(threads, MAX_THREADS))
+        self._num_threads = threads
+        self._threads = []
+        self._cond = threading.Condition()
+        self._queued = []  # jobs not yet taken by a worker
+        self._busy = set()  # jobs being decoded
+        self._done = []  # decoded jobs waiting to be installed
+        self._seq = 0
+        self._priority_layers = set()  # ids of layers
+        self._bbox = None
+        self._idle_id = None
+        self._closed = False
+
+    ## Queueing and ranking
+
+    def add(self, layer, data, x, y):
+        """Queues PNG data for loading into a layer
+
+        :param layer: a SurfaceBackedLayer, with an empty surface
+        :param str data: the PNG file's contents
+        :param int x: X offset of the PNG data
+        :param int y: Y offset of the PNG data
+        :returns: the layer's pending load, see `finish()`
+        """
+        with self._cond:
+            job = _LoadJob(self, layer, data, x, y, self._seq)
+            self._seq += 1
+            self._queued.append(job)
+            self._cond.notify()
+        return job
+
+    def prioritize(self, layers=None, bbox=None):
+        """Sets which jobs the workers should take first
+
+        :param layers: the layers wanted most, e.g. the current cels
+        :param bbox: the visible area, in model coordinates
+        """
+        with self._cond:
+            if layers is not None:
+                self._priority_layers = set(id(l) for l in layers)
+            if bbox is not None:
+                self._bbox = helpers.Rect(*bbox)
+
+    def _rank(self, job):
+        in_view = self._bbox is None or job.bbox.overlaps(self._bbox)
+        return (id(job.layer) not in self._priority_layers,
+                not in_view, job.seq)
+
+    def _take(self):
+        job = min(self._queued, key=self._rank)
+        self._queued.remove(job)
+        self._busy.add(job)
+        return job
+
+    @property
+    def pending(self):
+        """Number of layers whose tiles have not been installed yet"""
+        with self._cond:
+            return len(self._queued) + len(self._busy) + len(self._done)
+
+    ## Decoding
+
+    def start(self):
+        """Starts the worker threads"""
+        while len(self._threads) < self._num_threads:
+            thread = threading.Thread(target=self._run,
+                                      name="ProgressiveLoader")
+            thread.daemon = True
+            self._threads.append(thread)
+            thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._queued or self._closed):
+                    self._cond.wait()
+                if self._closed:
+                    return
+                job = self._take()
+            tiles = self._decode(job)
+            with self._cond:
+                self._busy.discard(job)
+                self._cond.notify_all()
+                if self._closed:
+                    return
+                job.tiles = tiles
+                self._done.append(job)
+                if self._idle_id is None:
+                    self._idle_id = GObject.idle_add(self._idle_cb)
+
+    @staticmethod
+    def _decode(job):
+        try:
+            return _decode_tiles(job.data, job.x, job.y)
+        except Exception:
+            logger.exception("Failed to decode the PNG data for %r",
+                             job.layer)
+            return {}
+
+    ## Installing tiles (main thread only)
+
+    def _idle_cb(self):
+        with self._cond:
+            if not self._done or self._closed:
+                self._idle_id = None
+                return False
+            job = self._done.pop(0)
+        self._install(job)
+        return True
+
+    def _install(self, job):
+        tiles = job.tiles
+        job.tiles = job.data = None
+        job.layer.load_surface_tiles(tiles)
+
+    def finish(self, jobs=None):
+        """Completes loading synchronously
+
+        :param jobs: the pending loads to complete (default: all)
+
+        Queued jobs are decoded on the calling thread, and jobs being
+        decoded by a worker are waited for.
+        """
+        if jobs is None:
+            with self._cond:
+                jobs = self._queued + list(self._busy) + self._done
+        for job in jobs:
+            with self._cond:
+                queued = job in self._queued
+                if queued:
+                    self._queued.remove(job)
+                else:
+                    while job in self._busy:
+                        self._cond.wait()
+                    if job not in self._done:
+                        continue  # installed already, or cancelled
+                    self._done.remove(job)
+            if queued:
+                job.tiles = self._decode(job)
+            self._install(job)
+
+    def close(self):
+        """Cancels all pending loads, and stops the workers"""
+        with self._cond:
+            self._closed = True
+            del self._queued[:]
+            del self._done[:]
+            self._cond.notify_all()
+        if self._idle_id is not None:
+            GObject.source_remove(self._idle_id)
+            self._idle_id = None
+        self._threads = []
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
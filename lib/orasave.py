@@ -0,0 +1,440 @@
+# This file is part of MyPaint.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Incremental saving of OpenRaster files
+
+Rendering and encoding the layer PNGs is most of the work of saving an
+OpenRaster file, and most layers are usually unchanged since the file
+was last saved or loaded. Things written to an `OraZipFile` can be
+remembered in a dict of `SavedMember` records kept by their owner,
+together with a key such as the content generation of the layer they
+came from. When the next save finds the same key, `reuse()` copies the
+member verbatim from the previous file instead.
+
+Members which do have to be encoded are compressed on the worker threads
+of an `EncoderPool`, one member per thread, and written to the zipfile
+in the order they were submitted in once they are ready.
+"""
+
+import os
+import sys
+import zipfile
+import threading
+import multiprocessing
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SavedMember (object):
+    """Where some data was saved to, or loaded from, in an OpenRaster file
+
+    :ivar filename: absolute path of the zipfile
+    :ivar storepath: name of the member within it
+    :ivar crc: the member's CRC-32, to detect changes to the file
+    :ivar size: the member's uncompressed size
+    :ivar key: what the data was made from, or None if not known yet
+    :ivar origin: model position of the data, if it matters
+    """
+
+    def __init__(self, filename, storepath, crc, size, key=None,
+                 origin=None):
+        object.__init__(self)
+        self.filename = filename
+        self.storepath = storepath
+        self.crc = crc
+        self.size = size
+        self.key = key
+        self.origin = origin
+
+    @classmethod
+    def from_zipfile(cls, orazip, storepath, key=None, origin=None):
+        """Records a member of an open zipfile, or returns None"""
+        try:
+            info = orazip.getinfo(storepath)
+        except KeyError:
+            return None
+        filename = os.path.abspath(orazip.filename)
+        return cls(filename, storepath, info.CRC, info.file_size,
+                   key=key, origin=origin)
+
+    def __repr__(self):
+        return "<SavedMember %r in %r>" % (self.storepath, self.filename)
+
+
+def options_key(options):
+    """Hashable summary of the save options which affect the data written
+
+    >>> options_key(dict(feedback_cb=None, alpha=True))
+    (('alpha', True),)
+    """
+    return tuple(sorted((k, v) for (k, v) in options.iteritems()
+                        if k != "feedback_cb"))
+
+
+## Encoding on worker threads
+
+
+class _Job (object):
+    """Data being made by an `EncoderPool`, for `wait()`ing on
+
+    The basic job calls a function on a worker, and its result is what
+    the function returns. Subclasses doing their work in several steps
+    override `has_work()`, `take_work()` and `do_work()`.
+    """
+
+    def __init__(self, pool, func=None, args=()):
+        object.__init__(self)
+        self.pool = pool
+        self.func = func
+        self.args = args
+        self.done = False
+        self.result = None
+        self.exc_info = None
+        self.scheduled = False  # queued for, or running on, a worker
+
+    def has_work(self):
+        """True if a worker has something to do (pool lock held)"""
+        return not self.done
+
+    def take_work(self):
+        """Takes what a worker is to do next (pool lock held)"""
+        return None
+
+    def do_work(self, work):
+        """Does what `take_work()` returned, without the lock held"""
+        self.result = self.func(*self.args)
+        self.done = True
+
+    def wait(self):
+        """Waits for the job to be done, and returns its result"""
+        cond = self.pool._cond
+        with cond:
+            while not self.done:
+                cond.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class _PNGJob (_Job):
+    """Job compressing strips of scanlines with a ProgressivePNGWriter"""
+
+    def __init__(self, pool, writer):
+        super(_PNGJob, self).__init__(pool)
+        self.writer = writer
+        self.strips = []
+        self.complete = False  # all strips have been added
+
+    def has_work(self):
+        return not self.done and (self.strips or self.complete)
+
+    def take_work(self):
+        strips = self.strips
+        self.strips = []
+        return (strips, self.complete)
+
+    def do_work(self, work):
+        strips, complete = work
+        try:
+            for strip in strips:
+                self.writer.write(strip)
+        finally:
+            self.pool._release(strips)
+        if complete:
+            self.result = self.writer.close()
+            self.writer = None
+            self.done = True
+
+
+class EncoderPool (object):
+    """Compresses data for zipfile members on worker threads
+
+    Surfaces, their tiles, and the tile memory budget must only be used
+    by one thread, so `encode_png()` renders scanlines on the calling
+    thread, and the workers only filter and compress them. The
+    ProgressivePNGWriter releases the GIL while it does that, and
+    rendering is much quicker than compressing, so the workers keep
+    several cores busy with a different layer each while the caller
+    renders the next one. The memory held by rendered scanlines waiting
+    to be compressed is capped at `limit` bytes.
+    """
+
+    #: Default cap on rendered data waiting to be compressed, in bytes
+    DEFAULT_LIMIT = 64 * 1024 * 1024
+
+    def __init__(self, threads=None, limit=DEFAULT_LIMIT):
+        """Initialize, with an optional number of worker threads"""
+        object.__init__(self)
+        if threads is None:
+            try:
+                threads = multiprocessing.cpu_count()
+            except NotImplementedError:
+                threads = 1
+        self._num_threads = max(1, threads)
+        self._limit = limit
+        self._threads = []
+        self._idle = 0  # workers waiting for a job
+        self._cond = threading.Condition()
+        self._ready = []  # jobs with work for a worker
+        self._queued_bytes = 0
+        self._closed = False
+
+    def submit(self, func, *args):
+        """Calls a function on a worker thread
+
+        :returns: a job, whose ``wait()`` returns what func returned
+
+        The function must not touch any state shared with the caller.
+        """
+        job = _Job(self, func, args)
+        with self._cond:
+            self._schedule(job)
+        return job
+
+    def encode_png(self, writer, scanlines):
+        """Renders scanlines here, and compresses them on a worker
+
+        :param writer: a new mypaintlib.ProgressivePNGWriter
+        :param scanlines: iterable of strips to write, which are copied
+        :returns: a job, whose ``wait()`` returns the PNG data
+        """
+        job = _PNGJob(self, writer)
+        for strip in scanlines:
+            strip = strip.copy()
+            with self._cond:
+                while (self._queued_bytes > 0 and not job.done and
+                       self._queued_bytes + strip.nbytes > self._limit):
+                    self._cond.wait()
+                if job.done:
+                    break  # failed
+                self._queued_bytes += strip.nbytes
+                job.strips.append(strip)
+                self._schedule(job)
+        with self._cond:
+            job.complete = True
+            self._schedule(job)
+        return job
+
+    def _schedule(self, job):
+        if job.scheduled or not job.has_work():
+            return
+        job.scheduled = True
+        self._ready.append(job)
+        self._cond.notify()
+        if (self._idle < len(self._ready) and
+                len(self._threads) < self._num_threads):
+            self._start_thread()
+
+    def _start_thread(self):
+        thread = threading.Thread(target=self._run, name="EncoderPool")
+        thread.daemon = True
+        self._threads.append(thread)
+        thread.start()
+
+    def _release(self, strips):
+        with self._cond:
+            self._queued_bytes -= sum(s.nbytes for s in strips)
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._ready or self._closed):
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                if not self._ready:
+                    return
+                job = self._ready.pop(0)
+                work = job.take_work()
+            try:
+                job.do_work(work)
+            except Exception:
+                job.exc_info = sys.exc_info()
+                job.done = True
+            with self._cond:
+                job.scheduled = False
+                if job.done:
+                    if isinstance(job, _PNGJob):
+                        self._queued_bytes -= sum(s.nbytes
+                                                  for s in job.strips)
+                        job.strips = []
+                        job.writer = None
+                    self._cond.notify_all()
+                else:
+                    self._schedule(job)
+
+    def close(self):
+        """Stops the workers once the jobs submitted so far are done"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._threads = []
+
+
+## Writing zipfiles
+
+
+def _writestr_0644(orazip, storepath, data):
+    # Work around a permission bug in the zipfile library:
+    # http://bugs.python.org/issue3394
+    zi = zipfile.ZipInfo(storepath)
+    zi.external_attr = 0100644 << 16
+    orazip.writestr(zi, data)
+
+
+class OraZipFile (zipfile.ZipFile):
+    """Zipfile being written by an OpenRaster save, reusing old members
+
+    :param file: the (temporary) file to write to
+    :param saved_as: the final filename of the file being written
+    :param previous: the file to copy unchanged members from, if any
+
+    Records made by `remember()` are only updated by `commit()`, which
+    should be called once the file has been renamed to `saved_as`.
+
+    Members can be written as jobs of the file's `encoder`, and all
+    members are stored in the order they were written in, whether they
+    were ready at the time or not.
+    """
+
+    def __init__(self, file, saved_as, previous=None, **kwargs):
+        zipfile.ZipFile.__init__(self, file, 'w', **kwargs)
+        self.saved_as = os.path.abspath(saved_as)
+        self.encoder = EncoderPool()
+        self._pending = []  # (storepath, data or job), in order
+        self._previous = None
+        self._remembered = []
+        self.reused = 0
+        if previous is not None and os.path.isfile(previous):
+            try:
+                self._previous = zipfile.ZipFile(previous)
+            except (IOError, zipfile.BadZipfile):
+                logger.warning("Cannot reuse data from %r", previous)
+
+    def write_file_str(self, storepath, data):
+        """Writes a member, with the right permissions
+
+        :param str storepath: name of the member
+        :param data: the member's data, or an `encoder` job making it
+        """
+        self._pending.append((storepath, data))
+        self._write_pending(wait=False)
+
+    def _write_pending(self, wait):
+        """Writes out pending members in order, while they are ready"""
+        while self._pending:
+            storepath, data = self._pending[0]
+            if isinstance(data, _Job):
+                if not (wait or data.done):
+                    return
+                data = data.wait()
+            self._pending.pop(0)
+            _writestr_0644(self, storepath, data)
+
+    def write(self, filename, arcname=None, compress_type=None):
+        """Writes a file as a member, after any pending members"""
+        self._write_pending(wait=True)
+        zipfile.ZipFile.write(self, filename, arcname, compress_type)
+
+    def reuse(self, records, name, key, storepath):
+        """Copies a member from the previous file if its key is unchanged
+
+        :param dict records: the owner's records, by name
+        :param name: which of the owner's records to look up
+        :param key: the key of the data to be written now
+        :param storepath: name to store the member under in this file
+        :returns: the record reused, or None if the data must be written
+        """
+        record = records.get(name)
+        previous = self._previous
+        if record is None or previous is None or record.key != key:
+            return None
+        if record.filename != os.path.abspath(previous.filename):
+            return None
+        try:
+            info = previous.getinfo(record.storepath)
+        except KeyError:
+            return None
+        if (info.CRC, info.file_size) != (record.crc, record.size):
+            return None
+        self.write_file_str(storepath, previous.read(record.storepath))
+        self.remember(records, name, key, storepath, record.origin)
+        self.reused += 1
+        return record
+
+    def remember(self, records, name, key, storepath, origin=None):
+        """Notes what a member was made from, for `commit()`"""
+        self._remembered.append((records, name, key, storepath, origin))
+
+    def close(self):
+        """Writes pending members, then closes the file and the previous one
+
+        The encoder's workers are stopped even if a member failed to
+        encode, in which case its exception is raised.
+        """
+        try:
+            self._write_pending(wait=True)
+        finally:
+            self._pending = []
+            self.encoder.close()
+            zipfile.ZipFile.close(self)
+            if self._previous is not None:
+                self._previous.close()
+                self._previous = None
+
+    def commit(self):
+        """Updates the remembered records to point at `saved_as`"""
+        for records, name, key, storepath, origin in self._remembered:
+            info = self.getinfo(storepath)
+            records[name] = SavedMember(self.saved_as, storepath,
+                                        info.CRC, info.file_size,
+                                        key=key, origin=origin)
+        self._remembered = []
+
+
+def get_encoder(orazip):
+    """The `EncoderPool` of orazip if it is an `OraZipFile`, else None"""
+    if isinstance(orazip, OraZipFile):
+        return orazip.encoder
+    return None
+
+
+def write_file_str(orazip, storepath, data):
+    """Writes a member to any zipfile, waiting for data if it's a job"""
+    if isinstance(orazip, OraZipFile):
+        orazip.write_file_str(storepath, data)
+        return
+    if isinstance(data, _Job):
+        data = data.wait()
+    _writestr_0644(orazip, storepath, data)
+
+
+def reuse(orazip, records, name, key, storepath):
+    """Calls `OraZipFile.reuse()` if orazip is one, else returns None"""
+    if isinstance(orazip, OraZipFile):
+        return orazip.reuse(records, name, key, storepath)
+    return None
+
+
+def remember(orazip, records, name, key, storepath, origin=None):
+    """Calls `OraZipFile.remember()` if orazip is one"""
+    if isinstance(orazip, OraZipFile):
+        orazip.remember(records, name, key, storepath, origin)
+
+
+## Module testing
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
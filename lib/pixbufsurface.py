@@ -144,14 +144,17 @@ def render_as_pixbuf(surface, *rect, **kwargs):
             tn += 1
     return s.pixbuf
 
-def save_as_png(surface, filename, *rect, **kwargs):
-    """Saves a surface to a file in PNG format"""
-    # TODO: Document keyword params and their meanings, mentioning that
-    # TODO:  some are processed and removed here, and that others are
-    # TODO:  passed to blit_tile_into().
+def _render_scanlines(surface, rect, kwargs):
+    """Renders a surface as strips of 8-bit scanlines, for PNG encoding
+
+    The keyword args ``alpha``, ``feedback_cb``, and
+    ``single_tile_pattern`` are consumed here, and the rest are passed to
+    the surface's `blit_tile_into()`. Returns the width, height, and
+    alpha flag of the image, and a generator of strips. The strips are
+    views into a buffer which is reused for the next strip.
+    """
     alpha = kwargs.pop('alpha', False)
     feedback_cb = kwargs.pop('feedback_cb', None)
-    write_legacy_png = kwargs.pop("write_legacy_png", True)
     single_tile_pattern = kwargs.pop("single_tile_pattern", False)
     if not rect:
         rect = surface.get_bbox()
@@ -207,8 +210,39 @@ def save_as_png(surface, filename, *rect, **kwargs):
                 res = res[y-render_ty*N:,:,:]
             yield res
 
+    return w, h, alpha, render_tile_scanlines()
+
+def save_as_png(surface, filename, *rect, **kwargs):
+    """Saves a surface to a file in PNG format"""
+    # TODO: Document keyword params and their meanings, mentioning that
+    # TODO:  some are processed and removed here, and that others are
+    # TODO:  passed to blit_tile_into().
+    write_legacy_png = kwargs.pop("write_legacy_png", True)
+    w, h, alpha, scanlines = _render_scanlines(surface, rect, kwargs)
     filename_sys = filename.encode(sys.getfilesystemencoding())
     # FIXME: should not do that, should use open(unicode_object)
     mypaintlib.save_png_fast_progressive(filename_sys, w, h, alpha,
-                                         render_tile_scanlines(),
-                                         write_legacy_png)
+                                         scanlines, write_legacy_png)
+
+def encode_as_png(surface, *rect, **kwargs):
+    """Encodes a surface as PNG data in memory
+
+    Takes the same params as `save_as_png()`, apart from the filename,
+    and also:
+
+    :keyword encoder: a `lib.orasave.EncoderPool` to compress the data
+      on, instead of on the calling thread
+    :returns: the PNG data as a str, or if an encoder was passed, the
+      encoder's job which will produce it
+
+    Rendering always happens on the calling thread.
+    """
+    encoder = kwargs.pop("encoder", None)
+    write_legacy_png = kwargs.pop("write_legacy_png", True)
+    w, h, alpha, scanlines = _render_scanlines(surface, rect, kwargs)
+    writer = mypaintlib.ProgressivePNGWriter(w, h, alpha, write_legacy_png)
+    if encoder is not None:
+        return encoder.encode_png(writer, scanlines)
+    for strip in scanlines:
+        writer.write(strip)
+    return writer.close()
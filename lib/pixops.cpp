@@ -16,6 +16,8 @@
 #include <mypaint-tiled-surface.h>
 
 #include <glib.h>
+#include <vector>
+#include <string.h>
 
 #define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
 #define NO_IMPORT_ARRAY
@@ -179,6 +181,9 @@ void tile_convert_rgba16_to_rgba8(PyObject * src, PyObject * dst) {
   precalculate_dithering_noise_if_required();
   int noise_idx = 0;
 
+  // Only pixels are touched from here on, so other threads can run
+  Py_BEGIN_ALLOW_THREADS
+
   for (int y=0; y<MYPAINT_TILE_SIZE; y++) {
     uint16_t * src_p = (uint16_t*)((char *)PyArray_DATA(src_arr) + y*PyArray_STRIDES(src_arr)[0]);
     uint8_t  * dst_p = (uint8_t*)((char *)PyArray_DATA(dst_arr) + y*PyArray_STRIDES(dst_arr)[0]);
@@ -261,6 +266,8 @@ void tile_convert_rgba16_to_rgba8(PyObject * src, PyObject * dst) {
     src_p += PyArray_STRIDES(src_arr)[0];
     dst_p += PyArray_STRIDES(dst_arr)[0];
   }
+
+  Py_END_ALLOW_THREADS
 }
 
 
@@ -699,3 +706,166 @@ tile_combine (enum CombineMode mode,
     op->combine_data(src_p, dst_p, dst_has_alpha, src_opacity);
 }
 
+
+
+/* tile_combine_plan(): composite a flattened layer stack into one tile */
+
+
+// One step of a render plan, as parsed from its Python tuple
+struct RenderPlanStep {
+    int op;
+    const fix15_short_t *src;  // NULL to skip a RenderPlanCombine
+    const TileDataCombineOp *combine_op;
+    float opacity;
+};
+
+
+// Checks that obj is a C-contiguous uint16 tile array, which is all the
+// plan can safely composite once the GIL is released. Sets a Python
+// exception and returns false otherwise.
+static bool
+render_plan_check_tile (PyObject *obj, const char *name)
+{
+    if (! PyArray_Check(obj)) {
+        PyErr_Format(PyExc_TypeError, "%s must be a tile array", name);
+        return false;
+    }
+    PyArrayObject *arr = (PyArrayObject *)obj;
+    if (PyArray_TYPE(arr) != NPY_UINT16) {
+        PyErr_Format(PyExc_TypeError, "%s must have dtype uint16", name);
+        return false;
+    }
+    if (PyArray_NDIM(arr) != 3
+            || PyArray_DIM(arr, 0) != MYPAINT_TILE_SIZE
+            || PyArray_DIM(arr, 1) != MYPAINT_TILE_SIZE
+            || PyArray_DIM(arr, 2) != 4) {
+        PyErr_Format(PyExc_ValueError, "%s must have shape (%d, %d, 4)",
+                     name, MYPAINT_TILE_SIZE, MYPAINT_TILE_SIZE);
+        return false;
+    }
+    if (! PyArray_ISCARRAY(arr)) {
+        PyErr_Format(PyExc_ValueError, "%s must be C-contiguous", name);
+        return false;
+    }
+    return true;
+}
+
+
+PyObject *
+tile_combine_plan (PyObject *plan_obj,
+                   PyObject *dst_obj,
+                   const bool dst_has_alpha)
+{
+    static const size_t buf_len = MYPAINT_TILE_SIZE*MYPAINT_TILE_SIZE*4;
+    PyObject *plan = PySequence_Fast(plan_obj, "render plan must be a sequence");
+    if (! plan) {
+        return NULL;
+    }
+    if (! render_plan_check_tile(dst_obj, "dst")) {
+        Py_DECREF(plan);
+        return NULL;
+    }
+
+    // Check and parse the whole plan while holding the GIL. The plan
+    // keeps the source arrays alive until the end.
+    std::vector<RenderPlanStep> steps;
+    int depth = 0;
+    bool ok = true;
+    const Py_ssize_t n = PySequence_Fast_GET_SIZE(plan);
+    for (Py_ssize_t i = 0; ok && i < n; i++) {
+        PyObject *item = PySequence_Fast_GET_ITEM(plan, i);
+        RenderPlanStep step;
+        PyObject *src_obj = NULL;
+        int mode = 0;
+        step.opacity = 1.0;
+        if (! PyArg_ParseTuple(item, "iOif", &step.op, &src_obj, &mode,
+                               &step.opacity)) {
+            ok = false;
+            break;
+        }
+        if (mode >= NumCombineModes || mode < 0) {
+            PyErr_Format(PyExc_ValueError, "bad combine mode %d", mode);
+            ok = false;
+            break;
+        }
+        step.combine_op = combine_mode_info[mode];
+        step.src = NULL;
+        switch (step.op) {
+        case RenderPlanCombine:
+            if (src_obj == Py_None) {
+                break;
+            }
+            if (! render_plan_check_tile(src_obj, "src")) {
+                ok = false;
+                break;
+            }
+            step.src = (fix15_short_t *)PyArray_DATA((PyArrayObject *)src_obj);
+            break;
+        case RenderPlanPush:
+            depth++;
+            break;
+        case RenderPlanPop:
+            if (depth < 1) {
+                PyErr_SetString(PyExc_ValueError, "unbalanced render plan");
+                ok = false;
+            }
+            depth--;
+            break;
+        default:
+            PyErr_Format(PyExc_ValueError, "bad render plan op %d", step.op);
+            ok = false;
+            break;
+        }
+        steps.push_back(step);
+    }
+    if (! ok) {
+        Py_DECREF(plan);
+        return NULL;
+    }
+
+    // Composite without the GIL, so that several threads can render.
+    // Stack of groups being composited: the bottom one is dst itself,
+    // and the others are scratch buffers owned here.
+    fix15_short_t *dst_p = (fix15_short_t *)PyArray_DATA((PyArrayObject *)dst_obj);
+    Py_BEGIN_ALLOW_THREADS
+    std::vector<fix15_short_t *> bufs;
+    std::vector<bool> bufs_alpha;
+    bufs.push_back(dst_p);
+    bufs_alpha.push_back(dst_has_alpha);
+    for (size_t i = 0; i < steps.size(); i++) {
+        const RenderPlanStep &step = steps[i];
+        switch (step.op) {
+        case RenderPlanCombine:
+            if (step.src) {
+                step.combine_op->combine_data(step.src, bufs.back(),
+                                              bufs_alpha.back(), step.opacity);
+            }
+            break;
+        case RenderPlanPush: {
+            fix15_short_t *buf = new fix15_short_t[buf_len];
+            memset(buf, 0, buf_len * sizeof(fix15_short_t));
+            bufs.push_back(buf);
+            bufs_alpha.push_back(true);
+            break;
+        }
+        case RenderPlanPop: {
+            fix15_short_t *buf = bufs.back();
+            bufs.pop_back();
+            bufs_alpha.pop_back();
+            step.combine_op->combine_data(buf, bufs.back(), bufs_alpha.back(),
+                                          step.opacity);
+            delete[] buf;
+            break;
+        }
+        }
+    }
+    // Free any scratch buffers left by a plan without enough pops
+    while (bufs.size() > 1) {
+        delete[] bufs.back();
+        bufs.pop_back();
+    }
+    Py_END_ALLOW_THREADS
+
+    Py_DECREF(plan);
+    Py_RETURN_NONE;
+}
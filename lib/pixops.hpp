@@ -134,4 +134,26 @@ tile_combine (enum CombineMode mode,
               const float src_opacity);
 
 
+// Opcodes for tile_combine_plan() render plans
+
+enum RenderPlanOp {
+    RenderPlanCombine,  // (op, src, mode, opacity): combine src into the group
+    RenderPlanPush,     // (op, None, 0, 0.0): begin an isolated group
+    RenderPlanPop       // (op, None, mode, opacity): combine the group down
+};
+
+
+// Composite a whole flattened layer stack into one tile, in one call.
+// The plan is a sequence of (op, src, mode, opacity) tuples, where src
+// is a tile array or None to skip. Isolated groups are composited into
+// scratch buffers. The plan is checked first, and then composited
+// without holding the GIL, so several threads can render tiles at once.
+// Returns None, or NULL with an exception set.
+
+PyObject *
+tile_combine_plan (PyObject *plan_obj,
+                   PyObject *dst_obj,
+                   const bool dst_has_alpha);
+
+
 #endif // PIXOPS_HPP
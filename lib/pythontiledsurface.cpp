@@ -8,15 +8,108 @@
  */
 
 #include "pythontiledsurface.h"
+#include "operationqueue.h"
+
+#include <map>
+#include <utility>
+
+// Native store of tile buffers fetched from tiledsurface.py.
+// Entries are only valid during one atomic section: Python keeps the
+// arrays alive until end_atomic(), but may replace them afterwards.
+struct TileStoreEntry {
+    uint16_t *buffer;
+    gboolean writable;
+};
+typedef std::map<std::pair<int, int>, TileStoreEntry> TileStore;
 
 struct _MyPaintPythonTiledSurface {
     MyPaintTiledSurface parent;
     PyObject * py_obj;
+    TileStore *tile_store;
 };
 
 // Forward declare
 void free_tiledsurf(MyPaintSurface *surface);
 
+static uint16_t *
+tile_store_lookup(MyPaintPythonTiledSurface *self, int tx, int ty,
+                  gboolean readonly)
+{
+    uint16_t *buffer = NULL;
+#pragma omp critical (tile_store)
+{
+    TileStore::iterator it = self->tile_store->find(std::make_pair(tx, ty));
+    if (it != self->tile_store->end() && (readonly || it->second.writable)) {
+        buffer = it->second.buffer;
+    }
+}
+    return buffer;
+}
+
+static void
+tile_store_insert(MyPaintPythonTiledSurface *self, int tx, int ty,
+                  uint16_t *buffer, gboolean readonly)
+{
+#pragma omp critical (tile_store)
+{
+    const std::pair<int, int> key = std::make_pair(tx, ty);
+    TileStore::iterator it = self->tile_store->find(key);
+    // A read-only fetch never supersedes an earlier one
+    if (it == self->tile_store->end()) {
+        TileStoreEntry entry = {buffer, !readonly};
+        self->tile_store->insert(std::make_pair(key, entry));
+    }
+    else if (! readonly) {
+        it->second.buffer = buffer;
+        it->second.writable = TRUE;
+    }
+}
+}
+
+void
+mypaint_python_tiled_surface_clear_tile_store(MyPaintPythonTiledSurface *self)
+{
+    self->tile_store->clear();
+}
+
+// Fetch all the tiles queued dabs will write to with one Python call,
+// so that the parallel process_tile() loop never needs the interpreter.
+static void
+prefetch_dirty_tiles(MyPaintPythonTiledSurface *self)
+{
+    TileIndex *tiles = NULL;
+    const int tiles_n = operation_queue_get_dirty_tiles(self->parent.operation_queue, &tiles);
+    if (tiles_n <= 0) {
+        return;
+    }
+    PyObject *positions = PyList_New(tiles_n);
+    if (positions == NULL) {
+        PyErr_Print();
+        return;
+    }
+    for (int i = 0; i < tiles_n; i++) {
+        PyList_SET_ITEM(positions, i, Py_BuildValue("(ii)", tiles[i].x, tiles[i].y));
+    }
+    PyObject *arrays = PyObject_CallMethod(self->py_obj, "_get_tiles_for_writing", "(O)", positions);
+    Py_DECREF(positions);
+    if (arrays == NULL || ! PyList_Check(arrays) || PyList_GET_SIZE(arrays) != tiles_n) {
+        // Not fatal: process_tile() falls back to single requests
+        printf("Python exception during _get_tiles_for_writing()!\n");
+        if (PyErr_Occurred()) {
+            PyErr_Print();
+        }
+        Py_XDECREF(arrays);
+        return;
+    }
+    for (int i = 0; i < tiles_n; i++) {
+        PyArrayObject *rgba = (PyArrayObject *)PyList_GET_ITEM(arrays, i);
+        // tiledsurface.py keeps a reference in its tiledict, as below
+        tile_store_insert(self, tiles[i].x, tiles[i].y,
+                          (uint16_t *)PyArray_DATA(rgba), FALSE);
+    }
+    Py_DECREF(arrays);
+}
+
 static void
 tile_request_start(MyPaintTiledSurface *tiled_surface, MyPaintTileRequest *request)
 {
@@ -27,6 +120,11 @@ tile_request_start(MyPaintTiledSurface *tiled_surface, MyPaintTileRequest *reque
     const int ty = request->ty;
     PyArrayObject* rgba = NULL;
 
+    request->buffer = tile_store_lookup(self, tx, ty, readonly);
+    if (request->buffer) {
+        return;
+    }
+
 #pragma omp critical
 {
     rgba = (PyArrayObject*)PyObject_CallMethod(self->py_obj, "_get_tile_numpy", "(iii)", tx, ty, readonly);
@@ -52,6 +150,9 @@ tile_request_start(MyPaintTiledSurface *tiled_surface, MyPaintTileRequest *reque
     }
 } // #end pragma opt critical
 
+    if (request->buffer) {
+        tile_store_insert(self, tx, ty, request->buffer, readonly);
+    }
 
 }
 
@@ -61,6 +162,23 @@ tile_request_end(MyPaintTiledSurface *tiled_surface, MyPaintTileRequest *request
     // We modify tiles directly, so don't need to do anything here
 }
 
+static void
+begin_atomic_tiledsurf(MyPaintSurface *surface)
+{
+    MyPaintPythonTiledSurface *self = (MyPaintPythonTiledSurface *)surface;
+    mypaint_python_tiled_surface_clear_tile_store(self);
+    mypaint_tiled_surface_begin_atomic(&self->parent);
+}
+
+static void
+end_atomic_tiledsurf(MyPaintSurface *surface, MyPaintRectangle *roi)
+{
+    MyPaintPythonTiledSurface *self = (MyPaintPythonTiledSurface *)surface;
+    prefetch_dirty_tiles(self);
+    mypaint_tiled_surface_end_atomic(&self->parent, roi);
+    mypaint_python_tiled_surface_clear_tile_store(self);
+}
+
 MyPaintPythonTiledSurface *
 mypaint_python_tiled_surface_new(PyObject *py_object)
 {
@@ -71,8 +189,11 @@ mypaint_python_tiled_surface_new(PyObject *py_object)
 
     // MyPaintSurface vfuncs
     self->parent.parent.destroy = free_tiledsurf;
+    self->parent.parent.begin_atomic = begin_atomic_tiledsurf;
+    self->parent.parent.end_atomic = end_atomic_tiledsurf;
 
     self->py_obj = py_object; // no need to incref
+    self->tile_store = new TileStore();
 
     return self;
 }
@@ -81,5 +202,6 @@ void free_tiledsurf(MyPaintSurface *surface)
 {
     MyPaintPythonTiledSurface *self = (MyPaintPythonTiledSurface *)surface;
     mypaint_tiled_surface_destroy(&self->parent);
+    delete self->tile_store;
     free(self);
 }
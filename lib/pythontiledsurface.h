@@ -12,6 +12,9 @@ typedef struct _MyPaintPythonTiledSurface MyPaintPythonTiledSurface;
 MyPaintPythonTiledSurface *
 mypaint_python_tiled_surface_new(PyObject *py_object);
 
+void
+mypaint_python_tiled_surface_clear_tile_store(MyPaintPythonTiledSurface *self);
+
 MyPaintSurface *
 mypaint_python_surface_factory(gpointer user_data);
 
@@ -20,17 +20,33 @@ import idletask
 
 TILE_SIZE = N = mypaintlib.TILE_SIZE
 
+#: Most tiles shifted at once by `translate_shapes()`, to bound its memory
+SHIFT_CHUNK_TILES = 1024
+
+
 class StrokeShape (object):
     """The shape of a single brushstroke.
 
     This class stores the shape of a stroke in as a 1-bit bitmap. The
-    information is stored in compressed memory blocks of the size of a
-    tile (for fast lookup).
+    bitmap is stored in blocks of the size of a tile (for fast lookup),
+    with 8 pixels packed into each byte by numpy.packbits(). Blocks are
+    kept in two parallel arrays, so that translating or trimming a
+    stroke is a bulk operation on all of them:
+
+    * ``positions``: (n, 2) int32 array of tile positions (tx, ty)
+    * ``blocks``: (n, N, N/8) uint8 array of packed bitmaps
+
+    No two blocks have the same position, and there are no empty blocks.
     """
     def __init__(self):
         object.__init__(self)
         self.tasks = idletask.Processor()
-        self.strokemap = {}
+        self._set_blocks(_empty_positions(), _empty_blocks())
+
+    def _set_blocks(self, positions, blocks):
+        self.positions = positions
+        self.blocks = blocks
+        self._rows = None  # (tx, ty) -> block index, built on demand
 
     def init_from_snapshots(self, snapshot_before, snapshot_after):
         """Set the shape from a before- and after-stroke pair of snapshots
@@ -38,43 +54,53 @@ class StrokeShape (object):
         :param snapshot_before: Snapshot state before the stroke was made
         :param snapshot_after: Snapshot state after the stroke was made
         """
-        assert not self.strokemap
+        assert not len(self.positions)
         # extract the layer from each snapshot
         a, b = snapshot_before.tiledict, snapshot_after.tiledict
         # enumerate all tiles that have changed
-        a_tiles = set(a.iteritems())
-        b_tiles = set(b.iteritems())
-        changes = a_tiles.symmetric_difference(b_tiles)
-        tiles_modified = set([pos for pos, data in changes])
+        tiles_modified = list(a.diff(b))
 
-        # for each tile, calculate the exact difference (not now, later, when idle)
-        for tx, ty in tiles_modified:
-            func = self._update_strokemap_with_percept_diff
-            self.tasks.add_work(func, a, b, tx, ty)
+        # calculate the exact differences later, when idle, in one pass
+        func = self._update_strokemap_with_percept_diff
+        self.tasks.add_work(func, a, b, tiles_modified)
 
 
-    def _update_strokemap_with_percept_diff(self, before, after, tx, ty):
-        # get the pixel data to compare
-        data_before = before.get((tx, ty), tiledsurface.transparent_tile).rgba
-        data_after = after.get((tx, ty), tiledsurface.transparent_tile).rgba
-        # calculate pixel changes, and add to the stroke's tiled bitmap
-        differences = empty((N, N), 'uint8')
-        mypaintlib.tile_perceptual_change_strokemap(data_before, data_after,
-                                                    differences)
-        self.strokemap[tx, ty] = zlib.compress(differences.tostring())
+    def _update_strokemap_with_percept_diff(self, before, after, tiles):
+        # calculate pixel changes for all tiles, then pack them together
+        differences = empty((len(tiles), N, N), 'uint8')
+        transparent = tiledsurface.transparent_tile
+        for i, (tx, ty) in enumerate(tiles):
+            data_before = before.get((tx, ty), transparent).rgba
+            data_after = after.get((tx, ty), transparent).rgba
+            mypaintlib.tile_perceptual_change_strokemap(data_before,
+                                                        data_after,
+                                                        differences[i])
+        positions = array(tiles, 'int32').reshape(-1, 2)
+        blocks = packbits(differences != 0, axis=2)
+        self._set_blocks(*_merge_blocks(positions, blocks))
 
 
     def init_from_string(self, data, translate_x, translate_y):
-        assert not self.strokemap
+        assert not len(self.positions)
         assert translate_x % N == 0
         assert translate_y % N == 0
         translate_x /= N
         translate_y /= N
-        while data:
-            tx, ty, size = struct.unpack('>iiI', data[:3*4])
-            compressed_bitmap = data[3*4:size+3*4]
-            self.strokemap[tx + translate_x, ty + translate_y] = compressed_bitmap
-            data = data[size+3*4:]
+        positions = []
+        bitmaps = []
+        i = 0
+        while i < len(data):
+            tx, ty, size = struct.unpack('>iiI', data[i:i+3*4])
+            i += 3*4
+            compressed_bitmap = data[i:i+size]
+            i += size
+            positions.append((tx + translate_x, ty + translate_y))
+            bitmaps.append(zlib.decompress(compressed_bitmap))
+        positions = array(positions, 'int32').reshape(-1, 2)
+        bitmaps = fromstring(''.join(bitmaps), dtype='uint8')
+        bitmaps.shape = (len(positions), N, N)
+        blocks = packbits(bitmaps != 0, axis=2)
+        self._set_blocks(*_merge_blocks(positions, blocks))
 
     def save_to_string(self, translate_x, translate_y):
         assert translate_x % N == 0
@@ -82,88 +108,47 @@ class StrokeShape (object):
         translate_x /= N
         translate_y /= N
         self.tasks.finish_all()
-        data = ''
-        for (tx, ty), compressed_bitmap in self.strokemap.iteritems():
+        bitmaps = unpackbits(self.blocks, axis=2)
+        data = []
+        for (tx, ty), bitmap in zip(self.positions.tolist(), bitmaps):
             tx, ty = tx + translate_x, ty + translate_y
-            data += struct.pack('>iiI', tx, ty, len(compressed_bitmap))
-            data += compressed_bitmap
-        return data
+            compressed_bitmap = zlib.compress(bitmap.tostring())
+            data.append(struct.pack('>iiI', tx, ty, len(compressed_bitmap)))
+            data.append(compressed_bitmap)
+        return ''.join(data)
+
+    def get_tiles(self):
+        """Returns the positions of the tiles the stroke touches"""
+        self.tasks.finish_all()
+        return [tuple(p) for p in self.positions.tolist()]
 
     def touches_pixel(self, x, y):
         self.tasks.finish_all()
-        data = self.strokemap.get((x/N, y/N))
-        if data:
-            data = fromstring(zlib.decompress(data), dtype='uint8')
-            data.shape = (N, N)
-            return data[y%N, x%N]
+        if self._rows is None:
+            self._rows = dict(zip(self.get_tiles(),
+                                  xrange(len(self.positions))))
+        i = self._rows.get((x/N, y/N))
+        if i is not None:
+            x, y = x%N, y%N
+            return bool(self.blocks[i, y, x/8] & (0x80 >> (x%8)))
+        return False
 
     def render_to_surface(self, surf):
         self.tasks.finish_all()
-        for (tx, ty), data in self.strokemap.iteritems():
-            data = fromstring(zlib.decompress(data), dtype='uint8')
-            data.shape = (N, N)
+        # neutral gray, 50% opaque
+        alphas = unpackbits(self.blocks, axis=2).astype('uint16')
+        alphas *= (1<<15)/2
+        for (tx, ty), alpha in zip(self.get_tiles(), alphas):
             with surf.tile_request(tx, ty, readonly=False) as tile:
-                # neutral gray, 50% opaque
-                tile[:,:,3] = data.astype('uint16') * (1<<15)/2
-                tile[:,:,0] = tile[:,:,3]/2
-                tile[:,:,1] = tile[:,:,3]/2
-                tile[:,:,2] = tile[:,:,3]/2
-
-
-    @staticmethod
-    def _translate_tile(src, src_tx, src_ty, slices_x, slices_y,
-                        targ_strokemap):
-        """Idle task: translate a single tile into an output strokemap"""
-        src = fromstring(zlib.decompress(src), dtype='uint8')
-        src.shape = (N, N)
-        is_integral = len(slices_x) == 1 and len(slices_y) == 1
-        for (src_x0, src_x1), (targ_tdx, targ_x0, targ_x1) in slices_x:
-            for (src_y0, src_y1), (targ_tdy, targ_y0, targ_y1) in slices_y:
-                targ_tx = src_tx + targ_tdx
-                targ_ty = src_ty + targ_tdy
-                if is_integral:
-                    targ_strokemap[targ_tx, targ_ty] = src
-                else:
-                    targ = targ_strokemap.get((targ_tx, targ_ty), None)
-                    if targ is None:
-                        targ = zeros((N, N), 'uint8')
-                        targ_strokemap[targ_tx, targ_ty] = targ
-                    targ[targ_y0:targ_y1, targ_x0:targ_x1] \
-                      = src[src_y0:src_y1, src_x0:src_x1]
-
-
-    def _recompress_tile(self, tx, ty, data):
-        """Idle task: recompress a single translated tile's data"""
-        if not data.any():
-            return
-        self.strokemap[tx, ty] = zlib.compress(data.tostring())
-
-
-    def _start_tile_recompression(self, src_strokemap):
-        """Idle task: starts recompressing data from the temp strokemap"""
-        for (tx, ty), data in src_strokemap.iteritems():
-            self.tasks.add_work(self._recompress_tile, tx, ty, data)
+                tile[:,:,3] = alpha
+                tile[:,:,0] = alpha/2
+                tile[:,:,1] = alpha/2
+                tile[:,:,2] = alpha/2
 
 
     def translate(self, dx, dy):
         """Translate the shape by (dx, dy)"""
-        # Finish any previous translations or handling of painted strokes
-        self.tasks.finish_all()
-        # Source data
-        src_strokemap = self.strokemap
-        self.strokemap = {}
-        slices_x = tiledsurface.calc_translation_slices(int(dx))
-        slices_y = tiledsurface.calc_translation_slices(int(dy))
-        # Temporary working strokemap, uncompressed
-        tmp_strokemap = {}
-        # Queue moves
-        for (src_tx, src_ty), src in src_strokemap.iteritems():
-            self.tasks.add_work(self._translate_tile, src,
-                                src_tx, src_ty, slices_x, slices_y,
-                                tmp_strokemap)
-        # Recompression of any tile can only start after all the above is
-        # complete. Luckily the idle-processor does things in order.
-        self.tasks.add_work(self._start_tile_recompression, tmp_strokemap)
+        translate_shapes([self], dx, dy)
 
 
     def trim(self, rect):
@@ -179,7 +164,182 @@ class StrokeShape (object):
         self.tasks.finish_all()
         x, y, w, h = rect
         logger.debug("Trimming stroke to %dx%d%+d%+d", w, h, x, y)
-        for tx, ty in list(self.strokemap.keys()):
-            if tx*N+N < x or ty*N+N < y or tx*N > x+w or ty*N > y+h:
-                self.strokemap.pop((tx, ty))
-        return bool(self.strokemap)
+        px = self.positions[:, 0] * N
+        py = self.positions[:, 1] * N
+        outside = (px+N < x) | (py+N < y) | (px > x+w) | (py > y+h)
+        if outside.any():
+            keep = ~outside
+            self._set_blocks(self.positions[keep], self.blocks[keep])
+        return bool(len(self.positions))
+
+
+## Bulk operations on packed blocks
+
+
+def _empty_positions(n=0):
+    return zeros((n, 2), 'int32')
+
+
+def _empty_blocks(n=0):
+    return zeros((n, N, N/8), 'uint8')
+
+
+def _merge_blocks(keys, blocks):
+    """Drops empty blocks, and merges blocks with the same key
+
+    :param keys: (n, k) int array, e.g. of tile positions
+    :param blocks: (n, N, N/8) packed bitmaps
+    :returns: keys and blocks, sorted by key, with unique keys
+
+    Blocks are merged by ORing their bits together.
+    """
+    if not len(blocks):
+        return keys, blocks
+    nonempty = blocks.reshape(len(blocks), -1).any(axis=1)
+    keys = keys[nonempty]
+    blocks = blocks[nonempty]
+    if len(keys) < 2:
+        return keys, blocks
+    order = lexsort(keys.T[::-1])
+    keys = keys[order]
+    blocks = blocks[order]
+    starts = concatenate(([True], (keys[1:] != keys[:-1]).any(axis=1)))
+    starts = flatnonzero(starts)
+    if len(starts) < len(keys):
+        blocks = bitwise_or.reduceat(blocks, starts, axis=0)
+        keys = keys[starts]
+    return keys, blocks
+
+
+def _shift_blocks(keys, blocks, rx, ry):
+    """Shifts packed bitmaps right and down by less than a tile
+
+    :param keys: (n, 2+k) int array, whose first columns are tile positions
+    :param blocks: (n, N, N/8) packed bitmaps
+    :param int rx: pixels to shift right by, 0 <= rx < N
+    :param int ry: pixels to shift down by, 0 <= ry < N
+    :returns: keys and blocks of up to 4 parts of each input block
+
+    The parts are not merged, and may be empty.
+    """
+    bits = unpackbits(blocks, axis=2)
+    n = len(bits)
+    parts_keys = []
+    parts_blocks = []
+    # For each neighbour receiving a part: its offset in tiles, and the
+    # slices of the source and destination which overlap.
+    for ox, src_x, dst_x in ((0, slice(0, N-rx), slice(rx, N)),
+                             (1, slice(N-rx, N), slice(0, rx))):
+        if ox and not rx:
+            continue
+        for oy, src_y, dst_y in ((0, slice(0, N-ry), slice(ry, N)),
+                                 (1, slice(N-ry, N), slice(0, ry))):
+            if oy and not ry:
+                continue
+            part = zeros((n, N, N), 'uint8')
+            part[:, dst_y, dst_x] = bits[:, src_y, src_x]
+            part_keys = keys.copy()
+            part_keys[:, 0] += ox
+            part_keys[:, 1] += oy
+            parts_keys.append(part_keys)
+            parts_blocks.append(packbits(part, axis=2))
+    return concatenate(parts_keys), concatenate(parts_blocks)
+
+
+def translate_shapes(shapes, dx, dy):
+    """Translates several stroke shapes by (dx, dy) in one pass
+
+    :param list shapes: the StrokeShapes to move
+    :param int dx: X offset, in model pixels
+    :param int dy: Y offset, in model pixels
+
+    Moves by whole tiles just change the shapes' positions. Other moves
+    shift the bits of all the shapes' blocks together, a chunk of tiles
+    at a time.
+    """
+    for shape in shapes:
+        shape.tasks.finish_all()
+    shapes = [s for s in shapes if len(s.positions)]
+    if not shapes:
+        return
+    qx, rx = divmod(int(dx), N)
+    qy, ry = divmod(int(dy), N)
+    if (rx, ry) == (0, 0):
+        for shape in shapes:
+            shape._set_blocks(shape.positions + (qx, qy), shape.blocks)
+        return
+    # Key each block by its new position, and the shape it belongs to
+    keys = []
+    for i, shape in enumerate(shapes):
+        k = empty((len(shape.positions), 3), 'int32')
+        k[:, 0:2] = shape.positions + (qx, qy)
+        k[:, 2] = i
+        keys.append(k)
+    keys = concatenate(keys) if keys else empty((0, 3), 'int32')
+    blocks = concatenate([s.blocks for s in shapes] or [_empty_blocks()])
+    parts_keys = []
+    parts_blocks = []
+    for i in xrange(0, len(keys), SHIFT_CHUNK_TILES):
+        chunk = slice(i, i+SHIFT_CHUNK_TILES)
+        k, b = _shift_blocks(keys[chunk], blocks[chunk], rx, ry)
+        parts_keys.append(k)
+        parts_blocks.append(b)
+    if parts_keys:
+        keys = concatenate(parts_keys)
+        blocks = concatenate(parts_blocks)
+    # Merge by shape, then position, and hand the blocks back
+    keys, blocks = _merge_blocks(keys[:, [2, 0, 1]], blocks)
+    bounds = searchsorted(keys[:, 0], arange(len(shapes) + 1))
+    for i, shape in enumerate(shapes):
+        part = slice(bounds[i], bounds[i+1])
+        shape._set_blocks(keys[part, 1:3].copy(), blocks[part].copy())
+
+
+class StrokeIndex (object):
+    """Index of the strokes covering each tile, for picking by position
+
+    Painting layers keep one of these next to their list of strokes.
+    Finding the topmost stroke at a point then only has to look at the
+    strokes which cover that point's tile, rather than at every stroke.
+
+    The index follows the layer's list of strokes on each lookup. Strokes
+    appended since the last lookup are added to it, and any other change
+    to the list rebuilds it. Translating or trimming strokes changes
+    their tiles without changing the list, so the layer must call
+    `invalidate()` when it does either.
+    """
+
+    def __init__(self):
+        object.__init__(self)
+        self._strokes = []  # strokes indexed, bottom to top
+        self._tiles = {}  # (tx, ty) -> strokes covering it, bottom to top
+
+    def invalidate(self):
+        """Forgets everything, so the next lookup rebuilds the index"""
+        self._strokes = []
+        self._tiles.clear()
+
+    def _sync(self, strokes):
+        n = len(self._strokes)
+        if len(strokes) < n or strokes[:n] != self._strokes:
+            self.invalidate()
+            n = 0
+        for stroke in strokes[n:]:
+            for pos in stroke.get_tiles():
+                self._tiles.setdefault(pos, []).append(stroke)
+            self._strokes.append(stroke)
+
+    def get_stroke_at(self, strokes, x, y):
+        """Returns the topmost stroke touching a pixel, or None
+
+        :param list strokes: the layer's strokes, bottom to top
+        :param int x: model X coordinate of the pixel
+        :param int y: model Y coordinate of the pixel
+        :rtype: StrokeShape
+        """
+        self._sync(strokes)
+        pos = (x/N, y/N)
+        for stroke in reversed(self._tiles.get(pos, ())):
+            if stroke.touches_pixel(x, y):
+                return stroke
+        return None
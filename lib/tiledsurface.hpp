@@ -78,6 +78,12 @@ public:
       return mypaint_surface_get_alpha((MyPaintSurface *)c_surface, x, y, radius);
   }
 
+  // Forget tile buffers fetched during the current atomic section.
+  // Call after replacing or freezing tiles in the Python tiledict.
+  void invalidate_tile_store() {
+      mypaint_python_tiled_surface_clear_tile_store(c_surface);
+  }
+
   MyPaintSurface *get_surface_interface() {
     return (MyPaintSurface*)c_surface;
   }
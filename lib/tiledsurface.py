@@ -16,6 +16,10 @@ import time
 import sys
 import os
 import contextlib
+import zlib
+import weakref
+import tempfile
+from collections import OrderedDict
 import logging
 logger = logging.getLogger(__name__)
 
@@ -25,6 +29,9 @@ import mypaintlib
 import helpers
 import math
 import pixbufsurface
+from tilemap import TileMap
+
+from gi.repository import GObject
 
 
 ## Constants: tile sizes and mipmaps
@@ -135,28 +142,348 @@ for mode in range(NUM_COMBINE_MODES):
 ## Tile class and marker tile constants
 
 class Tile (object):
-    def __init__(self, copy_from=None):
+    def __init__(self, copy_from=None, solid=None):
+        """Initialize, with zeroed, copied, or solid pixels
+
+        :param Tile copy_from: tile to copy the pixels of
+        :param tuple solid: a single premultiplied RGBA colour for the
+          whole tile. Solid tiles store no pixel array until written to.
+        """
         object.__init__(self)
+        self._readonly = False
+        self._packed = None
+        self._solid = None
         # note: pixels are stored with premultiplied alpha
         #       15bits are used, but fully opaque or white is stored as 2**15 (requiring 16 bits)
         #       This is to allow many calcuations to divide by 2**15 instead of (2**16-1)
         if copy_from is None:
-            self.rgba = zeros((N, N, 4), 'uint16')
-        else:
+            if solid is None:
+                self.rgba = zeros((N, N, 4), 'uint16')
+            else:
+                self._solid = tuple(int(c) for c in solid)
+        elif copy_from._solid is not None:
+            # Stays compact until written to
+            self._solid = copy_from._solid
+        elif 'rgba' in copy_from.__dict__:
             self.rgba = copy_from.rgba.copy()
-        self.readonly = False
+        else:
+            # Don't keep the unpacked pixels around on the source too
+            self.rgba = copy_from._unpack()
 
     def copy(self):
         return Tile(copy_from=self)
 
+    @property
+    def readonly(self):
+        """Whether the pixels are shared, and must be copied to write
+
+        Read-only tiles are immutable, so `tile_memory` can compress them.
+        """
+        return self._readonly
+
+    @readonly.setter
+    def readonly(self, value):
+        if value and not self._readonly:
+            tile_memory.add(self)
+        self._readonly = value
+
+    def __getattr__(self, name):
+        # Only reached if normal lookup fails: for solid or packed pixels
+        if name != 'rgba':
+            raise AttributeError(name)
+        d = self.__dict__
+        if d.get('_solid') is not None:
+            if d['_readonly']:
+                return _get_solid_array(self._solid)
+            # Writable pixels may change, so expand them for good
+            rgba = self.rgba = empty((N, N, 4), 'uint16')
+            rgba[:, :] = self._solid
+            self._solid = None
+            return rgba
+        if d.get('_packed') is not None:
+            rgba = self.rgba = self._unpack()
+            tile_memory.unpacked(self)
+            return rgba
+        raise AttributeError(name)
+
+    def _unpack(self):
+        data = zlib.decompress(self._packed)
+        return numpy.fromstring(data, 'uint16').reshape((N, N, 4))
+
+    def _pack(self):
+        """Drops the raw pixels of a read-only tile, keeping them packed
+
+        Tiles of a single colour are made solid instead of compressed.
+
+        :returns: the size of the packed pixels, in bytes
+        """
+        assert self._readonly
+        if self._packed is None:
+            rgba = self.rgba
+            first = rgba[0, 0]
+            if (rgba == first).all():
+                self._solid = tuple(int(c) for c in first)
+                del self.rgba
+                return 0
+            self._packed = zlib.compress(rgba.tostring(), 1)
+        del self.rgba
+        return len(self._packed)
+
+
+def _get_solid_array(solid, kind='rgba16'):
+    """Shared pixels for a solid tile's colour, for reading only
+
+    :param tuple solid: the premultiplied RGBA16 colour
+    :param str kind: "rgba16", or an 8-bit "rgba8" or "rgbu8" conversion
+    """
+    key = (solid, kind)
+    arr = _solid_arrays.get(key)
+    if arr is None:
+        rgba = _solid_arrays.get((solid, 'rgba16'))
+        if rgba is None:
+            rgba = empty((N, N, 4), 'uint16')
+            rgba[:, :] = solid
+            _solid_arrays[(solid, 'rgba16')] = rgba
+        if kind == 'rgba16':
+            arr = rgba
+        else:
+            arr = empty((N, N, 4), 'uint8')
+            if kind == 'rgba8':
+                mypaintlib.tile_convert_rgba16_to_rgba8(rgba, arr)
+            else:
+                mypaintlib.tile_convert_rgbu16_to_rgbu8(rgba, arr)
+            _solid_arrays[key] = arr
+    return arr
+
+#: Cache for _get_solid_array(), trimmed by TileMemory.collect()
+_solid_arrays = {}
+_SOLID_ARRAYS_MAX = 256
+
+
+def _tile_bytes(tile):
+    """Memory used by a tile's pixels, in bytes"""
+    if tile._solid is not None:
+        return 0
+    size = 0
+    if 'rgba' in tile.__dict__:
+        size += TileMemory.TILE_BYTES
+    if tile._packed is not None:
+        size += len(tile._packed)
+    return size
+
+
+def _tile_pixels(tile):
+    """Pixels of any tile, for reading only, without expanding solids"""
+    if tile._solid is not None:
+        return _get_solid_array(tile._solid)
+    return tile.rgba
+
+
+class TileMemory (object):
+    """Keeps the raw pixels of read-only tiles within a memory budget
+
+    Read-only tiles are the ones shared with undo snapshots, hidden
+    animation cels and the like, and they make up most of the tiles in
+    a long session. When more of them hold raw pixels than the budget
+    allows, the least recently used ones are compressed with zlib, and
+    their raw pixels dropped. Accessing `Tile.rgba` decompresses them
+    again. Writable tiles are never compressed.
+
+    Tiles are shared between the surfaces of every open document, so
+    there is one budget for the whole process: `tile_memory`.
+
+    Raw pixels are only dropped by `collect()`, which surfaces call
+    after ``end_atomic()`` and when taking snapshots. The C++ side keeps
+    bare pointers to tile memory until its atomic section ends.
+    """
+
+    #: Default budget for raw read-only pixels, in bytes
+    DEFAULT_BUDGET = 1024 * 1024 * 1024
+
+    #: Bytes used by one tile's raw pixels
+    TILE_BYTES = N * N * 4 * 2
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        object.__init__(self)
+        self.budget = budget
+        self.raw_size = 0
+        self.packed_size = 0
+        self._raw = OrderedDict()  # id(tile) -> weakref, in LRU order
+        self._refs = {}  # id(tile) -> weakref, for every tracked tile
+        self._packed_sizes = {}  # id(tile) -> packed size in bytes
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self.collect()
+
+    def add(self, tile):
+        """Starts tracking a tile which has just become read-only"""
+        key = id(tile)
+        if key in self._refs:
+            return
+        ref = weakref.ref(tile, lambda r, key=key: self._forget(key))
+        self._refs[key] = ref
+        if tile._solid is not None:
+            return
+        if 'rgba' in tile.__dict__:
+            self._raw[key] = ref
+            self.raw_size += self.TILE_BYTES
+        else:
+            # Tiles read back from a spill file start out packed
+            size = len(tile._packed)
+            self._packed_sizes[key] = size
+            self.packed_size += size
+
+    def touch(self, tile):
+        """Marks a tile as recently used"""
+        ref = self._raw.pop(id(tile), None)
+        if ref is not None:
+            self._raw[id(tile)] = ref
+
+    def unpacked(self, tile):
+        """Records that a packed tile holds raw pixels again"""
+        key = id(tile)
+        ref = self._refs.get(key)
+        if ref is not None and key not in self._raw:
+            self._raw[key] = ref
+            self.raw_size += self.TILE_BYTES
+
+    def _forget(self, key):
+        self._refs.pop(key, None)
+        if self._raw.pop(key, None) is not None:
+            self.raw_size -= self.TILE_BYTES
+        self.packed_size -= self._packed_sizes.pop(key, 0)
+
+    def collect(self):
+        """Compresses least recently used tiles until within budget"""
+        if len(_solid_arrays) > _SOLID_ARRAYS_MAX:
+            _solid_arrays.clear()
+        if self.raw_size <= self.budget:
+            return
+        n = 0
+        while self.raw_size > self.budget and self._raw:
+            key, ref = self._raw.popitem(last=False)
+            self.raw_size -= self.TILE_BYTES
+            tile = ref()
+            if tile is None:
+                continue
+            size = tile._pack()
+            if key not in self._packed_sizes:
+                self._packed_sizes[key] = size
+                self.packed_size += size
+            n += 1
+        logger.debug("Packed %d tiles: %.1f MiB raw, %.1f MiB packed", n,
+                     self.raw_size / 1048576.0,
+                     self.packed_size / 1048576.0)
+
+
+#: The process-wide read-only tile budget
+tile_memory = TileMemory()
+
+
+class MipmapScheduler (object):
+    """Rebuilds dirty mipmap tiles in the background
+
+    Writing to a surface marks the tiles above it in each mipmap level as
+    dirty, recording the surface's current generation number against
+    each. Dirty tiles keep their previous pixels until they are rebuilt.
+    This scheduler rebuilds them when the main loop is idle, a few at a
+    time, oldest generation first.
+
+    Reads of dirty tiles normally rebuild them on the spot. Within a
+    `deferred()` block, which display rendering uses, they are only
+    rebuilt until a time budget runs out. After that the tile's previous
+    pixels are used, or a scaled-up quarter of a coarser level's if it
+    had none. The observers are told about those areas once they have
+    been rebuilt for real, so that they can be redrawn.
+    """
+
+    #: Seconds of rebuilding per idle callback
+    IDLE_BUDGET = 0.01
+
+    #: Default seconds of on-demand rebuilding per deferred() block
+    RENDER_BUDGET = 0.005
+
+    def __init__(self):
+        object.__init__(self)
+        self.observers = []  # callbacks: f(x, y, w, h), model coords
+        self._pending = weakref.WeakSet()  # root surfaces with dirt
+        self._stale = weakref.WeakKeyDictionary()  # root: {(level, pos)}
+        self._deadline = None
+        self._idle_srcid = None
+
+    def schedule(self, surface):
+        """Queues a root surface's dirty mipmaps for rebuilding"""
+        self._pending.add(surface)
+        if self._idle_srcid is None:
+            self._idle_srcid = GObject.idle_add(
+                self._idle_cb, priority=GObject.PRIORITY_LOW)
+
+    @contextlib.contextmanager
+    def deferred(self, budget=None):
+        """Context manager allowing stale mipmap tiles to be returned"""
+        if budget is None:
+            budget = self.RENDER_BUDGET
+        old_deadline = self._deadline
+        self._deadline = time.time() + budget
+        try:
+            yield
+        finally:
+            self._deadline = old_deadline
+
+    def can_rebuild_now(self):
+        """Whether a dirty tile being read should be rebuilt right away"""
+        return self._deadline is None or time.time() < self._deadline
+
+    def served_stale(self, surface, tx, ty):
+        """Records that stale pixels were returned for a mipmap tile"""
+        root = surface._mipmaps[0]
+        stale = self._stale.get(root)
+        if stale is None:
+            stale = self._stale[root] = set()
+        stale.add((surface.mipmap_level, (tx, ty)))
+        self.schedule(root)
+
+    def finish_all(self):
+        """Rebuilds all dirty mipmap tiles now"""
+        self._run(None)
+
+    def _idle_cb(self):
+        if self._run(time.time() + self.IDLE_BUDGET):
+            return True
+        self._idle_srcid = None
+        return False
+
+    def _run(self, deadline):
+        """Rebuilds until a deadline, returning whether work remains"""
+        redraw_bbox = helpers.Rect()
+        for root in list(self._pending):
+            # Areas which have been drawn from stale data go first
+            stale = self._stale.pop(root, set())
+            for level, pos in stale:
+                surface = root._mipmaps[level]
+                if pos in surface._dirty:
+                    surface._regenerate_mipmap(*pos)
+                size = N << level
+                redraw_bbox.expandToIncludeRect(
+                    helpers.Rect(pos[0]*size, pos[1]*size, size, size))
+            if root._rebuild_mipmaps(deadline):
+                self._pending.discard(root)
+            if deadline is not None and time.time() > deadline:
+                break
+        if redraw_bbox.w > 0 and redraw_bbox.h > 0:
+            for f in self.observers:
+                f(*redraw_bbox)
+        return len(self._pending) > 0
+
+
+#: The process-wide mipmap rebuild scheduler
+mipmap_scheduler = MipmapScheduler()
+
 
 # tile for read-only operations on empty spots
 transparent_tile = Tile()
-transparent_tile.readonly = True
-
-# tile with invalid pixel memory (needs refresh)
-mipmap_dirty_tile = Tile()
-del mipmap_dirty_tile.rgba
+transparent_tile._readonly = True  # and never packed: its rgba is compared
 
 
 ## Helper funcs
@@ -171,11 +498,206 @@ def get_tiles_bbox(tiles):
 ## Class defs: surfaces
 
 class SurfaceSnapshot (object):
-    pass
+    """Copy-on-write state of a surface's tiles, for undo
+
+    Snapshots share their tiles with the surface and with each other.
+    Undo histories can move the tiles which nothing newer shares out to
+    a `SnapshotSpill` file with `spill()`. Reading `tiledict` brings them
+    back into memory transparently.
+    """
+
+    def __init__(self, tiledict=None):
+        object.__init__(self)
+        if tiledict is None:
+            tiledict = TileMap()
+        self._tiledict = tiledict
+        self._spill = None
+        self._spilled = {}  # (tx, ty) -> SnapshotSpill record
+        self._surface_ref = None  # the surface it was taken of, if any
+
+    @property
+    def tiledict(self):
+        """The snapshot's TileMap, read back from any spill file"""
+        if self._spilled:
+            self._restore()
+        return self._tiledict
+
+    @tiledict.setter
+    def tiledict(self, tiledict):
+        self._tiledict = tiledict
+        self._spill = None
+        self._spilled = {}
+
+    @property
+    def spilled(self):
+        """Whether some of the snapshot's tiles are in a spill file"""
+        return bool(self._spilled)
+
+    def iter_unseen_tiles(self, seen, found):
+        """Yields the in-memory tiles not seen before
+
+        See `TileMap.iterunseen()`. Spilled tiles are not yielded.
+        """
+        return self._tiledict.iterunseen(seen, found)
+
+    def count_unshared_bytes(self):
+        """Bytes of the in-memory tiles not shared with its surface
+
+        Only the chunks which differ from the surface's current tiles are
+        looked at, so this is cheap for snapshots taken by small edits.
+        Snapshots of surfaces which no longer exist count all their tiles.
+        """
+        surface = self._surface_ref and self._surface_ref()
+        if surface is None:
+            tiles = self._tiledict.iterunseen(set(), set())
+        else:
+            tiledict = self._tiledict
+            tiles = (tiledict[pos] for pos in tiledict.diff(surface.tiledict)
+                     if pos in tiledict)
+        return sum(_tile_bytes(tile) for tile in tiles)
+
+    def spill(self, spill, keep):
+        """Moves the tiles which aren't kept to a spill file
+
+        :param SnapshotSpill spill: where to write the tiles
+        :param set keep: ids of tiles which must stay in memory, usually
+          because something newer shares them
+        :returns: the number of bytes moved out of memory
+        """
+        assert self._spill in (None, spill)
+        moved = []
+        for pos, tile in self._tiledict.iteritems():
+            if id(tile) in keep or tile is transparent_tile:
+                continue
+            if tile._solid is not None:
+                continue
+            moved.append((pos, tile))
+        if not moved:
+            return 0
+        # Others may still be reading the old map, e.g. strokemap tasks
+        tiledict = self._tiledict.copy()
+        size = 0
+        for pos, tile in moved:
+            size += _tile_bytes(tile)
+            self._spilled[pos] = spill.write(tile)
+            tiledict.pop(pos)
+        self._tiledict = tiledict
+        self._spill = spill
+        return size
+
+    def _restore(self):
+        tiledict = self._tiledict
+        spill = self._spill
+        for pos, record in self._spilled.iteritems():
+            tiledict[pos] = spill.read(record)
+        logger.debug("Restored %d spilled tiles", len(self._spilled))
+        self._spilled = {}
+
+
+class _SpillRecord (object):
+    """Where a tile's packed pixels are in a spill file"""
+
+    def __init__(self, offset, length):
+        object.__init__(self)
+        self.offset = offset
+        self.length = length
+        self.tile_ref = None  # last tile read from the record, if alive
+
+
+class SnapshotSpill (object):
+    """Anonymous temporary file holding tiles spilled from snapshots
+
+    Tiles are written packed, once each: spilling a tile which was
+    already written, or read back, reuses its record. Records are only
+    referred to by spilled snapshots, and the file is compacted by
+    `collect()` once most of it belongs to records which have died.
+    """
+
+    #: Files smaller than this are never compacted
+    MIN_COMPACT_SIZE = 16 * 1024 * 1024
+
+    def __init__(self):
+        object.__init__(self)
+        self._file = None
+        self._size = 0
+        self._records = weakref.WeakSet()
+        self._tile_records = weakref.WeakKeyDictionary()  # tile -> record
+
+    def _get_file(self):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix="mypaint-undo-")
+            self._size = 0
+        return self._file
+
+    def write(self, tile):
+        """Appends a read-only tile's pixels, returning its record"""
+        record = self._tile_records.get(tile)
+        if record is not None:
+            return record
+        data = tile._packed
+        if data is None:
+            data = zlib.compress(_tile_pixels(tile).tostring(), 1)
+        f = self._get_file()
+        f.seek(self._size)
+        f.write(data)
+        record = _SpillRecord(self._size, len(data))
+        self._size += len(data)
+        self._records.add(record)
+        self._tile_records[tile] = record
+        record.tile_ref = weakref.ref(tile)
+        return record
+
+    def read(self, record):
+        """Reads a record back as a packed, read-only tile"""
+        tile = record.tile_ref and record.tile_ref()
+        if tile is not None:
+            return tile
+        f = self._file
+        f.seek(record.offset)
+        data = f.read(record.length)
+        tile = Tile(solid=(0, 0, 0, 0))
+        tile._solid = None
+        tile._packed = data
+        tile.readonly = True
+        self._tile_records[tile] = record
+        record.tile_ref = weakref.ref(tile)
+        return tile
+
+    def collect(self):
+        """Compacts the file if most of it is unused"""
+        if self._file is None:
+            return
+        records = sorted(self._records, key=lambda r: r.offset)
+        if not records:
+            self._file.close()
+            self._file = None
+            self._size = 0
+            return
+        used = sum(r.length for r in records)
+        if self._size < max(self.MIN_COMPACT_SIZE, 2 * used):
+            return
+        old = self._file
+        self._file = None
+        new = self._get_file()
+        for record in records:
+            old.seek(record.offset)
+            new.write(old.read(record.length))
+            record.offset = self._size
+            self._size += record.length
+        old.close()
+        logger.debug("Compacted undo spill file to %.1f MiB",
+                     self._size / 1048576.0)
+
+    def close(self):
+        """Discards the file: spilled snapshots can't be read afterwards"""
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._size = 0
+        self._records = weakref.WeakSet()
+        self._tile_records = weakref.WeakKeyDictionary()
 
 
-# TODO:
-# - move the tile storage from MyPaintSurface to a separate class
 class MyPaintSurface (object):
     """Tile-based surface
 
@@ -194,9 +716,14 @@ class MyPaintSurface (object):
 
         # TODO: pass just what it needs access to, not all of self
         self._backend = mypaintlib.TiledSurface(self)
-        self.tiledict = {}
+        self.tiledict = TileMap()
         self.observers = []
 
+        # Mipmap tiles needing a rebuild, with the root surface's
+        # generation number when they were last marked dirty.
+        self._dirty = {}  # (tx, ty) -> generation
+        self._mipmap_generation = 0
+
         # Used to implement repeating surfaces, like Background
         if looped_size[0] % N or looped_size[1] % N:
             raise ValueError, 'Looped size must be multiples of tile size'
@@ -249,6 +776,8 @@ class MyPaintSurface (object):
         bbox = self._backend.end_atomic()
         if (bbox[2] > 0 and bbox[3] > 0):
             self.notify_observers(*bbox)
+        self._mipmap_generation += 1
+        tile_memory.collect()
 
     @property
     def backend(self):
@@ -260,7 +789,9 @@ class MyPaintSurface (object):
 
     def clear(self):
         tiles = self.tiledict.keys()
-        self.tiledict = {}
+        self.tiledict = TileMap()
+        self._backend.invalidate_tile_store()
+        self._dirty.clear()
         self.notify_observers(*get_tiles_bbox(tiles))
         if self.mipmap: self.mipmap.clear()
 
@@ -294,25 +825,86 @@ class MyPaintSurface (object):
         yield numpy_tile
         self._set_tile_numpy(tx, ty, numpy_tile, readonly)
 
-    def _regenerate_mipmap(self, t, tx, ty):
+    def _regenerate_mipmap(self, tx, ty):
+        """Rebuilds a dirty mipmap tile from the level below, returning it"""
+        parent = self.parent
+        srcs = []
+        for x in xrange(2):
+            for y in xrange(2):
+                pos = (tx*2 + x, ty*2 + y)
+                if pos in parent._dirty:
+                    src = parent._regenerate_mipmap(*pos)
+                else:
+                    src = parent.tiledict.get(pos, transparent_tile)
+                srcs.append((x, y, src))
+        del self._dirty[(tx, ty)]
+
+        # Downscaling four tiles of the same solid colour is a no-op
+        solid = srcs[0][2]._solid
+        if solid is not None and all(src._solid == solid
+                                     for x, y, src in srcs):
+            t = Tile(solid=solid)
+            self.tiledict[(tx, ty)] = t
+            return t
+
         t = Tile()
         self.tiledict[(tx, ty)] = t
         empty = True
-
-        for x in xrange(2):
-            for y in xrange(2):
-                src = self.parent.tiledict.get((tx*2 + x, ty*2 + y), transparent_tile)
-                if src is mipmap_dirty_tile:
-                    src = self.parent._regenerate_mipmap(src, tx*2 + x, ty*2 + y)
-                mypaintlib.tile_downscale_rgba16(src.rgba, t.rgba, x*N/2, y*N/2)
-                if src.rgba is not transparent_tile.rgba:
-                    empty = False
+        for x, y, src in srcs:
+            src_rgba = _tile_pixels(src)
+            mypaintlib.tile_downscale_rgba16(src_rgba, t.rgba, x*N/2, y*N/2)
+            if src_rgba is not transparent_tile.rgba:
+                empty = False
         if empty:
             # rare case, no need to speed it up
             del self.tiledict[(tx, ty)]
             t = transparent_tile
         return t
 
+    def _rebuild_mipmaps(self, deadline=None):
+        """Rebuilds dirty mipmap tiles, returning True once all are done
+
+        :param deadline: time.time() to stop at, or None to finish
+
+        Levels are rebuilt from the finest up, and the tiles within
+        each level in the order they were dirtied.
+        """
+        for mipmap in self._mipmaps[1:]:
+            dirty = sorted(mipmap._dirty.iteritems(), key=lambda i: i[1])
+            for pos, gen in dirty:
+                if pos in mipmap._dirty:
+                    mipmap._regenerate_mipmap(*pos)
+                if deadline is not None and time.time() > deadline:
+                    return not any(m._dirty for m in self._mipmaps)
+        return True
+
+    def _get_stale_tile_numpy(self, tx, ty):
+        """Fallback pixels for a dirty mipmap tile, for reading only
+
+        The tile's previous pixels are used if it has any. Otherwise the
+        matching part of the nearest coarser level with pixels is scaled
+        up. The scheduler redraws the area once it has been rebuilt.
+        """
+        mipmap_scheduler.served_stale(self, tx, ty)
+        t = self.tiledict.get((tx, ty))
+        if t is not None:
+            return _tile_pixels(t)
+        coarser = self.mipmap
+        fac = 1
+        while coarser is not None:
+            fac *= 2
+            t = coarser.tiledict.get((tx/fac, ty/fac))
+            if t is not None:
+                break
+            coarser = coarser.mipmap
+        if t is None:
+            return transparent_tile.rgba
+        n = N/fac
+        x0 = (tx % fac) * n
+        y0 = (ty % fac) * n
+        part = _tile_pixels(t)[y0:y0+n, x0:x0+n]
+        return part.repeat(fac, axis=0).repeat(fac, axis=1)
+
     def _get_tile_numpy(self, tx, ty, readonly):
         # OPTIMIZE: do some profiling to check if this function is a bottleneck
         #           yes it is
@@ -323,6 +915,12 @@ class MyPaintSurface (object):
             tx = tx % (self.looped_size[0] / N)
             ty = ty % (self.looped_size[1] / N)
 
+        if (tx, ty) in self._dirty:
+            if mipmap_scheduler.can_rebuild_now():
+                self._regenerate_mipmap(tx, ty)
+            else:
+                return self._get_stale_tile_numpy(tx, ty)
+
         t = self.tiledict.get((tx, ty))
         if t is None:
             if readonly:
@@ -330,17 +928,35 @@ class MyPaintSurface (object):
             else:
                 t = Tile()
                 self.tiledict[(tx, ty)] = t
-        if t is mipmap_dirty_tile:
-            t = self._regenerate_mipmap(t, tx, ty)
-        if t.readonly and not readonly:
-            # shared memory, get a private copy for writing
-            t = t.copy()
-            self.tiledict[(tx, ty)] = t
+        if t.readonly:
+            if not readonly:
+                # shared memory, get a private copy for writing
+                t = t.copy()
+                self.tiledict[(tx, ty)] = t
+            else:
+                tile_memory.touch(t)
         if not readonly:
             # assert self.mipmap_level == 0
             self._mark_mipmap_dirty(tx, ty)
+        elif t._solid is not None:
+            # don't expand solid tiles just for reading
+            return _get_solid_array(t._solid)
         return t.rgba
 
+    def _get_tiles_for_writing(self, positions):
+        """Fetches several tiles for writing, for the native tile store
+
+        :param list positions: tile positions, as (tx, ty) tuples
+        :returns: writable NumPy arrays, in the same order
+        :rtype: list
+
+        Called once per end_atomic() with all the tiles the queued dabs
+        touch, so that the brush engine can paint them in parallel
+        without calling back into Python.
+        """
+        get = self._get_tile_numpy
+        return [get(tx, ty, False) for tx, ty in positions]
+
     def _set_tile_numpy(self, tx, ty, obj, readonly):
         pass # Data can be modified directly, no action needed
 
@@ -348,13 +964,17 @@ class MyPaintSurface (object):
         #assert self.mipmap_level == 0
         if not self._mipmaps:
             return
+        gen = self._mipmap_generation
         for level, mipmap in enumerate(self._mipmaps):
             if level == 0:
                 continue
             fac = 2**(level)
-            if mipmap.tiledict.get((tx/fac, ty/fac), None) == mipmap_dirty_tile:
-                break
-            mipmap.tiledict[(tx/fac, ty/fac)] = mipmap_dirty_tile
+            pos = (tx/fac, ty/fac)
+            if mipmap._dirty.get(pos) == gen:
+                # and so are all the levels above it
+                return
+            mipmap._dirty[pos] = gen
+        mipmap_scheduler.schedule(self)
 
     def blit_tile_into(self, dst, dst_has_alpha, tx, ty, mipmap_level=0):
         # used mainly for saving (transparent PNG)
@@ -366,6 +986,17 @@ class MyPaintSurface (object):
 
         assert dst.shape[2] == 4
 
+        # Solid tiles just need filling in
+        solid = self._get_solid(tx, ty)
+        if solid is not None:
+            if dst.dtype == 'uint16':
+                dst[:, :, :] = solid
+                return
+            elif dst.dtype == 'uint8':
+                kind = dst_has_alpha and 'rgba8' or 'rgbu8'
+                dst[:, :, :] = _get_solid_array(solid, kind)
+                return
+
         with self.tile_request(tx, ty, readonly=True) as src:
 
             if src is transparent_tile.rgba:
@@ -397,48 +1028,125 @@ class MyPaintSurface (object):
         # Optimization: for some compositing modes, e.g. source-over, an empty
         # source tile leaves the backdrop unchanged.
         if self._SKIP_COMPOSITE_IF_EMPTY[mode]:
-            if (tx, ty) not in self.tiledict:
+            if (tx, ty) not in self.tiledict and (tx, ty) not in self._dirty:
                 return
             if opacity == 0:
                 return
 
+        # Solid tiles: an opaque one over anything in normal mode is just
+        # a fill, and the shared pixels saves expanding the others.
+        solid = self._get_solid(tx, ty)
+        if solid is not None:
+            if self._SKIP_COMPOSITE_IF_EMPTY[mode] and not any(solid):
+                return
+            if (mode == DEFAULT_COMBINE_MODE and opacity == 1.0
+                    and solid[3] == 1<<15):
+                if dst_has_alpha:
+                    dst[:, :, :] = solid
+                else:
+                    dst[:, :, :3] = solid[:3]
+                return
+            src = _get_solid_array(solid)
+            mypaintlib.tile_combine(mode, src, dst, dst_has_alpha, opacity)
+            return
+
         with self.tile_request(tx, ty, readonly=True) as src:
             mypaintlib.tile_combine(mode, src, dst, dst_has_alpha, opacity)
 
+    def _get_solid(self, tx, ty):
+        """The colour of a solid tile at a position, or None"""
+        if self.looped or (tx, ty) in self._dirty:
+            return None
+        t = self.tiledict.get((tx, ty))
+        if t is None:
+            return None
+        return t._solid
+
+    def get_combine_src(self, tx, ty, mipmap_level=0, opacity=1.0,
+                        mode=DEFAULT_COMBINE_MODE):
+        """Source pixels for compositing one tile, as in `composite_tile()`
+
+        Returns a readonly NumPy array for use in a render plan (see
+        `mypaintlib.tile_combine_plan()`), or None if compositing the tile
+        would leave the backdrop unchanged.
+        """
+        if self.mipmap_level < mipmap_level:
+            return self.mipmap.get_combine_src(tx, ty, mipmap_level,
+                                               opacity, mode)
+        if self._SKIP_COMPOSITE_IF_EMPTY[mode]:
+            if (tx, ty) not in self.tiledict and (tx, ty) not in self._dirty:
+                return None
+            if opacity == 0:
+                return None
+            solid = self._get_solid(tx, ty)
+            if solid is not None and not any(solid):
+                return None
+        return self._get_tile_numpy(tx, ty, True)
+
 
     ## Snapshotting
 
     def save_snapshot(self):
         """Creates and returns a snapshot of the surface"""
-        sshot = SurfaceSnapshot()
-        for t in self.tiledict.itervalues():
-            t.readonly = True
-        sshot.tiledict = self.tiledict.copy()
+        # Copying freezes the tiles, making them copy-on-write
+        sshot = SurfaceSnapshot(self.tiledict.copy())
+        sshot._surface_ref = weakref.ref(self)
+        self._backend.invalidate_tile_store()
+        tile_memory.collect()
         return sshot
 
 
-    def load_snapshot(self, sshot):
-        """Loads a saved snapshot, replacing the internal tiledict"""
-        self._load_tiledict(sshot.tiledict)
+    def load_snapshot(self, sshot, tiles=None):
+        """Loads a saved snapshot, replacing the internal tiledict
+
+        :param SurfaceSnapshot sshot: the snapshot to load
+        :param tiles: if given, the positions of the only tiles which
+          can differ from the snapshot. Just these are compared and
+          loaded, so the cost is in proportion to their number.
+        """
+        if tiles is None:
+            self._load_tiledict(sshot.tiledict)
+        else:
+            self._load_tiles(sshot.tiledict, tiles)
 
 
     def _load_tiledict(self, d):
         """Efficiently loads a tiledict, and notifies the observers"""
-        if d == self.tiledict:
+        # Only the chunks which differ need to be compared
+        dirty = self.tiledict.diff(d)
+        if not dirty:
             # common case optimization, called via stroke.redo()
-            # testcase: comparison above (if equal) takes 0.6ms, code below 30ms
             return
-        old = set(self.tiledict.iteritems())
         self.tiledict = d.copy()
-        new = set(self.tiledict.iteritems())
-        dirty = old.symmetric_difference(new)
-        for pos, tile in dirty:
+        self._backend.invalidate_tile_store()
+        for pos in dirty:
             self._mark_mipmap_dirty(*pos)
-        bbox = get_tiles_bbox([pos for (pos, tile) in dirty])
+        bbox = get_tiles_bbox(dirty)
         if not bbox.empty():
             self.notify_observers(*bbox)
 
 
+    def _load_tiles(self, d, tiles):
+        """Loads some tiles from a tiledict, and notifies the observers"""
+        tiledict = self.tiledict
+        dirty = []
+        for pos in tiles:
+            tile = d.get(pos)
+            if tiledict.get(pos) is tile:
+                continue
+            if tile is None:
+                tiledict.pop(pos)
+            else:
+                tiledict[pos] = tile
+            dirty.append(pos)
+        if not dirty:
+            return
+        self._backend.invalidate_tile_store()
+        for pos in dirty:
+            self._mark_mipmap_dirty(*pos)
+        self.notify_observers(*get_tiles_bbox(dirty))
+
+
     ## Loading tile data
 
 
@@ -447,9 +1155,19 @@ class MyPaintSurface (object):
         self.load_snapshot(other.save_snapshot())
 
 
+    def load_tiles(self, tiles):
+        """Replaces all tile data with new tiles
+
+        :param dict tiles: tiles keyed by position, to be owned by the
+          surface from now on, as made by the background PNG decoding
+          in `lib.oraload`
+        """
+        self._load_tiles(tiles, set(tiles).union(self.tiledict.iterkeys()))
+
+
     def _load_from_pixbufsurface(self, s):
         dirty_tiles = set(self.tiledict.keys())
-        self.tiledict = {}
+        self.tiledict = TileMap()
 
         for tx, ty in s.get_tiles():
             with self.tile_request(tx, ty, readonly=False) as dst:
@@ -486,7 +1204,7 @@ class MyPaintSurface (object):
         """Load from a PNG, one tilerow at a time, discarding empty tiles.
         """
         dirty_tiles = set(self.tiledict.keys())
-        self.tiledict = {}
+        self.tiledict = TileMap()
 
         state = {}
         state['buf'] = None # array of height N, width depends on image
@@ -561,6 +1279,15 @@ class MyPaintSurface (object):
             kwargs['single_tile_pattern'] = True
         pixbufsurface.save_as_png(self, filename, *args, **kwargs)
 
+    def encode_as_png(self, *args, **kwargs):
+        """Encodes as PNG data, like `save_as_png()` (see pixbufsurface)"""
+        if not 'alpha' in kwargs:
+            kwargs['alpha'] = True
+
+        if len(self.tiledict) == 1:
+            kwargs['single_tile_pattern'] = True
+        return pixbufsurface.encode_as_png(self, *args, **kwargs)
+
     def get_tiles(self):
         return self.tiledict
 
@@ -571,9 +1298,23 @@ class MyPaintSurface (object):
         return not self.tiledict
 
     def remove_empty_tiles(self):
-        """Removes tiles from the tiledict which contain no data"""
-        for pos, data in self.tiledict.items():
-            if not data.rgba.any():
+        """Removes tiles from the tiledict which contain no data
+
+        Writable tiles filled with a single colour are made solid too.
+        """
+        for pos, tile in self.tiledict.items():
+            solid = tile._solid
+            if solid is None:
+                rgba = tile.rgba
+                first = rgba[0, 0]
+                if not (rgba == first).all():
+                    continue
+                solid = tuple(int(c) for c in first)
+                if any(solid):
+                    if not tile.readonly:
+                        self.tiledict[pos] = Tile(solid=solid)
+                    continue
+            if not any(solid):
                 self.tiledict.pop(pos)
 
     def get_move(self, x, y, sort=True):
@@ -980,8 +1721,13 @@ def flood_fill(src, x, y, color, bbox, tolerance, dst):
     # Composite filled tiles into the destination surface
     mode = mypaintlib.CombineNormal
     for (tx, ty), src_tile in filled.iteritems():
-        with dst.tile_request(tx, ty, readonly=False) as dst_tile:
-            mypaintlib.tile_combine(mode, src_tile, dst_tile, True, 1.0)
+        # Completely filled tiles just replace what was there
+        first = src_tile[0, 0]
+        if first[3] == 1<<15 and (src_tile == first).all():
+            dst.tiledict[(tx, ty)] = Tile(solid=first)
+        else:
+            with dst.tile_request(tx, ty, readonly=False) as dst_tile:
+                mypaintlib.tile_combine(mode, src_tile, dst_tile, True, 1.0)
         dst._mark_mipmap_dirty(tx, ty)
     bbox = get_tiles_bbox(filled)
     dst.notify_observers(*bbox)
@@ -0,0 +1,240 @@
+# This file is part of MyPaint.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Persistent storage for a surface's tiles"""
+
+#: Chunks are squares of 2**CHUNK_SHIFT tiles on each side
+CHUNK_SHIFT = 4
+
+
+class TileMap (object):
+    """Mapping of tile positions to tiles, with cheap copies
+
+    Tiles are stored in square chunks of positions, and copies of the
+    map share their chunks until one of the maps writes to a chunk.
+    Copying, comparing, and finding the positions which differ between
+    two related maps therefore cost time in proportion to the number of
+    chunks, plus the chunks which differ, rather than the number of
+    tiles.
+
+    Copying also freezes tiles: every tile stored in the map since its
+    last copy gets its ``readonly`` flag set, so that surfaces will copy
+    it before writing to it. Tiles stored before then were frozen by
+    earlier copies, so this costs time in proportion to the number of
+    tiles stored since.
+
+    This supports the parts of the dict interface that surfaces use.
+    Keys are ``(tx, ty)`` tuples, and values are tile objects compared
+    by identity.
+
+    >>> class T (object):
+    ...     readonly = False
+    >>> a = TileMap()
+    >>> a[0, 0] = t0 = T()
+    >>> b = a.copy()
+    >>> t0.readonly
+    True
+    >>> a[100, 0] = T()
+    >>> sorted(a.keys()), sorted(b.keys())
+    ([(0, 0), (100, 0)], [(0, 0)])
+    >>> sorted(a.diff(b))
+    [(100, 0)]
+    >>> b == a.copy()
+    False
+    """
+
+    def __init__(self, items=()):
+        object.__init__(self)
+        self._chunks = {}  # (cx, cy) -> {(tx, ty): tile}
+        self._owned = set()  # chunk keys that are not shared
+        self._unfrozen = set()  # positions stored since the last copy
+        self._len = 0
+        for pos, tile in items:
+            self[pos] = tile
+
+    ## Internals
+
+    @staticmethod
+    def _chunk_key(pos):
+        return (pos[0] >> CHUNK_SHIFT, pos[1] >> CHUNK_SHIFT)
+
+    def _writable_chunk(self, ckey):
+        """Returns a chunk which can be modified, copying it if shared"""
+        chunk = self._chunks.get(ckey)
+        if ckey not in self._owned:
+            chunk = dict(chunk) if chunk else {}
+            self._chunks[ckey] = chunk
+            self._owned.add(ckey)
+        return chunk
+
+    def _remove(self, pos):
+        ckey = self._chunk_key(pos)
+        chunk = self._writable_chunk(ckey)
+        tile = chunk.pop(pos)
+        self._len -= 1
+        if not chunk:
+            del self._chunks[ckey]
+            self._owned.discard(ckey)
+        return tile
+
+    ## Copying and comparing
+
+    def copy(self):
+        """Returns a copy sharing this map's chunks, freezing new tiles"""
+        for pos in self._unfrozen:
+            tile = self.get(pos)
+            if tile is not None:
+                tile.readonly = True
+        self._unfrozen.clear()
+        self._owned.clear()
+        result = TileMap()
+        result._chunks = self._chunks.copy()
+        result._len = self._len
+        return result
+
+    def diff(self, other):
+        """Returns the set of positions whose tiles differ in another map
+
+        :param other: the map to compare against
+        :type other: TileMap
+        :rtype: set
+        """
+        changed = set()
+        for ckey in set(self._chunks).union(other._chunks):
+            a = self._chunks.get(ckey)
+            b = other._chunks.get(ckey)
+            if a is b:
+                continue
+            a = a or {}
+            b = b or {}
+            for pos, tile in a.iteritems():
+                if b.get(pos) is not tile:
+                    changed.add(pos)
+            for pos in b:
+                if pos not in a:
+                    changed.add(pos)
+        return changed
+
+    def iterunseen(self, seen, found):
+        """Yields the tiles not seen before, skipping seen chunks whole
+
+        :param set seen: ids of the chunks and tiles already visited
+        :param set found: ids of the chunks and tiles visited by this
+          call are added here, so that callers can merge them into
+          `seen` afterwards, or not
+
+        Maps copied from one another share most of their chunks, so
+        walking a set of related maps this way costs time in proportion
+        to the chunks which differ between them.
+
+        >>> class T (object):
+        ...     readonly = False
+        >>> a = TileMap([((0, 0), T()), ((100, 0), T())])
+        >>> b = a.copy()
+        >>> b[0, 0] = T()
+        >>> found = set()
+        >>> len(list(a.iterunseen(set(), found)))
+        2
+        >>> len(list(b.iterunseen(found, set())))
+        1
+        """
+        for chunk in self._chunks.itervalues():
+            key = id(chunk)
+            if key in seen or key in found:
+                continue
+            found.add(key)
+            for tile in chunk.itervalues():
+                key = id(tile)
+                if key in seen or key in found:
+                    continue
+                found.add(key)
+                yield tile
+
+    def __eq__(self, other):
+        if not isinstance(other, TileMap):
+            return NotImplemented
+        if self._len != other._len:
+            return False
+        return not self.diff(other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    ## Dict interface
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, pos):
+        chunk = self._chunks.get(self._chunk_key(pos))
+        return chunk is not None and pos in chunk
+
+    def __getitem__(self, pos):
+        chunk = self._chunks.get(self._chunk_key(pos))
+        if chunk is None:
+            raise KeyError(pos)
+        return chunk[pos]
+
+    def get(self, pos, default=None):
+        chunk = self._chunks.get(self._chunk_key(pos))
+        if chunk is None:
+            return default
+        return chunk.get(pos, default)
+
+    def __setitem__(self, pos, tile):
+        chunk = self._writable_chunk(self._chunk_key(pos))
+        if pos not in chunk:
+            self._len += 1
+        chunk[pos] = tile
+        self._unfrozen.add(pos)
+
+    def __delitem__(self, pos):
+        if pos not in self:
+            raise KeyError(pos)
+        self._remove(pos)
+
+    def pop(self, pos, *default):
+        if pos not in self:
+            if default:
+                return default[0]
+            raise KeyError(pos)
+        return self._remove(pos)
+
+    def iterkeys(self):
+        for chunk in self._chunks.itervalues():
+            for pos in chunk:
+                yield pos
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for chunk in self._chunks.itervalues():
+            for tile in chunk.itervalues():
+                yield tile
+
+    def iteritems(self):
+        for chunk in self._chunks.itervalues():
+            for item in chunk.iteritems():
+                yield item
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __repr__(self):
+        return "<TileMap %d tiles in %d chunks>" % (self._len,
+                                                    len(self._chunks))
@@ -5,6 +5,8 @@
 # it under the terms of the GNU General Public License as published by
 # the Free Software Foundation
 
+from bisect import bisect_left, bisect_right
+
 DEFAULT_OPACITIES = {
     'cel': 1./2, # The immediate next and previous cels
     'key': 1./2, # The cel keys that are after and before the current cel
@@ -28,11 +30,52 @@ DEFAULT_NEXTPREV = {
 
 class Frame(object):
     def __init__(self, is_key=False, skip_visible=False, cel=None, description=''):
+        self._owner = None
         self.is_key = is_key
         self.description = description
         self.cel = cel
         self.skip_visible = skip_visible
 
+    def _changed(self):
+        if self._owner is not None:
+            self._owner.revision += 1
+
+    @property
+    def is_key(self):
+        return self._is_key
+
+    @is_key.setter
+    def is_key(self, value):
+        self._is_key = value
+        self._changed()
+
+    @property
+    def skip_visible(self):
+        return self._skip_visible
+
+    @skip_visible.setter
+    def skip_visible(self, value):
+        self._skip_visible = value
+        self._changed()
+
+    @property
+    def description(self):
+        return self._description
+
+    @description.setter
+    def description(self, value):
+        self._description = value
+        self._changed()
+
+    @property
+    def cel(self):
+        return self._cel
+
+    @cel.setter
+    def cel(self, value):
+        self._cel = value
+        self._changed()
+
     def __repr__(self):
         return 'Frame(is_key=' + str(self.is_key) + ', skip_visible=' + str(self.skip_visible) + ', cel=' + str(self.cel) + ', description="' + self.description + '")'
 
@@ -79,8 +122,19 @@ class FrameList(dict):
     list of the frames making up the animation.
     now in a dictionary, so only the necessary frames actually exist.
 
+    The frame numbers are also kept in a sorted index, so the first and
+    last frames can be found in constant time and neighbour lookups
+    (cel_at, key_range) only need a binary search.
+
+    `revision` is bumped whenever a frame is added, removed, or has its
+    key, skip, description or cel changed, so cached results can be
+    validated cheaply.
+
     """
     def __init__(self, name='Untitled layer', stack=None, **kargs):
+        self._keys = []
+        self._key_changes = 0  # bumped when frame numbers come or go
+        self.revision = 0
         self.name = name
         self.visible = True
         self.opacity = 1.0
@@ -123,36 +177,103 @@ class FrameList(dict):
                     items.append(self.setdefault(i, Frame()))
         return items
 
+    ## Sorted key index maintenance
+
+    def _index_add(self, key):
+        keys = self._keys
+        i = bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            keys.insert(i, key)
+            self._key_changes += 1
+
+    def _index_remove(self, key):
+        keys = self._keys
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+            self._key_changes += 1
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._index_add(key)
+        if isinstance(value, Frame):
+            value._owner = self
+        self.revision += 1
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._index_remove(key)
+        self.revision += 1
+
+    def setdefault(self, key, default=None):
+        if not dict.__contains__(self, key):
+            self[key] = default
+            return default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *default):
+        if dict.__contains__(self, key):
+            self._index_remove(key)
+            self.revision += 1
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._index_remove(key)
+        self.revision += 1
+        return key, value
+
+    def update(self, *args, **kargs):
+        for k, v in dict(*args, **kargs).iteritems():
+            self[k] = v
+
+    def clear(self):
+        dict.clear(self)
+        self._keys = []
+        self._key_changes += 1
+        self.revision += 1
+
+    def _iter_keys(self, keys):
+        # Like a dict, adding or removing frames while iterating is an
+        # error, so that iterating doesn't have to copy the index.
+        # Callers doing that iterate over list(framelist) instead.
+        changes = self._key_changes
+        for key in keys:
+            yield key
+            if self._key_changes != changes:
+                raise RuntimeError("FrameList changed size during iteration")
+
     def __iter__(self):
-        return self.keys().__iter__()
+        return self._iter_keys(self._keys)
+
+    def __reversed__(self):
+        return self._iter_keys(reversed(self._keys))
 
     def enumerate(self):			#temporary
         enum = []
         start = self.get_first()
         for f in self:
             enum.append((f - start, self[f]))
-        return sorted(enum)
+        return enum
 
     def cleanup(self):
         """
         checks which frames can be safely removed, and removes them.
 
         """
-        for f in self:
+        for f in list(self):
             if self[f] is None or not self[f].is_needed():
                 self.pop(f)
 
     def get_first(self):
-        try:
-            return min(self)
-        except:
-            return 0
+        if self._keys:
+            return self._keys[0]
+        return 0
 
     def get_last(self):
-        try:
-            return max(self)
-        except:
-            return 0
+        if self._keys:
+            return self._keys[-1]
+        return 0
 
     def index(self, value):
         for i in self:
@@ -160,16 +281,28 @@ class FrameList(dict):
                 return i
         return None
 
-    def key_range(self, idx, step, end=None):
+    def iter_range(self, idx, step, end=None):
+        """
+        Iterate over the existing frame numbers after (step 1) or
+        before (step -1) idx, nearest first, optionally stopping at end.
+
+        """
+        keys = self._keys
         if step == -1:
-            if end is None:
-                return sorted(filter(lambda item: item < idx, self))[::-1]
-            return sorted(filter(lambda item: end <= item < idx, self))[::-1]
+            lo = 0
+            if end is not None:
+                lo = bisect_left(keys, end)
+            for i in xrange(bisect_left(keys, idx) - 1, lo - 1, -1):
+                yield keys[i]
         elif step == 1:
-            if end is None:
-                return sorted(filter(lambda item: item > idx, self))
-            return sorted(filter(lambda item: end >= item > idx, self))
-        return []
+            hi = len(keys)
+            if end is not None:
+                hi = bisect_right(keys, end)
+            for i in xrange(bisect_right(keys, idx), hi):
+                yield keys[i]
+
+    def key_range(self, idx, step, end=None):
+        return list(self.iter_range(idx, step, end))
 
     def change_keys(self, amount, start=None, end=None):
         """
@@ -177,7 +310,7 @@ class FrameList(dict):
 
         """
         tmp = {}
-        for n in self:
+        for n in list(self):
             if n >= start and (n <= end or end is None):
                 tmp[n + amount] = self.pop(n)
         self.update(tmp)
@@ -214,10 +347,11 @@ class FrameList(dict):
         Return the cel at the nth frame.
 
         """
-        for i in sorted(self)[::-1]:
-            if i > n: continue
-            if self[i].cel is not None:
-                return self[i].cel
+        keys = self._keys
+        for i in xrange(bisect_right(keys, n) - 1, -1, -1):
+            cel = dict.__getitem__(self, keys[i]).cel
+            if cel is not None:
+                return cel
         return None
 
     def get_all_cels(self):
@@ -228,11 +362,8 @@ class FrameList(dict):
         return cels
 
     def get_all_cel_keys(self):
-        keys = []
-        for f in self:
-            if self[f].cel is not None and f not in keys:
-                keys.append(f)
-        return keys
+        return [f for f in self._keys
+                if dict.__getitem__(self, f).cel is not None]
 
 
 class TimeLine(list):
@@ -243,6 +374,7 @@ class TimeLine(list):
 
     """
     def __init__(self, opacities=None, active_cels=None, nextprev=None):
+        self.settings_revision = 0
         self.idx = 0
         self.layer_idx = 0
         self.fps = 24
@@ -262,6 +394,7 @@ class TimeLine(list):
 
     def setup_nextprev(self, nextprev):
         self.nextprev.update(nextprev)
+        self.settings_revision += 1
 
     def setup_opacities(self, opacities):
         self.opacities.update(opacities)
@@ -274,9 +407,11 @@ class TimeLine(list):
         self.converted_opacities = {}
         for k, v in self.opacities.items():
             self.converted_opacities[k] = v * factor
+        self.settings_revision += 1
 
     def setup_active_cels(self, active_cels):
         self.active_cels.update(active_cels)
+        self.settings_revision += 1
 
     def cel_index(self, value):
         for j, jl in enumerate(self):
@@ -369,29 +504,31 @@ class TimeLine(list):
 
     def get_next_key(self, layer=None, recursive=True):
         if layer is None: layer = self.layer_idx
-        for f in self[layer].key_range(self.idx, 1):
+        for f in self[layer].iter_range(self.idx, 1):
             if self[layer][f].is_key and not self[layer][f].skip_visible:
                 return f
         if recursive:
             keys = []
             for l in filter(lambda item: item != layer, self):
-                for f in l.key_range(self.idx, 1):
+                for f in l.iter_range(self.idx, 1):
                     if l[f].is_key and not l[f].skip_visible:
                         keys.append(f)
+                        break
             if len(keys) > 0: return min(keys)
         return None
 
     def get_previous_key(self, layer=None, recursive=True):
         if layer is None: layer = self.layer_idx
-        for f in self[layer].key_range(self.idx, -1):
+        for f in self[layer].iter_range(self.idx, -1):
             if self[layer][f].is_key and not self[layer][f].skip_visible:
                 return f
         if recursive:
             keys = []
             for l in filter(lambda item: item != layer, self):
-                for f in l.key_range(self.idx, -1):
+                for f in l.iter_range(self.idx, -1):
                     if l[f].is_key and not l[f].skip_visible:
                         keys.append(f)
+                        break
             if len(keys) > 0: return max(keys)
         return None
 
@@ -445,7 +582,7 @@ class TimeLine(list):
         cur_cel = self[layer].cel_at(self.idx)
         if not cur_cel:
             return None
-        for f in self[layer].key_range(self.idx, -1):
+        for f in self[layer].iter_range(self.idx, -1):
             frame = self[layer][f]
             if frame.cel is not None and frame.cel != cur_cel and not frame.skip_visible:
                 return f
@@ -459,7 +596,7 @@ class TimeLine(list):
         """
         if layer is None: layer = self.layer_idx
         cur_cel = self[layer].cel_at(self.idx)
-        for f in self[layer].key_range(self.idx, 1):
+        for f in self[layer].iter_range(self.idx, 1):
             frame = self[layer][f]
             if frame.cel is not None and frame.cel != cur_cel and not frame.skip_visible:
                 return f
@@ -563,6 +700,91 @@ class TimeLine(list):
                     matrix[i - first].append(None)
         return matrix
 
+    def lightbox_opacity(self, nextprev, kind, f, layer):
+        """
+        Return the opacity of a cel of layer shown at frame f, on
+        the nextprev ('next' or 'previous') side of the current frame.
+
+        """
+        if self.nextprev[nextprev] and self.active_cels[kind]:
+            opac = self.converted_opacities[kind] * layer.opacity
+            try:
+                return round(opac * (abs(self.idx - f) ** -.1), 4)
+            except ZeroDivisionError:
+                return opac
+        return 0
+
+    def get_lightbox_entries(self, l_idx):
+        """
+        Classify the cels of a layer for the lightbox at the current frame.
+
+        Returns (forced, conditional). forced is a list of (cel, opacity)
+        pairs that always apply: the current cel and the explicitly
+        skipped ones. conditional is a list of (cel, nextprev, kind, f)
+        for the remaining cels, in order of precedence, to be passed to
+        lightbox_opacity().
+
+        """
+        layer = self[l_idx]
+        forced = []
+
+        # current cels, always full opacity:
+        cel = layer.cel_at(self.idx)
+        if cel is not None:
+            forced.append((cel, layer.opacity))
+
+        # explicit skip of cels:
+        for f in layer.get_all_cel_keys():
+            if layer[f].skip_visible and layer[f].cel:
+                forced.append((layer[f].cel, 0))
+
+        seen = set(c for c, opa in forced)
+        conditional = []
+
+        def add(f, nextprev, kind):
+            cel = layer[f].cel
+            if cel is not None and cel not in seen:
+                seen.add(cel)
+                conditional.append((cel, nextprev, kind, f))
+
+        # next:
+        next = self.get_next_cel(l_idx)
+        if next is not None:
+            add(next, 'next', 'cel')
+
+        # previous:
+        prev = self.get_previous_cel(l_idx)
+        if prev is not None:
+            add(prev, 'previous', 'cel')
+
+        # previous key:
+        prevkey = self.get_previous_key(l_idx, False)
+        if prevkey:
+            add(prevkey, 'previous', 'key')
+        else:
+            prevkey = layer.get_first()
+
+        # next key:
+        nextkey = self.get_next_key(l_idx, False)
+        if nextkey:
+            add(nextkey, 'next', 'key')
+        else:
+            nextkey = layer.get_last()
+
+        # inbetweens:
+        for f in layer.iter_range(self.idx, 1, nextkey):
+            add(f, 'next', 'inbetweens')
+        for f in layer.iter_range(self.idx, -1, prevkey):
+            add(f, 'previous', 'inbetweens')
+
+        # frames outside immediate keys:
+        for f in layer.iter_range(nextkey, 1):
+            add(f, 'next', layer[f].is_key and 'other keys' or 'other')
+        for f in layer.iter_range(prevkey, -1):
+            add(f, 'previous', layer[f].is_key and 'other keys' or 'other')
+
+        return forced, conditional
+
     def get_opacities(self):
         """
         Return a map of cels and the opacity they should have.
@@ -571,90 +793,17 @@ class TimeLine(list):
         opaque, and they may want to see the neighbour cels
         semi-transparent.
 
+        This recomputes everything; see Lightbox for the incremental
+        version used while stepping through frames.
+
         """
         opacities = {}
-
-        def get_opa(nextprev, c, idx, layer):
-            can_nextprev = self.nextprev[nextprev]
-            if can_nextprev and self.active_cels[c]:
-                opac = self.converted_opacities[c] * layer.opacity
-                try:
-                    return round(opac * (abs(self.idx - idx) ** -.1), 4)
-                except ZeroDivisionError:
-                    return opac
-            return 0
-
         for l_idx, layer in enumerate(self):
-            # current cels, always full opacity:
-            cel = layer.cel_at(self.idx)
-            if cel is not None:
-                opacities[cel] = layer.opacity
-
-            # explicit skip of cels:
-            for f in layer.get_all_cel_keys():
-                if layer[f].skip_visible and layer[f].cel:
-                    opacities[layer[f].cel] = 0
-
-            # next:
-            next = self.get_next_cel(l_idx)
-            if layer[next] and layer[next].cel not in opacities:
-                opacities[layer[next].cel] = get_opa('next', 'cel', next, layer)
-
-            # previous:
-            prev = self.get_previous_cel(l_idx)
-            if layer[prev] and layer[prev].cel not in opacities:
-                opacities[layer[prev].cel] = get_opa('previous', 'cel', prev, layer)
-
-            # previous key:
-            prevkey = self.get_previous_key(l_idx, False)
-            if prevkey:
-                if layer[prevkey].cel and layer[prevkey].cel not in opacities:
-                    opacities[layer[prevkey].cel] = get_opa('previous', 'key', prevkey, layer)
-            else:
-                prevkey = layer.get_first()
-
-            # next key:
-            nextkey = self.get_next_key(l_idx, False)
-            if nextkey:
-                if layer[nextkey].cel and layer[nextkey].cel not in opacities:
-                    opacities[layer[nextkey].cel] = get_opa('next', 'key', nextkey, layer)
-            else:
-                nextkey = layer.get_last()
-
-            def has_cel(f):
-                return layer[f].cel is not None
-
-            # inbetweens:
-            next_inbetweens_range = layer.key_range(self.idx, 1, nextkey)
-            for f in filter(has_cel, next_inbetweens_range):
-                if layer[f].cel not in opacities.keys():
-                    opacities[layer[f].cel] = get_opa('next', 'inbetweens', f, layer)
-            prev_inbetweens_range = layer.key_range(self.idx, -1, prevkey)
-            for f in filter(has_cel, prev_inbetweens_range):
-                if layer[f].cel not in opacities.keys():
-                    opacities[layer[f].cel] = get_opa('previous', 'inbetweens', f, layer)
-            del next_inbetweens_range, prev_inbetweens_range
-
-            # frames outside immediate keys:
-            next_outside_range = layer.key_range(nextkey, 1)
-            for f in filter(has_cel, next_outside_range):
-                cel = layer[f].cel
-                if cel not in opacities.keys():
-                    if layer[f].is_key:
-                        opacities[cel] = get_opa('next', 'other keys', f, layer)
-                    else:
-                        opacities[cel] = get_opa('next', 'other', f, layer)
-
-            prev_outside_range = layer.key_range(prevkey, -1)
-            for f in filter(has_cel, prev_outside_range):
-                cel = layer[f].cel
-                if cel not in opacities.keys():
-                    if layer[f].is_key:
-                        opacities[cel] = get_opa('previous', 'other keys', f, layer)
-                    else:
-                        opacities[cel] = get_opa('previous', 'other', f, layer)
-
-            del next_outside_range, prev_outside_range
+            forced, conditional = self.get_lightbox_entries(l_idx)
+            opacities.update(forced)
+            for cel, nextprev, kind, f in conditional:
+                if cel not in opacities:
+                    opacities[cel] = self.lightbox_opacity(nextprev, kind, f, layer)
 
         visible = {}
         for cel, opa in opacities.items():
@@ -681,8 +830,7 @@ class TimeLine(list):
         f, l = 0, 0
         for i in range(len(self)):
             has_cel = False
-            for j in range(self[i].get_first(), self[i].get_last()+1)[::-1]:
-                if j not in self[i]: continue
+            for j in reversed(self[i]):
                 if self[i][j].cel is None: continue
                 paths.append(((l,f), (i, j), self[i][j].cel))
                 has_cel = True
@@ -703,3 +851,166 @@ class TimeLine(list):
             new_order.append(c)
         return new_order
 
+
+
+class _LayerLightbox(object):
+    """
+    Cached lightbox classification of one FrameList.
+
+    The classification only depends on where the current frame lies
+    relative to the existing frames of the layer, so it stays valid
+    while the current frame moves between two neighbouring frames
+    (e.g. inside a held cel). Only the cels whose opacity fades with
+    the distance need recomputing then.
+
+    """
+    def __init__(self, timeline, l_idx):
+        layer = timeline[l_idx]
+        idx = timeline.idx
+        self.layer = layer
+        self.revision = layer.revision
+        self.opacity = layer.opacity
+        self.settings_revision = timeline.settings_revision
+
+        # range of current frames this classification is valid for
+        if idx in layer:
+            self.lo = self.hi = idx
+        else:
+            prev = next(layer.iter_range(idx, -1), None)
+            nxt = next(layer.iter_range(idx, 1), None)
+            self.lo = self.hi = None
+            if prev is not None:
+                self.lo = prev + 1
+            if nxt is not None:
+                self.hi = nxt - 1
+
+        self.forced, self.conditional = timeline.get_lightbox_entries(l_idx)
+
+        # split the cels into fixed values and distance dependent ones
+        self.static = dict(self.forced)
+        self.dynamic = []
+        for entry in self.conditional:
+            cel, nextprev, kind, f = entry
+            if (timeline.nextprev[nextprev] and timeline.active_cels[kind]
+                    and timeline.converted_opacities[kind] * layer.opacity):
+                self.dynamic.append(entry)
+            else:
+                self.static[cel] = 0
+        self.cels = set(self.static)
+        self.cels.update(e[0] for e in self.dynamic)
+
+    def is_valid(self, timeline):
+        idx = timeline.idx
+        return (self.revision == self.layer.revision
+                and self.opacity == self.layer.opacity
+                and self.settings_revision == timeline.settings_revision
+                and (self.lo is None or idx >= self.lo)
+                and (self.hi is None or idx <= self.hi))
+
+    def dynamic_values(self, timeline):
+        layer = self.layer
+        return [(cel, timeline.lightbox_opacity(nextprev, kind, f, layer))
+                for cel, nextprev, kind, f in self.dynamic]
+
+    def values(self, timeline):
+        values = self.static.copy()
+        values.update(self.dynamic_values(timeline))
+        return values
+
+
+class Lightbox(object):
+    """
+    Incremental lightbox: tracks which opacity each cel was given and
+    returns only the changes when the timeline moves or is edited.
+
+    Per-layer classifications are cached (see _LayerLightbox) and only
+    rebuilt for the layers that were edited or whose neighbourhood the
+    current frame has left. The result is the same as comparing
+    successive TimeLine.get_opacities() results.
+
+    """
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self._states = {}     # id(FrameList) -> _LayerLightbox
+        self._owners = {}     # cel -> number of layers showing it
+        self._shared = 0      # number of cels shown by several layers
+        self._applied = None  # cel -> opacity as last returned
+
+    def invalidate(self):
+        """
+        Forget the applied opacities, e.g. because the cels' visibility
+        was changed by something else. The next update() returns all.
+
+        """
+        self._applied = None
+
+    def _own(self, cels, amount):
+        owners = self._owners
+        for cel in cels:
+            n = owners.get(cel, 0)
+            if (n > 1) != (n + amount > 1):
+                self._shared += amount
+            if n + amount:
+                owners[cel] = n + amount
+            else:
+                del owners[cel]
+
+    def update(self):
+        """
+        Return a map of {cel: (opacity, visible)} for the cels whose
+        lightbox opacity changed since the previous call.
+
+        """
+        timeline = self.timeline
+        old_states = self._states
+        states = {}
+        ordered = []
+        rebuilt = []
+        for l_idx, layer in enumerate(timeline):
+            state = old_states.pop(id(layer), None)
+            if state is None or not state.is_valid(timeline):
+                if state is not None:
+                    self._own(state.cels, -1)
+                    rebuilt.append(state)
+                state = _LayerLightbox(timeline, l_idx)
+                self._own(state.cels, 1)
+                rebuilt.append(state)
+            states[id(layer)] = state
+            ordered.append(state)
+        for state in old_states.values():
+            self._own(state.cels, -1)
+            rebuilt.append(state)
+        self._states = states
+
+        applied = self._applied
+        if applied is None or self._shared:
+            # precedence between layers matters, compute everything
+            values = {}
+            for state in ordered:
+                values.update(state.forced)
+                layer_values = state.values(timeline)
+                for cel, nextprev, kind, f in state.conditional:
+                    if cel not in values:
+                        values[cel] = layer_values[cel]
+            if applied is None:
+                applied = {}
+            for cel in [c for c in applied if c not in values]:
+                del applied[cel]
+        else:
+            values = {}
+            rebuilt = set(id(s) for s in rebuilt)
+            for state in ordered:
+                if id(state) in rebuilt:
+                    values.update(state.values(timeline))
+                else:
+                    values.update(state.dynamic_values(timeline))
+            for cel in [c for c in applied if c not in self._owners]:
+                del applied[cel]
+
+        changes = {}
+        for cel, opa in values.iteritems():
+            if cel not in applied or applied[cel] != opa:
+                applied[cel] = opa
+                changes[cel] = (opa, opa != 0)
+        self._applied = applied
+        return changes
@@ -9,6 +9,7 @@
 
 import os
 import json
+import struct
 
 # adaptive file-format reader/writer inspired by Blender's SDNA system
 # the format works like this:
@@ -17,6 +18,59 @@ import json
 # an XDNA signature is equivalent to an empty xsheet with datatypes
 # instead of data
 
+# the binary x-sheet format stores the same data in columns:
+# * a header: BINARY_MAGIC, a '>H' format version, the metadata as
+#   JSON, and a '>d' framerate
+# * the cel table: a '>I' count, then for each cel its layer path, as a
+#   '>H' length and that many '>i' indices. Frames refer to cels by
+#   their position in this table.
+# * a '>I' count of raster frame lists, then for each list its name,
+#   a '>B' of LIST_* flags, a '>d' opacity, and its composite op,
+#   followed by a '>I' frame count n and the columns of its frames:
+#   n '>i' frame numbers in ascending order, n '>B' FRAME_* flags,
+#   n '>i' cel IDs (-1 for none), then a string for each frame with
+#   FRAME_DESCRIBED set.
+# strings are a '>I' length and that many bytes of UTF-8.
+
+BINARY_MAGIC = 'XDNAbin\n'
+BINARY_VERSION = 1
+
+LIST_VISIBLE = 1
+LIST_LOCKED = 2
+
+FRAME_KEY = 1
+FRAME_SKIP_VISIBLE = 2
+FRAME_DESCRIBED = 4
+
+
+class _BinaryReader(object):
+    """Reads values from binary x-sheet data, in order"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def unpack(self, fmt, n=None):
+        if n is not None:
+            fmt = '>%d%s' % (n, fmt)
+        values = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return values
+
+    def string(self):
+        n, = self.unpack('>I')
+        s = self.data[self.pos:self.pos + n]
+        if len(s) != n:
+            raise ValueError('truncated binary x-sheet data')
+        self.pos += n
+        return s.decode('utf-8')
+
+
+def _pack_string(s):
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return struct.pack('>I', len(s)) + s
+
 class XDNA(object):
 
     def __init__(self):
@@ -88,3 +142,95 @@ class XDNA(object):
 
     def list_to_dict(self, l):
         return dict(zip(map(str, range(len(l))), l))
+
+    def is_binary(self, data):
+        """
+        Whether data is in the binary x-sheet format
+
+        """
+        return data.startswith(BINARY_MAGIC)
+
+    def binary_serialize(self, xsheet):
+        """
+        Converts an x-sheet to the binary format.
+
+        `xsheet` is a dict with keys 'metadata', 'framerate', 'cels' (a
+        list of layer paths), and 'raster_frame_lists'. Each frame list is
+        a dict with keys 'name', 'visible', 'opacity', 'locked' and
+        'composite', and columns of its frames: 'frames' (ascending frame
+        numbers), 'flags' (FRAME_* values), 'cels' (indices into the cel
+        table, or None), and 'descriptions'.
+
+        """
+        out = [BINARY_MAGIC, struct.pack('>H', BINARY_VERSION),
+               _pack_string(json.dumps(xsheet['metadata'], sort_keys=True)),
+               struct.pack('>d', xsheet['framerate'])]
+        cels = xsheet['cels']
+        out.append(struct.pack('>I', len(cels)))
+        for path in cels:
+            out.append(struct.pack('>H%di' % len(path), len(path), *path))
+        frame_lists = xsheet['raster_frame_lists']
+        out.append(struct.pack('>I', len(frame_lists)))
+        for fl in frame_lists:
+            flags = ((fl['visible'] and LIST_VISIBLE or 0) |
+                     (fl['locked'] and LIST_LOCKED or 0))
+            out.append(_pack_string(fl['name']))
+            out.append(struct.pack('>Bd', flags, fl['opacity']))
+            out.append(_pack_string(fl['composite']))
+            n = len(fl['frames'])
+            out.append(struct.pack('>I', n))
+            out.append(struct.pack('>%di' % n, *fl['frames']))
+            out.append(struct.pack('>%dB' % n, *fl['flags']))
+            cel_ids = [-1 if c is None else c for c in fl['cels']]
+            out.append(struct.pack('>%di' % n, *cel_ids))
+            for flag, description in zip(fl['flags'], fl['descriptions']):
+                if flag & FRAME_DESCRIBED:
+                    out.append(_pack_string(description))
+        return ''.join(out)
+
+    def binary_deserialize(self, data):
+        """
+        Converts binary x-sheet data back to the dict it was made from.
+
+        Descriptions are '' for frames without FRAME_DESCRIBED. Raises
+        ValueError if the data is not in a known version of the format.
+
+        """
+        if not self.is_binary(data):
+            raise ValueError('not binary x-sheet data')
+        r = _BinaryReader(data)
+        r.pos = len(BINARY_MAGIC)
+        try:
+            version, = r.unpack('>H')
+            if version > BINARY_VERSION:
+                raise ValueError('unsupported binary x-sheet version %d'
+                                 % (version,))
+            xsheet = {'metadata': json.loads(r.string())}
+            xsheet['framerate'], = r.unpack('>d')
+            ncels, = r.unpack('>I')
+            cels = []
+            for i in xrange(ncels):
+                depth, = r.unpack('>H')
+                cels.append(r.unpack('i', depth))
+            xsheet['cels'] = cels
+            nlists, = r.unpack('>I')
+            frame_lists = []
+            for i in xrange(nlists):
+                fl = {'name': r.string()}
+                flags, fl['opacity'] = r.unpack('>Bd')
+                fl['visible'] = bool(flags & LIST_VISIBLE)
+                fl['locked'] = bool(flags & LIST_LOCKED)
+                fl['composite'] = r.string()
+                n, = r.unpack('>I')
+                fl['frames'] = list(r.unpack('i', n))
+                fl['flags'] = list(r.unpack('B', n))
+                fl['cels'] = [None if c < 0 else c for c in r.unpack('i', n)]
+                if any(c >= ncels for c in fl['cels'] if c is not None):
+                    raise ValueError('bad cel ID in binary x-sheet data')
+                fl['descriptions'] = [r.string() if f & FRAME_DESCRIBED
+                                      else '' for f in fl['flags']]
+                frame_lists.append(fl)
+            xsheet['raster_frame_lists'] = frame_lists
+        except struct.error:
+            raise ValueError('truncated binary x-sheet data')
+        return xsheet
@@ -23,6 +23,660 @@ def tileConversions():
     mypaintlib.tile_convert_rgba16_to_rgba8(src, dst)
     assert (dst[:,:,3] == 255).all()
 
+def packedTiles():
+    # read-only tiles over budget get packed, and unpack on access
+    N = mypaintlib.TILE_SIZE
+    memory = tiledsurface.tile_memory
+    old_budget = memory.budget
+    s = tiledsurface.Surface()
+    for tx in range(4):
+        with s.tile_request(tx, 0, readonly=False) as dst:
+            dst[:,:,:] = randint(0, 1<<15, (N, N, 4))
+    before = dict((pos, t.rgba.copy()) for pos, t in s.tiledict.iteritems())
+    sshot = s.save_snapshot()
+    memory.set_budget(0)
+    for pos, t in s.tiledict.iteritems():
+        assert 'rgba' not in t.__dict__
+        assert (t.rgba == before[pos]).all()
+    with s.tile_request(0, 0, readonly=False) as dst:
+        dst[:,:,:] = 0
+    assert (sshot.tiledict[0, 0].rgba == before[0, 0]).all()
+    memory.set_budget(old_budget)
+
+def solidTiles():
+    # solid tiles render like their expanded equivalents
+    N = mypaintlib.TILE_SIZE
+    one = 1<<15
+    for colour in [(one, 0, 0, one), (0, one/4, 0, one/2), (0, 0, 0, 0)]:
+        solid = tiledsurface.Surface()
+        solid.tiledict[0, 0] = tiledsurface.Tile(solid=colour)
+        expanded = tiledsurface.Surface()
+        with expanded.tile_request(0, 0, readonly=False) as dst:
+            dst[:,:] = colour
+        for opacity in [1.0, 0.5]:
+            dst1 = zeros((N, N, 4), 'uint16')
+            dst1[:N/2] = (0, 0, one, one)
+            dst2 = dst1.copy()
+            solid.composite_tile(dst1, True, 0, 0, opacity=opacity)
+            expanded.composite_tile(dst2, True, 0, 0, opacity=opacity)
+            assert (dst1 == dst2).all()
+        dst1 = zeros((N, N, 4), 'uint8')
+        dst2 = zeros((N, N, 4), 'uint8')
+        solid.blit_tile_into(dst1, True, 0, 0)
+        expanded.blit_tile_into(dst2, True, 0, 0)
+        assert (dst1 == dst2).all()
+    # and expand when written to
+    tile = solid.tiledict[0, 0]
+    with solid.tile_request(0, 0, readonly=False) as dst:
+        dst[0, 0] = (one, one, one, one)
+    assert tile._solid is None
+    solid.remove_empty_tiles()
+    assert solid.tiledict[0, 0]._solid is None
+    with solid.tile_request(0, 0, readonly=False) as dst:
+        dst[0, 0] = 0
+    solid.remove_empty_tiles()
+    assert not solid.tiledict
+
+def lazyMipmaps():
+    # dirty mipmap tiles serve stale pixels when out of time, and are
+    # rebuilt properly on demand or by the scheduler
+    N = mypaintlib.TILE_SIZE
+    one = 1<<15
+    scheduler = tiledsurface.mipmap_scheduler
+    s = tiledsurface.Surface()
+    with s.tile_request(0, 0, readonly=False) as dst:
+        dst[:] = (one, 0, 0, one)
+    scheduler.finish_all()
+    red = zeros((N, N, 4), 'uint16')
+    s.blit_tile_into(red, True, 0, 0, mipmap_level=1)
+    assert red[0, 0, 0] == one and red[0, 0, 3] == one
+    with s.tile_request(0, 0, readonly=False) as dst:
+        dst[:] = (0, one, 0, one)
+    s.end_atomic()
+    stale = zeros((N, N, 4), 'uint16')
+    with scheduler.deferred(budget=-1):
+        s.blit_tile_into(stale, True, 0, 0, mipmap_level=1)
+    assert (stale == red).all()
+    fresh = zeros((N, N, 4), 'uint16')
+    s.blit_tile_into(fresh, True, 0, 0, mipmap_level=1)
+    assert fresh[0, 0, 1] == one and fresh[0, 0, 0] == 0
+    # coarser levels stand in for tiles without any old pixels
+    with s.tile_request(2, 0, readonly=False) as dst:
+        dst[:] = (one, 0, 0, one)
+    scheduler.finish_all()
+    s._mipmaps[1].tiledict.pop((1, 0))
+    with s.tile_request(2, 0, readonly=False) as dst:
+        dst[:] = (0, 0, one, one)
+    s.end_atomic()
+    with scheduler.deferred(budget=-1):
+        s.blit_tile_into(stale, True, 1, 0, mipmap_level=1)
+    assert stale[0, 0, 0] == one and stale[0, 0, 2] == 0
+    scheduler.finish_all()
+    for mipmap in s._mipmaps:
+        assert not mipmap._dirty
+
+def spilledSnapshots():
+    # snapshot tiles spilled to disk read back transparently, except
+    # for the ones kept because something else still shares them
+    N = mypaintlib.TILE_SIZE
+    s = tiledsurface.Surface()
+    for tx in range(4):
+        with s.tile_request(tx, 0, readonly=False) as dst:
+            dst[:,:,:] = randint(0, 1<<15, (N, N, 4))
+    before = dict((pos, t.rgba.copy()) for pos, t in s.tiledict.iteritems())
+    sshot = s.save_snapshot()
+    kept = s.tiledict[0, 0]
+    with s.tile_request(1, 0, readonly=False) as dst:
+        dst[:,:,:] = 0
+    spill = tiledsurface.SnapshotSpill()
+    assert sshot.spill(spill, set([id(kept)])) > 0
+    assert sshot.spilled
+    assert len(sshot._tiledict) == 1
+    tiledict = sshot.tiledict
+    assert not sshot.spilled
+    assert tiledict[0, 0] is kept
+    assert tiledict[2, 0] is s.tiledict[2, 0]  # still alive: reused
+    for pos, rgba in before.iteritems():
+        assert (tiledict[pos].rgba == rgba).all()
+    s.load_snapshot(sshot)
+    assert (s.tiledict[1, 0].rgba == before[1, 0]).all()
+    spill.close()
+
+def playbackCacheInvalidation():
+    # cached frames ignore their cels' visible/opacity flags, but drop
+    # tiles whose pixels change, even in a batch with a flag change
+    N = mypaintlib.TILE_SIZE
+    doc = document.Document()
+    cel = doc.layer_stack.current
+    doc.ani.timeline[0][0].cel = cel
+    cache = doc.ani.playback_cache
+    dst = tiledsurface.Surface()
+    cache.render_into(dst, [(0, 0), (1, 0)], 0)
+    frame, = cache._frames.values()
+    cel.visible = False
+    cel.opacity = 0.5
+    assert sorted(frame.tiles) == [(0, 0), (1, 0)]
+    with doc.batch_updates():
+        cel.opacity = 1.0
+        with cel._surface.tile_request(0, 0, readonly=False) as rgba:
+            rgba[:,:,:] = 1<<15
+        cel._surface.notify_observers(0, 0, N, N)
+    assert sorted(frame.tiles) == [(1, 0)]
+    cache.render_into(dst, [(0, 0)], 0)
+    with dst.tile_request(0, 0, readonly=True) as rgba:
+        assert rgba[0, 0, 3] > 0
+    with cel._surface.tile_request(1, 0, readonly=False) as rgba:
+        rgba[:,:,:] = 1<<15
+    cel._surface.notify_observers(N, 0, N, N)
+    assert sorted(frame.tiles) == [(0, 0)]
+
+def playbackPrerender():
+    # frames ahead of the playhead are rendered when idle, within the
+    # budget, look like the layer stack showing just their cels, and
+    # cels are only watched while cached frames show them
+    import contextlib
+    from lib import layer
+    N = mypaintlib.TILE_SIZE
+    one = 1<<15
+    doc = document.Document()
+    root = doc.layer_stack
+    timeline = doc.ani.timeline
+    cels = []
+    for i, colour in enumerate([(one, 0, 0, one), (0, one/2, 0, one/2),
+                                (0, 0, one/4, one/2)]):
+        l = layer.PaintingLayer()
+        with l._surface.tile_request(i % 2, 0, readonly=False) as dst:
+            dst[:,:] = colour
+        root.append(l)
+        timeline[0][i].cel = l
+        cels.append(l)
+    observers = [list(cel._surface.observers) for cel in cels]
+    class Tiles (object):
+        def __init__(self):
+            self.tiles = {}
+        @contextlib.contextmanager
+        def tile_request(self, tx, ty, readonly):
+            yield self.tiles.setdefault((tx, ty), zeros((N, N, 4), 'uint8'))
+    tiles = [(0, 0), (1, 0)]
+    cache = doc.ani.playback_cache
+    cache.active = True
+    timeline.select(0)
+    cache.render_into(Tiles(), tiles, 0)
+    cache._tasks.finish_all()
+    assert len(cache._frames) == 3
+    assert cache.size == 3 * len(tiles) * cache.TILE_BYTES
+    for i in range(3):
+        for cel in cels:
+            cel.visible = (cel is cels[i])
+            cel.opacity = 1.0
+        expected = Tiles()
+        root.render_into(expected, tiles, 0)
+        for cel in cels:
+            cel.visible = False
+            cel.opacity = 0.5
+        timeline.select(i)
+        size = cache.size
+        frame = Tiles()
+        cache.render_into(frame, tiles, 0)
+        assert cache.size == size
+        for pos in tiles:
+            assert (frame.tiles[pos] == expected.tiles[pos]).all()
+    # rendering ahead stops at the budget, rather than evicting
+    cache.clear()
+    cache.set_budget(2 * len(tiles) * cache.TILE_BYTES)
+    timeline.select(0)
+    cache.render_into(Tiles(), tiles, 0)
+    cache._tasks.finish_all()
+    assert len(cache._frames) == 2
+    assert cache.size <= cache.budget
+    shown = set()
+    for frame in cache._frames.values():
+        shown.update(frame.shown)
+    assert set(cache._watched) == shown
+    cache.set_budget(0)
+    assert not cache._watched
+    for cel, before in zip(cels, observers):
+        assert cel._surface.observers == before
+
+def undoMemoryBudget():
+    # commands are costed by the tiles they changed when pushed, and
+    # the oldest are spilled once those costs exceed the budget
+    N = mypaintlib.TILE_SIZE
+    doc = document.Document()
+    layer = doc.layer_stack.current
+    for tx in range(4):
+        with layer._surface.tile_request(tx, 0, readonly=False) as dst:
+            dst[:,:,:] = 1
+    class Clear (command.Command):
+        def __init__(self, doc, tx):
+            command.Command.__init__(self, doc)
+            self.tx = tx
+        def redo(self):
+            self.sshot = layer.save_snapshot()
+            surf = layer._surface
+            with surf.tile_request(self.tx, 0, readonly=False) as dst:
+                dst[:,:,:] = 0
+        def undo(self):
+            layer.load_snapshot(self.sshot)
+    stack = command.CommandStack()
+    cmds = [Clear(doc, tx) for tx in range(4)]
+    for cmd in cmds:
+        stack.do(cmd)
+    sizes = [stack._command_bytes[cmd] for cmd in cmds]
+    assert all(size > 0 for size in sizes)
+    assert not any(cmd.sshot.surface_sshot.spilled for cmd in cmds)
+    stack.set_memory_budget(sum(sizes[2:]))
+    spilled = [cmd.sshot.surface_sshot.spilled for cmd in cmds]
+    assert spilled == [True, True, False, False]
+    assert sum(stack._command_bytes.itervalues()) <= stack.memory_budget
+    stack.undo()
+    stack.undo()
+    stack.undo()
+    assert (layer._surface.tiledict[1, 0].rgba == 1).all()
+    stack.clear()
+
+def partialSnapshotLoad():
+    # loading just the changed tiles of a snapshot restores it, and
+    # only notifies the observers of those
+    N = mypaintlib.TILE_SIZE
+    s = tiledsurface.Surface()
+    for tx in range(8):
+        with s.tile_request(tx, 0, readonly=False) as dst:
+            dst[:,:,:] = randint(0, 1<<15, (N, N, 4))
+    before = s.save_snapshot()
+    with s.tile_request(2, 0, readonly=False) as dst:
+        dst[:,:,:] = 0
+    with s.tile_request(9, 0, readonly=False) as dst:
+        dst[:,:,:] = 1
+    after = s.save_snapshot()
+    changed = before.tiledict.diff(after.tiledict)
+    assert changed == set([(2, 0), (9, 0)])
+    areas = []
+    s.observers.append(lambda *a: areas.append(a))
+    s.load_snapshot(before, tiles=changed)
+    assert s.tiledict == before.tiledict
+    assert areas == [(2*N, 0, 8*N, N)]
+    s.load_snapshot(after, tiles=changed)
+    assert s.tiledict == after.tiledict
+
+def progressiveLoad():
+    # layers decoded in the background end up the same as ones loaded
+    # directly, and snapshotting a layer completes its load first
+    doc1 = document.Document()
+    doc1.load('smallimage.ora')
+    doc2 = document.Document(progressive_load=True)
+    doc2.load('smallimage.ora')
+    layers1 = list(doc1.layer_stack.deepiter())
+    layers2 = list(doc2.layer_stack.deepiter())
+    assert len(layers1) == len(layers2)
+    pending = [l for l in layers2 if l._pending_load is not None]
+    if pending:
+        pending[-1].save_snapshot()
+        assert pending[-1]._pending_load is None
+    doc2.finish_loading()
+    for l1, l2 in zip(layers1, layers2):
+        assert l2._pending_load is None
+        assert l1.get_bbox() == l2.get_bbox()
+        d1 = l1._surface.tiledict
+        d2 = l2._surface.tiledict
+        assert sorted(d1.keys()) == sorted(d2.keys())
+        for pos in d1.keys():
+            assert (d1[pos].rgba == d2[pos].rgba).all()
+    doc2.cleanup()
+
+def incrementalSave():
+    # saving again copies the PNGs of unchanged layers from the last
+    # file, and the result loads the same
+    import zipfile
+    N = mypaintlib.TILE_SIZE
+    doc = document.Document()
+    doc.load('smallimage.ora')
+    doc.save('test_incremental1.ora')
+    layers = list(doc.layer_stack.deepiter())
+    with layers[0]._surface.tile_request(0, 0, readonly=False) as dst:
+        dst[:,:,:] = 1 << 15
+    layers[0]._surface.notify_observers(0, 0, N, N)
+    doc.save('test_incremental2.ora')
+    z1 = zipfile.ZipFile('test_incremental1.ora')
+    z2 = zipfile.ZipFile('test_incremental2.ora')
+    assert z1.read('data/layer-00.png') != z2.read('data/layer-00.png')
+    assert z1.read('data/layer-01.png') == z2.read('data/layer-01.png')
+    record = layers[1]._ora_members['layer']
+    assert record.filename == os.path.abspath('test_incremental2.ora')
+    doc2 = document.Document()
+    doc2.load('test_incremental2.ora')
+    assert len(list(doc2.layer_stack.deepiter())) == len(layers)
+
+def xsheetSave():
+    # an animated document saved to OpenRaster reloads with its frames
+    # on the same cels, with the same flags, and cels which can't be
+    # found are replaced by new layers
+    import zipfile
+    from lib import layer
+    N = mypaintlib.TILE_SIZE
+    doc = document.Document()
+    for i in range(2):
+        l = layer.PaintingLayer(name='cel %d' % i)
+        with l._surface.tile_request(i, 0, readonly=False) as dst:
+            dst[:,:,:] = 1 << 15
+        doc.layer_stack.append(l)
+    cel1, cel2 = list(doc.layer_stack)[-2:]
+    timeline = doc.ani.timeline
+    timeline.fps = 12
+    timeline[0][0].cel = cel1
+    timeline[0][0].is_key = True
+    timeline[0][0].description = 'start'
+    timeline[0][3].cel = cel2
+    timeline[0][3].skip_visible = True
+    timeline[0][5].description = 'no cel'
+    timeline.append_layer(name='second')
+    timeline[1][1].cel = cel1
+    timeline[1][1].is_key = True
+    def describe(doc):
+        timeline = doc.ani.timeline
+        frames = []
+        for lyr in timeline:
+            for nf in lyr:
+                f = lyr[nf]
+                if not f.is_needed():
+                    continue
+                path = None
+                if f.cel is not None:
+                    path = doc.layer_stack.deepindex(f.cel)
+                frames.append((lyr.name, nf, f.is_key, f.skip_visible,
+                               f.description, path))
+        return timeline.fps, frames
+    expected = describe(doc)
+    # JSON is the default, and the binary format is opt-in
+    for xsheet_format in (None, 'json', 'binary'):
+        if xsheet_format is None:
+            doc.save('test_xsheetSave.ora')
+        else:
+            doc.save('test_xsheetSave.ora', xsheet_format=xsheet_format)
+        z = zipfile.ZipFile('test_xsheetSave.ora')
+        data = z.read('animation.xsheet')
+        z.close()
+        if xsheet_format == 'binary':
+            assert data == doc.ani.xsheet_as_binary()
+        else:
+            assert data == doc.ani.xsheet_as_str()
+        doc2 = document.Document()
+        doc2.load('test_xsheetSave.ora')
+        assert describe(doc2) == expected
+        timeline2 = doc2.ani.timeline
+        assert timeline2[0][0].cel is timeline2[1][1].cel
+        assert timeline2[0][0].cel.name == 'cel 0'
+        assert timeline2[0][3].cel.name == 'cel 1'
+    # without the saved layers, the cels are new layers
+    doc3 = document.Document()
+    n = len(doc3.layer_stack)
+    doc3.ani.str_to_xsheet(doc.ani.xsheet_as_binary())
+    timeline3 = doc3.ani.timeline
+    cels = set(timeline3.get_all_cels())
+    assert len(cels) == 2
+    assert len(doc3.layer_stack) == n + 2
+    assert timeline3[0][0].cel is timeline3[1][1].cel
+    assert timeline3[0][3].cel is not timeline3[0][0].cel
+    assert timeline3[0][3].skip_visible
+    assert timeline3[0][5].description == 'no cel'
+
+def parallelSave():
+    # PNG data encoded in memory, and on encoder threads, is the same as
+    # the data saved to a file
+    from lib import orasave
+    doc = document.Document()
+    doc.load('bigimage.ora')
+    surf = doc.layer_stack.current._surface
+    rect = surf.get_bbox()
+    surf.save_as_png('test_parallelSave.png', *rect)
+    expected = open('test_parallelSave.png', 'rb').read()
+    assert surf.encode_as_png(*rect) == expected
+    pool = orasave.EncoderPool(threads=2, limit=1)
+    jobs = [surf.encode_as_png(*rect, encoder=pool) for i in xrange(3)]
+    assert all(job.wait() == expected for job in jobs)
+    pool.close()
+
+def make_strokeshape(bitmaps):
+    # a StrokeShape from a dict of (N, N) bitmaps by tile position
+    import zlib, struct
+    from lib import strokemap
+    data = ''
+    for (tx, ty), bitmap in bitmaps.iteritems():
+        compressed = zlib.compress(bitmap.astype('uint8').tostring())
+        data += struct.pack('>iiI', tx, ty, len(compressed)) + compressed
+    shape = strokemap.StrokeShape()
+    shape.init_from_string(data, 0, 0)
+    return shape
+
+def strokemapTranslate():
+    # moving strokes keeps their pixels, whether moved one at a time or
+    # together, and survives a save and reload
+    from lib import strokemap
+    N = mypaintlib.TILE_SIZE
+    bitmap = zeros((N, N), 'uint8')
+    bitmap[::3, ::5] = 1
+    pixels = set(zip(*nonzero(bitmap)[::-1]))
+    shapes = [make_strokeshape({(0, 0): bitmap, (1, 0): bitmap})
+              for i in xrange(3)]
+    for dx, dy in [(N, -2*N), (5, 3), (-N-7, N/2), (0, 1)]:
+        shapes[0].translate(dx, dy)
+        strokemap.translate_shapes(shapes[1:], dx, dy)
+        pixels = set((x+dx, y+dy) for (x, y) in pixels)
+        for shape in shapes:
+            for x, y in pixels:
+                assert shape.touches_pixel(x, y)
+                assert shape.touches_pixel(x+N, y)
+            assert not shape.touches_pixel(x+1, y)
+    data = shapes[0].save_to_string(0, 0)
+    assert shapes[1].save_to_string(0, 0) == data
+    shape = strokemap.StrokeShape()
+    shape.init_from_string(data, N, 0)
+    x, y = sorted(pixels)[0]
+    assert shape.touches_pixel(x+N, y)
+    assert shape.trim((x+N, y, 1, 1))
+    assert not shape.trim((x+100*N, y, 1, 1))
+    # strokes which changed nothing, and layers without strokes, move too
+    empty = strokemap.StrokeShape()
+    empty._update_strokemap_with_percept_diff({}, {}, [])
+    assert not len(empty.positions)
+    strokemap.translate_shapes([empty, shapes[0]], 5, 3)
+    assert not len(empty.positions)
+    assert shapes[0].touches_pixel(x+5, y+3)
+    strokemap.translate_shapes([empty], 5, 3)
+    strokemap.translate_shapes([], 5, 3)
+    from lib import layer
+    l = layer.PaintingLayer()
+    move = l.get_move(0, 0)
+    move.update(5, 3)
+    move.cleanup()
+    assert l.strokes == []
+
+def strokeIndex():
+    # picking strokes by position finds the topmost stroke at the point,
+    # following changes to the layer's list of strokes
+    from lib import layer
+    N = mypaintlib.TILE_SIZE
+    def make_stroke(rows):
+        bitmap = zeros((N, N), 'uint8')
+        bitmap[rows] = 1
+        return make_strokeshape({(0, 0): bitmap})
+    l = layer.PaintingLayer()
+    s1 = make_stroke(slice(0, N))
+    s2 = make_stroke(slice(0, N/2))
+    l.strokes.append(s1)
+    assert l.get_stroke_info_at(1, N-1) is s1
+    l.strokes.append(s2)
+    assert l.get_stroke_info_at(1, 1) is s2
+    assert l.get_stroke_info_at(1, N-1) is s1
+    assert l.get_stroke_info_at(N+1, 1) is None
+    l.strokes = [s2]
+    assert l.get_stroke_info_at(1, N-1) is None
+    l.trim((0, 0, N, N/4))
+    assert l.get_stroke_info_at(1, 1) is s2
+
+def renderPlan():
+    # a render plan gives the same result as compositing step by step
+    N = mypaintlib.TILE_SIZE
+    one = 1<<15
+    src1 = zeros((N, N, 4), 'uint16')
+    src1[:, :N/2] = (one/2, 0, 0, one/2)
+    src2 = zeros((N, N, 4), 'uint16')
+    src2[N/4:] = (0, one/4, one/4, one/2)
+    bg = zeros((N, N, 4), 'uint16')
+    bg[:] = (one, one, one, one)
+    multiply = mypaintlib.CombineMultiply
+    normal = mypaintlib.CombineNormal
+
+    dst1 = bg.copy()
+    mypaintlib.tile_combine(normal, src1, dst1, False, 1.0)
+    tmp = zeros((N, N, 4), 'uint16')
+    mypaintlib.tile_combine(normal, src2, tmp, True, 0.5)
+    mypaintlib.tile_combine(multiply, src1, tmp, True, 1.0)
+    mypaintlib.tile_combine(normal, tmp, dst1, False, 0.75)
+
+    dst2 = bg.copy()
+    plan = [(mypaintlib.RenderPlanCombine, src1, normal, 1.0),
+            (mypaintlib.RenderPlanCombine, None, normal, 1.0),
+            (mypaintlib.RenderPlanPush, None, normal, 0.0),
+            (mypaintlib.RenderPlanCombine, src2, normal, 0.5),
+            (mypaintlib.RenderPlanCombine, src1, multiply, 1.0),
+            (mypaintlib.RenderPlanPop, None, normal, 0.75)]
+    mypaintlib.tile_combine_plan(plan, dst2, False)
+    assert (dst1 == dst2).all()
+
+    bad = [(mypaintlib.RenderPlanPop, None, normal, 1.0)]
+    try:
+        mypaintlib.tile_combine_plan(bad, dst2, False)
+    except ValueError:
+        pass
+    else:
+        assert False, 'unbalanced plan accepted'
+
+    # arrays are checked before compositing without the GIL
+    for arr, exc in [(zeros((N, N, 4), 'uint8'), TypeError),
+                     (zeros((N, N/2, 4), 'uint16'), ValueError),
+                     (zeros((N, N, 8), 'uint16')[:, :, ::2], ValueError)]:
+        for src, dst in [(arr, dst2), (src1, arr)]:
+            try:
+                plan = [(mypaintlib.RenderPlanCombine, src, normal, 1.0)]
+                mypaintlib.tile_combine_plan(plan, dst, False)
+            except exc:
+                pass
+            else:
+                assert False, 'bad tile array accepted'
+
+def frameRendering():
+    # frames rendered on worker threads are the merges of their cels,
+    # held frames are rendered once, and merged tiles get cached
+    from lib import layer
+    N = mypaintlib.TILE_SIZE
+    one = 1<<15
+    doc = document.Document()
+    cels = []
+    for i, colour in enumerate([(one/2, 0, 0, one/2), (0, one/4, 0, one/2),
+                                (0, 0, one, one)]):
+        l = layer.PaintingLayer()
+        for tx in (0, i+1):
+            with l._surface.tile_request(tx, 0, readonly=False) as dst:
+                dst[:,:] = colour
+        doc.layer_stack.append(l)
+        cels.append(l)
+    ani = doc.ani
+    timeline = ani.timeline
+    timeline[0][0].cel = cels[0]
+    timeline[0][2].cel = cels[2]
+    timeline.append_layer()
+    timeline[1][0].cel = cels[1]
+    timeline[1].opacity = 0.5
+    bbox = (0, 0, 4*N, N)
+    frames = list(ani._iter_frames(bbox))
+    assert [(i, repeat) for (i, pixels, repeat) in frames] == \
+        [(0, False), (1, True), (2, False)]
+    assert frames[0][1] is frames[1][1]
+    for i, pixels, repeat in frames:
+        merged = ani.merge(timeline.cels_at(i))
+        expected = zeros((N, 4*N, 4), 'uint8')
+        for (tx, ty), tile in merged._surface.tiledict.items():
+            dst = expected[:, tx*N:(tx+1)*N]
+            mypaintlib.tile_convert_rgba16_to_rgba8(tile.rgba, dst)
+        assert (pixels == expected).all()
+    hits = ani.merge_cache.hits
+    flat = list(ani._iter_frames(bbox, background=(255, 255, 255)))
+    assert ani.merge_cache.hits > hits
+    assert flat[0][1].shape == (N, 4*N, 3)
+    assert flat[0][1].flags.c_contiguous
+
+def groupedMerge():
+    # cels grouped by sorting the layers are still merged through the
+    # merge cache, giving the same tiles as normalizing them
+    from lib import layer
+    N = mypaintlib.TILE_SIZE
+    one = 1<<15
+    doc = document.Document()
+    cels = []
+    for i, colour in enumerate([(one/2, 0, 0, one/2), (0, one/4, 0, one/2),
+                                (0, 0, one, one)]):
+        l = layer.PaintingLayer()
+        for tx in (0, i+1):
+            with l._surface.tile_request(tx, 0, readonly=False) as dst:
+                dst[:,:] = colour
+        doc.layer_stack.append(l)
+        cels.append(l)
+    ani = doc.ani
+    timeline = ani.timeline
+    timeline[0][0].cel = cels[0]
+    timeline.append_layer()
+    timeline[1][0].cel = cels[1]
+    timeline.append_layer()
+    timeline[2][0].cel = cels[2]
+    timeline[2].visible = False
+    ani.sort_layers()
+    for cel in cels:
+        assert len(doc.layer_stack.deepindex(cel)) == 2
+    layers = timeline.cels_at(0)
+    cache = ani.merge_cache
+    assert cache.get_sources(layers) is not None
+    expected = ani._merge_normalized(layers)._surface.tiledict
+    for i in range(2):
+        hits = cache.hits
+        merged = ani.merge(layers)._surface.tiledict
+        assert sorted(merged) == sorted(expected)
+        for pos, tile in merged.items():
+            assert (tile.rgba == expected[pos].rgba).all()
+    assert cache.hits > hits
+    # frames of grouped cels are merged by the renderer's workers
+    import threading
+    from lib import animation
+    lib = animation.mypaintlib
+    merging_threads = []
+    class RecordingLib (object):
+        def __getattr__(self, name):
+            return getattr(lib, name)
+        def tile_combine_plan(self, *args):
+            merging_threads.append(threading.current_thread())
+            return lib.tile_combine_plan(*args)
+    cache.clear()
+    animation.mypaintlib = RecordingLib()
+    try:
+        frames = list(ani._iter_frames((0, 0, 4*N, N)))
+    finally:
+        animation.mypaintlib = lib
+    assert merging_threads
+    for thread in merging_threads:
+        assert thread.name == "FrameRenderer"
+    # saving frames takes the PNG writer's options, and no others
+    ani.save_png('test_groupedMerge.png', write_legacy_png=False)
+    try:
+        ani.save_png('test_groupedMerge.png', quality=90)
+    except TypeError:
+        pass
+    else:
+        assert False, 'unknown save option accepted'
+    # non-default parent stacks still fall back to normalizing
+    parent = doc.layer_stack.deepget(doc.layer_stack.deepindex(cels[0])[:1])
+    parent.opacity = 0.5
+    assert cache.get_sources(layers) is None
+
 def layerModes():
     N = mypaintlib.TILE_SIZE
 
@@ -302,6 +956,23 @@ parser = OptionParser('usage: %prog [options]')
 options, tests = parser.parse_args()
 
 #tileConversions()
+packedTiles()
+solidTiles()
+lazyMipmaps()
+spilledSnapshots()
+undoMemoryBudget()
+partialSnapshotLoad()
+playbackCacheInvalidation()
+playbackPrerender()
+progressiveLoad()
+incrementalSave()
+xsheetSave()
+parallelSave()
+strokemapTranslate()
+strokeIndex()
+renderPlan()
+frameRendering()
+groupedMerge()
 #layerModes()
 directPaint()
 brushPaint()
@@ -0,0 +1,69 @@
+# test the persistent tile map used by tiled surfaces
+import sys
+import unittest
+
+sys.path.insert(0, '..')
+
+from lib.tilemap import TileMap
+
+class Tile(object):
+    def __init__(self):
+        self.readonly = False
+
+class TestTileMap(unittest.TestCase):
+
+    def setUp(self):
+        self.tiles = {}
+        self.m = TileMap()
+        for pos in [(0, 0), (1, 0), (-1, -1), (40, 3), (-100, 57)]:
+            self.tiles[pos] = self.m[pos] = Tile()
+
+    def test_dict_interface(self):
+        m = self.m
+        self.assertEqual(len(m), 5)
+        self.assertEqual(sorted(m.keys()), sorted(self.tiles.keys()))
+        self.assertEqual(dict(m.items()), self.tiles)
+        self.assertTrue((40, 3) in m)
+        self.assertFalse((41, 3) in m)
+        self.assertTrue(m[-1, -1] is self.tiles[-1, -1])
+        self.assertEqual(m.get((2, 2)), None)
+        self.assertRaises(KeyError, lambda: m[2, 2])
+        m[0, 0] = Tile()
+        self.assertEqual(len(m), 5)
+        del m[0, 0]
+        self.assertEqual(m.pop((2, 2), 'x'), 'x')
+        self.assertTrue(m.pop((1, 0)) is self.tiles[1, 0])
+        self.assertEqual(len(m), 3)
+        self.assertRaises(KeyError, m.pop, (1, 0))
+        self.assertFalse(TileMap())
+
+    def test_copies_are_independent(self):
+        a = self.m
+        b = a.copy()
+        self.assertTrue(a == b)
+        a[0, 0] = Tile()
+        del a[40, 3]
+        b[7, 7] = Tile()
+        self.assertTrue(b[0, 0] is self.tiles[0, 0])
+        self.assertTrue((40, 3) in b)
+        self.assertFalse((7, 7) in a)
+        self.assertEqual(len(a), 4)
+        self.assertEqual(len(b), 6)
+        self.assertEqual(a.diff(b), set([(0, 0), (40, 3), (7, 7)]))
+        self.assertEqual(b.diff(a), a.diff(b))
+        self.assertTrue(a != b)
+
+    def test_copy_freezes_new_tiles(self):
+        a = self.m
+        b = a.copy()
+        for tile in self.tiles.values():
+            self.assertTrue(tile.readonly)
+        t = a[3, 3] = Tile()
+        self.assertFalse(t.readonly)
+        b.copy()  # only freezes what was stored in b
+        self.assertFalse(t.readonly)
+        a.copy()
+        self.assertTrue(t.readonly)
+
+if __name__ == '__main__':
+    unittest.main()
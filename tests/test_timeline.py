@@ -0,0 +1,174 @@
+# test the animation timeline data structures
+import sys
+import unittest
+from copy import deepcopy
+
+sys.path.insert(0, '..')
+
+from lib.timeline import *
+
+class TestFrameListIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.fl = FrameList()
+        for i in (10, 2, 7, 30, 4):
+            self.fl[i].add_cel('cel%d' % i)
+        self.fl[5].set_key()
+
+    def test_first_last(self):
+        fl = self.fl
+        self.assertEqual(fl.get_first(), 2)
+        self.assertEqual(fl.get_last(), 30)
+        self.assertEqual(FrameList().get_first(), 0)
+        self.assertEqual(FrameList().get_last(), 0)
+
+    def test_iteration_is_sorted(self):
+        self.assertEqual(list(self.fl), [2, 4, 5, 7, 10, 30])
+        self.assertEqual(list(reversed(self.fl)), [30, 10, 7, 5, 4, 2])
+
+    def test_iteration_checks_for_changes(self):
+        fl = self.fl
+        with self.assertRaises(RuntimeError):
+            for f in fl:
+                fl.pop(f)
+        with self.assertRaises(RuntimeError):
+            for f in reversed(fl):
+                fl[f + 1]
+        # changing frames, or looking up existing ones, is fine
+        for f in fl:
+            fl[f].toggle_key()
+        self.assertEqual(list(fl), [4, 5, 7, 10, 30, 31])
+
+    def test_revision_follows_frame_changes(self):
+        fl = self.fl
+        for change in [lambda f: f.set_key(),
+                       lambda f: f.toggle_skip_visible(),
+                       lambda f: setattr(f, 'description', 'x'),
+                       lambda f: f.add_cel('other')]:
+            revision = fl.revision
+            change(fl[7])
+            self.assertTrue(fl.revision > revision)
+
+    def test_key_range(self):
+        fl = self.fl
+        self.assertEqual(fl.key_range(5, 1), [7, 10, 30])
+        self.assertEqual(fl.key_range(5, -1), [4, 2])
+        self.assertEqual(fl.key_range(4, 1, 10), [5, 7, 10])
+        self.assertEqual(fl.key_range(10, -1, 4), [7, 5, 4])
+        self.assertEqual(fl.key_range(5, 0), [])
+
+    def test_cel_at(self):
+        fl = self.fl
+        self.assertEqual(fl.cel_at(1), None)
+        self.assertEqual(fl.cel_at(2), 'cel2')
+        self.assertEqual(fl.cel_at(5), 'cel4')
+        self.assertEqual(fl.cel_at(29), 'cel10')
+        self.assertEqual(fl.cel_at(1000), 'cel30')
+
+    def test_index_follows_mutation(self):
+        fl = self.fl
+        fl.pop(30)
+        self.assertEqual(fl.get_last(), 10)
+        del fl[2]
+        self.assertEqual(fl.get_first(), 4)
+        fl.remove_frames(4, 2)
+        self.assertEqual(list(fl), [7, 10])
+        fl.change_keys(3, 0)
+        self.assertEqual(list(fl), [10, 13])
+        self.assertEqual(fl.cel_at(12), 'cel7')
+        fl.cleanup()
+        self.assertEqual(list(fl), [10, 13])
+        fl.clear()
+        self.assertEqual(list(fl), [])
+
+    def test_cleanup(self):
+        fl = self.fl
+        fl[40]
+        fl.cleanup()
+        self.assertEqual(list(fl), [2, 4, 5, 7, 10, 30])
+
+    def test_deepcopy(self):
+        fl = deepcopy(self.fl)
+        self.assertEqual(list(fl), list(self.fl))
+        fl[50]
+        self.assertEqual(fl.get_last(), 50)
+        self.assertEqual(self.fl.get_last(), 30)
+
+
+class TestTimeLineNavigation(unittest.TestCase):
+
+    def setUp(self):
+        self.tl = TimeLine()
+        self.tl.append_layer()
+        self.tl.append_layer()
+        for i in (0, 6, 12):
+            self.tl[0][i].add_cel('a%d' % i)
+            self.tl[0][i].set_key()
+        for i in (3, 9):
+            self.tl[1][i].add_cel('b%d' % i)
+            self.tl[1][i].set_key()
+        self.tl.select(6)
+
+    def test_keys(self):
+        tl = self.tl
+        self.assertEqual(tl.get_next_key(0, False), 12)
+        self.assertEqual(tl.get_previous_key(0, False), 0)
+        self.assertEqual(tl.get_next_key(1), 9)
+        self.assertEqual(tl.get_previous_key(1), 3)
+
+    def test_cels(self):
+        tl = self.tl
+        self.assertEqual(tl.get_next_cel(0), 12)
+        self.assertEqual(tl.get_previous_cel(0), 0)
+        self.assertEqual(tl.cels_at(7), ['a6', 'b3'])
+
+    def test_effective_paths(self):
+        paths = self.tl.get_effective_paths()
+        self.assertEqual([p[2] for p in paths], ['a12', 'a6', 'a0', 'b9', 'b3'])
+        self.assertEqual(paths[3][0], (1, 0))
+
+
+class TestLightbox(unittest.TestCase):
+
+    def setUp(self):
+        self.tl = TimeLine()
+        self.tl.append_layer()
+        for i in range(0, 120, 12):
+            self.tl[0][i].add_cel('c%d' % i)
+        self.tl[0][0].set_key()
+        self.tl[0][60].set_key()
+        self.tl.select(30)
+        self.lightbox = Lightbox(self.tl)
+
+    def check_applied(self, changes, applied):
+        opacities = self.tl.get_opacities()[0]
+        for cel, (opa, vis) in changes.items():
+            applied[cel] = opa
+        for cel in list(applied):
+            if cel not in opacities:
+                del applied[cel]
+        self.assertEqual(applied, opacities)
+
+    def test_matches_full_recomputation(self):
+        applied = {}
+        self.check_applied(self.lightbox.update(), applied)
+        for idx in (31, 35, 36, 59, 60, 61, 119, 200, -5, 30):
+            self.tl.select(idx)
+            self.check_applied(self.lightbox.update(), applied)
+        self.tl[0][40].set_key()
+        self.check_applied(self.lightbox.update(), applied)
+        self.tl[0].pop(48)
+        self.check_applied(self.lightbox.update(), applied)
+
+    def test_only_changes_returned(self):
+        self.lightbox.update()
+        self.tl.select(31)
+        changes = self.lightbox.update()
+        # current cel and hidden cels keep their values
+        self.assertTrue('c24' not in changes)
+        self.assertTrue('c96' not in changes)
+        self.assertTrue('c36' in changes)
+        self.assertEqual(self.lightbox.update(), {})
+
+if __name__ == '__main__':
+    unittest.main()
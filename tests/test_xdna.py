@@ -154,5 +154,67 @@ class TestXDNASignatureFunctions(unittest.TestCase):
         self.assertTrue(['xsheet', 'framerate'] in diff['changed_type'])
         self.assertTrue(['xsheet', 'raster_frame_lists', '0', 'raster_frame_list', '0', 'description'] in diff['changed_type'])
 
+class TestXDNABinaryFormat(unittest.TestCase):
+
+    def setUp(self):
+        self.xdna = XDNA()
+
+        self.xsheet = {
+            'metadata': self.xdna.application_signature,
+            'framerate': 24.0,
+            'cels': [(0,), (2, 1)],
+            'raster_frame_lists': [{
+                'name': u'ink \u2013 1',
+                'visible': True,
+                'opacity': 0.5,
+                'locked': False,
+                'composite': 'svg:src-over',
+                'frames': [-2, 0, 7],
+                'flags': [FRAME_KEY, FRAME_DESCRIBED, FRAME_SKIP_VISIBLE],
+                'cels': [1, None, 0],
+                'descriptions': [u'', u'walk cycle', u'']
+            }, {
+                'name': u'empty',
+                'visible': False,
+                'opacity': 1.0,
+                'locked': True,
+                'composite': 'svg:multiply',
+                'frames': [],
+                'flags': [],
+                'cels': [],
+                'descriptions': []
+            }]
+        }
+
+    def test_roundtrip(self):
+        x = self.xdna
+
+        data = x.binary_serialize(self.xsheet)
+
+        self.assertTrue(x.is_binary(data))
+        self.assertEqual(x.binary_deserialize(data), self.xsheet)
+
+    def test_json_is_not_binary(self):
+        x = self.xdna
+
+        self.assertFalse(x.is_binary(x.data_serialize({'XDNA': {}})))
+
+    def test_truncated(self):
+        x = self.xdna
+
+        data = x.binary_serialize(self.xsheet)
+
+        for n in (len(BINARY_MAGIC) + 1, len(data) // 2, len(data) - 1):
+            self.assertRaises(ValueError, x.binary_deserialize, data[:n])
+
+    def test_newer_version(self):
+        x = self.xdna
+
+        data = x.binary_serialize(self.xsheet)
+        i = len(BINARY_MAGIC)
+        data = data[:i] + struct.pack('>H', BINARY_VERSION + 1) + data[i+2:]
+
+        self.assertRaises(ValueError, x.binary_deserialize, data)
+
 if __name__ == '__main__':
     unittest.main()